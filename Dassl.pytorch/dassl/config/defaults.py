@@ -31,6 +31,9 @@ _C.INPUT.INTERPOLATION = "bilinear"
 _C.INPUT.TRANSFORMS = ()
 # If True, tfm_train and tfm_test will be None
 _C.INPUT.NO_TRANSFORM = False
+# Run the training augmentation on whole batches on the device, the
+# data-loader workers only resize the images (see BATCH_CHOICES)
+_C.INPUT.BATCH_TRANSFORM = False
 # Mean and std (default: ImageNet)
 _C.INPUT.PIXEL_MEAN = [0.485, 0.456, 0.406]
 _C.INPUT.PIXEL_STD = [0.229, 0.224, 0.225]
@@ -86,17 +89,39 @@ _C.DATASET.CIFAR_C_TYPE = ""
 _C.DATASET.CIFAR_C_LEVEL = 1
 # Use all data in the unlabeled data set (e.g. FixMatch)
 _C.DATASET.ALL_AS_UNLABELED = False
+# Directory of the dataset packed by pack_dataset.py (empty means
+# reading the image files)
+_C.DATASET.PACKED_DIR = ""
+# Directory of the cached manifests (image paths, labels and domains)
+# of the built datasets (empty means building the dataset every time)
+_C.DATASET.MANIFEST_DIR = ""
+# Store the splits as numpy arrays (ColumnarData) instead of lists of
+# Datum, which keeps the memory of data-loader workers shared
+_C.DATASET.COLUMNAR = False
 
 ###########################
 # Dataloader
 ###########################
 _C.DATALOADER = CN()
 _C.DATALOADER.NUM_WORKERS = 4
+# Keep the worker processes alive between epochs
+_C.DATALOADER.PERSISTENT_WORKERS = False
+# Number of batches loaded in advance by each worker
+_C.DATALOADER.PREFETCH_FACTOR = 2
+# Copy the next training batch to the device (on a side CUDA stream)
+# while the current step runs
+_C.DATALOADER.DEVICE_PREFETCH = False
+# Make the training data-loaders endless streams that are iterated
+# once and never restarted (the sampler reshuffles at each pass)
+_C.DATALOADER.INFINITE = False
 # Apply transformations to an image K times (during training)
 _C.DATALOADER.K_TRANSFORMS = 1
 # img0 denotes image tensor without augmentation
 # Useful for consistency learning
 _C.DATALOADER.RETURN_IMG0 = False
+# Size (in MB) of the shared-memory cache of decoded images
+# resized to INPUT.SIZE, used by the training loaders (0 means no cache)
+_C.DATALOADER.IMAGE_CACHE_MB = 0
 # Setting for the train_x data-loader
 _C.DATALOADER.TRAIN_X = CN()
 _C.DATALOADER.TRAIN_X.SAMPLER = "RandomSampler"
@@ -191,11 +216,17 @@ _C.TRAIN = CN()
 # How often (epoch) to save model during training
 # Set to 0 or negative value to only save the last one
 _C.TRAIN.CHECKPOINT_FREQ = 0
+# Save model-last.pth.tar every N iterations (0 means never), from
+# which TrainerXU resumes at the next batch with the same data order
+_C.TRAIN.CHECKPOINT_ITER_FREQ = 0
 # How often (batch) to print training information
 _C.TRAIN.PRINT_FREQ = 10
 # Use 'train_x', 'train_u' or 'smaller_one' to count
 # the number of iterations in an epoch (for DA and SSL)
 _C.TRAIN.COUNT_ITER = "train_x"
+# Use 'fp32', 'fp16' (autocast + GradScaler, CUDA only)
+# or 'bf16' (autocast) for training and testing
+_C.TRAIN.PRECISION = "fp32"
 
 ###########################
 # Test
@@ -214,6 +245,23 @@ _C.TEST.SPLIT = "test"
 # If best_val, evaluation is done every epoch (if val data
 # is unavailable, test data will be used)
 _C.TEST.FINAL_MODEL = "last_step"
+# Run the intermediate tests on a CPU snapshot of the weights
+# in a background thread while training continues
+_C.TEST.BACKGROUND = False
+# Device of the background tests (empty: the training device)
+_C.TEST.BACKGROUND_DEVICE = ""
+# Size of the fixed class-stratified subset of val/test scored by
+# the intermediate tests (0: whole split), a 95% confidence
+# interval is reported next to the accuracy
+_C.TEST.SUBSET_SIZE = 0
+# Seed of the subset, the same subset is used across runs
+_C.TEST.SUBSET_SEED = 0
+# Test-time augmentation: views scored along with each test image
+# in one model call, among "flip" and "crops" (four corner and one
+# center crops), or trainer-specific ones; empty: off
+_C.TEST.TTA = ()
+# Relative size of the TTA crops, resized back to INPUT.SIZE
+_C.TEST.TTA_CROP_SCALE = 0.875
 
 ###########################
 # Trainer specifics
@@ -1,3 +1,5 @@
+import os.path as osp
+import numpy as np
 import torch
 import torchvision.transforms as T
 from tabulate import tabulate
@@ -6,8 +8,42 @@ from torch.utils.data import Dataset as TorchDataset
 from dassl.utils import read_image
 
 from .datasets import build_dataset
-from .samplers import build_sampler
+from .samplers import (
+    InfiniteSampler, ResumableSampler, build_sampler, column, group_indices
+)
+from .image_cache import SharedImageCache
+from .packed import PackedImages
 from .transforms import INTERPOLATION_MODES, build_transform
+from .transforms.batch_transforms import BatchTransform
+
+
+def stratified_subset(data_source, size, seed, num_classes):
+    """Draw a fixed class-stratified subset of about size items.
+
+    Classes get a share of the subset proportional to their size, and at
+    least two items (when they have as many) so that their variance can
+    be estimated.
+
+    Returns:
+        idxs (np.ndarray): sorted indices of the subset.
+        population (np.ndarray): number of items per class in data_source.
+    """
+    labels = np.asarray(column(data_source, "label"))
+    population = np.bincount(labels, minlength=num_classes)
+
+    # Largest remainder allocation
+    quotas = size * population / len(labels)
+    counts = np.floor(quotas).astype(np.int64)
+    remainder = size - counts.sum()
+    counts[np.argsort(counts - quotas, kind="stable")[:remainder]] += 1
+    counts = np.maximum(counts, np.minimum(population, 2))
+
+    rng = np.random.default_rng(seed)
+    idxs = [
+        rng.choice(group, counts[label], replace=False)
+        for label, group in sorted(group_indices(labels).items())
+    ]
+    return np.sort(np.concatenate(idxs)), population
 
 
 def build_data_loader(
@@ -19,7 +55,8 @@ def build_data_loader(
     n_ins=2,
     tfm=None,
     is_train=True,
-    dataset_wrapper=None
+    dataset_wrapper=None,
+    image_cache=None
 ):
     # Build sampler
     sampler = build_sampler(
@@ -30,24 +67,47 @@ def build_data_loader(
         n_domain=n_domain,
         n_ins=n_ins
     )
+    if is_train and cfg.TRAIN.CHECKPOINT_ITER_FREQ > 0:
+        # Training can then be resumed in the middle of an epoch
+        sampler = ResumableSampler(sampler)
+    if is_train and cfg.DATALOADER.INFINITE:
+        sampler = InfiniteSampler(sampler)
 
     if dataset_wrapper is None:
         dataset_wrapper = DatasetWrapper
 
+    # Worker options that only apply with worker processes
+    worker_kwargs = {}
+    if cfg.DATALOADER.NUM_WORKERS > 0:
+        worker_kwargs["persistent_workers"] = cfg.DATALOADER.PERSISTENT_WORKERS
+        worker_kwargs["prefetch_factor"] = cfg.DATALOADER.PREFETCH_FACTOR
+
     # Build data loader
     data_loader = torch.utils.data.DataLoader(
-        dataset_wrapper(cfg, data_source, transform=tfm, is_train=is_train),
+        dataset_wrapper(
+            cfg,
+            data_source,
+            transform=tfm,
+            is_train=is_train,
+            image_cache=image_cache
+        ),
         batch_size=batch_size,
         sampler=sampler,
         num_workers=cfg.DATALOADER.NUM_WORKERS,
         drop_last=is_train and len(data_source) >= batch_size,
-        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA)
+        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA),
+        **worker_kwargs
     )
     assert len(data_loader) > 0
 
     return data_loader
 
 
+def _size_list(size):
+    # Resize accepts an int (shorter side) or a sequence
+    return [size] if isinstance(size, int) else list(size)
+
+
 class DataManager:
 
     def __init__(
@@ -73,6 +133,12 @@ class DataManager:
             print("* Using custom transform for testing")
             tfm_test = custom_tfm_test
 
+        # Decoded images shared by the training loaders (the cache resizes
+        # to INPUT.SIZE, which would skip the center crop of tfm_test)
+        image_cache = None
+        if cfg.DATALOADER.IMAGE_CACHE_MB > 0:
+            image_cache = SharedImageCache.from_cfg(cfg, dataset)
+
         # Build train_loader_x
         train_loader_x = build_data_loader(
             cfg,
@@ -83,7 +149,8 @@ class DataManager:
             n_ins=cfg.DATALOADER.TRAIN_X.N_INS,
             tfm=tfm_train,
             is_train=True,
-            dataset_wrapper=dataset_wrapper
+            dataset_wrapper=dataset_wrapper,
+            image_cache=image_cache
         )
 
         # Build train_loader_u
@@ -109,7 +176,8 @@ class DataManager:
                 n_ins=n_ins_,
                 tfm=tfm_train,
                 is_train=True,
-                dataset_wrapper=dataset_wrapper
+                dataset_wrapper=dataset_wrapper,
+                image_cache=image_cache
             )
 
         # Build val_loader
@@ -136,6 +204,28 @@ class DataManager:
             dataset_wrapper=dataset_wrapper
         )
 
+        # Fixed class-stratified subsets for the intermediate tests, along
+        # with the number of items per class of the whole split
+        subsets = {}
+        subset_size = cfg.TEST.SUBSET_SIZE
+        for split, data_source in [("val", dataset.val), ("test", dataset.test)]:
+            if not data_source or not 0 < subset_size < len(data_source):
+                continue
+            idxs, population = stratified_subset(
+                data_source, subset_size, cfg.TEST.SUBSET_SEED,
+                dataset.num_classes
+            )
+            subset_loader = build_data_loader(
+                cfg,
+                sampler_type=cfg.DATALOADER.TEST.SAMPLER,
+                data_source=[data_source[i] for i in idxs],
+                batch_size=cfg.DATALOADER.TEST.BATCH_SIZE,
+                tfm=tfm_test,
+                is_train=False,
+                dataset_wrapper=dataset_wrapper
+            )
+            subsets[split] = (subset_loader, population)
+
         # Attributes
         self._num_classes = dataset.num_classes
         self._num_source_domains = len(cfg.DATASET.SOURCE_DOMAINS)
@@ -147,6 +237,7 @@ class DataManager:
         self.train_loader_u = train_loader_u
         self.val_loader = val_loader
         self.test_loader = test_loader
+        self.subsets = subsets  # {split: (data_loader, population)}
 
         if cfg.VERBOSE:
             self.show_dataset_summary(cfg)
@@ -187,15 +278,25 @@ class DataManager:
 
 class DatasetWrapper(TorchDataset):
 
-    def __init__(self, cfg, data_source, transform=None, is_train=False):
+    def __init__(
+        self, cfg, data_source, transform=None, is_train=False, image_cache=None
+    ):
         self.cfg = cfg
         self.data_source = data_source
+        self.image_cache = image_cache
         self.transform = transform  # accept list (tuple) as input
         self.is_train = is_train
         # Augmenting an image K>1 times is only allowed during training
         self.k_tfm = cfg.DATALOADER.K_TRANSFORMS if is_train else 1
         self.return_img0 = cfg.DATALOADER.RETURN_IMG0
 
+        # Images packed into shards by pack_images()
+        self.packed = None
+        if cfg.DATASET.PACKED_DIR:
+            root = osp.abspath(osp.expanduser(cfg.DATASET.ROOT))
+            packed_dir = osp.abspath(osp.expanduser(cfg.DATASET.PACKED_DIR))
+            self.packed = PackedImages(packed_dir, root)
+
         if self.k_tfm > 1 and transform is None:
             raise ValueError(
                 "Cannot augment the image {} times "
@@ -204,8 +305,9 @@ class DatasetWrapper(TorchDataset):
 
         # Build transform that doesn't apply any data augmentation
         interp_mode = INTERPOLATION_MODES[cfg.INPUT.INTERPOLATION]
+        resize = T.Resize(cfg.INPUT.SIZE, interpolation=interp_mode)
         to_tensor = []
-        to_tensor += [T.Resize(cfg.INPUT.SIZE, interpolation=interp_mode)]
+        to_tensor += [resize]
         to_tensor += [T.ToTensor()]
         if "normalize" in cfg.INPUT.TRANSFORMS:
             normalize = T.Normalize(
@@ -214,6 +316,21 @@ class DatasetWrapper(TorchDataset):
             to_tensor += [normalize]
         self.to_tensor = T.Compose(to_tensor)
 
+        # When every transform starts by resizing to INPUT.SIZE, the image
+        # is resized once and all views (and img0) start from that base
+        self.base_resize = None
+        if transform is not None:
+            transforms = transform
+            if not isinstance(transform, (list, tuple)):
+                transforms = [transform]
+            view_transforms = [
+                self._strip_resize(tfm, resize) for tfm in transforms
+            ]
+            if all(tfm is not None for tfm in view_transforms):
+                self.base_resize = resize
+                self.view_transforms = view_transforms
+                self.base_to_tensor = T.Compose(to_tensor[1:])
+
     def __len__(self):
         return len(self.data_source)
 
@@ -227,27 +344,83 @@ class DatasetWrapper(TorchDataset):
             "index": idx
         }
 
-        img0 = read_image(item.impath)
+        img0 = self.read_image(item.impath)
 
-        if self.transform is not None:
-            if isinstance(self.transform, (list, tuple)):
-                for i, tfm in enumerate(self.transform):
+        transform = self.transform
+        to_tensor = self.to_tensor
+        if self.base_resize is not None:
+            img0 = self.base_resize(img0)
+            transform = self.view_transforms
+            to_tensor = self.base_to_tensor
+
+        if transform is not None:
+            if isinstance(transform, (list, tuple)):
+                for i, tfm in enumerate(transform):
                     img = self._transform_image(tfm, img0)
                     keyname = "img"
                     if (i + 1) > 1:
                         keyname += str(i + 1)
                     output[keyname] = img
             else:
-                img = self._transform_image(self.transform, img0)
+                img = self._transform_image(transform, img0)
                 output["img"] = img
         else:
             output["img"] = img0
 
         if self.return_img0:
-            output["img0"] = self.to_tensor(img0)  # without any augmentation
+            output["img0"] = to_tensor(img0)  # without any augmentation
 
         return output
 
+    def apply_batch_transform(self, batch, device):
+        """Run the batched part of BatchTransform transforms (see
+        INPUT.BATCH_TRANSFORM) on a collated batch, on device."""
+        transforms = self.transform
+        if not isinstance(transforms, (list, tuple)):
+            transforms = [transforms]
+
+        for i, tfm in enumerate(transforms):
+            if not isinstance(tfm, BatchTransform):
+                continue
+            keyname = "img"
+            if (i + 1) > 1:
+                keyname += str(i + 1)
+            imgs = batch[keyname]
+            if isinstance(imgs, list):
+                batch[keyname] = [tfm.apply_batch(x.to(device)) for x in imgs]
+            else:
+                batch[keyname] = tfm.apply_batch(imgs.to(device))
+
+        return batch
+
+    def read_image(self, impath):
+        decode = read_image if self.packed is None else self.packed.read
+        if self.image_cache is not None:
+            return self.image_cache.read(impath, decode=decode)
+        return decode(impath)
+
+    @staticmethod
+    def _strip_resize(tfm, resize):
+        """Return tfm without its leading resize if it is the same as
+        resize, otherwise None."""
+        if isinstance(tfm, BatchTransform):
+            tfm = tfm.sample_transform
+        if not isinstance(tfm, T.Compose) or not tfm.transforms:
+            return None
+
+        first = tfm.transforms[0]
+        same_resize = (
+            isinstance(first, T.Resize)
+            and _size_list(first.size) == _size_list(resize.size)
+            and first.interpolation == resize.interpolation
+            and first.max_size == resize.max_size
+            and first.antialias == resize.antialias
+        )
+        if not same_resize:
+            return None
+
+        return T.Compose(tfm.transforms[1:])
+
     def _transform_image(self, tfm, img0):
         img_list = []
 
@@ -4,6 +4,7 @@ import os.path as osp
 import tarfile
 import zipfile
 from collections import defaultdict
+import numpy as np
 import gdown
 
 from dassl.utils import check_isfile
@@ -17,11 +18,15 @@ class Datum:
         label (int): class label.
         domain (int): domain label.
         classname (str): class name.
+        check_file (bool): check that impath exists.
     """
 
-    def __init__(self, impath="", label=0, domain=0, classname=""):
+    def __init__(
+        self, impath="", label=0, domain=0, classname="", check_file=True
+    ):
         assert isinstance(impath, str)
-        assert check_isfile(impath)
+        if check_file:
+            assert check_isfile(impath)
 
         self._impath = impath
         self._label = label
@@ -45,6 +50,110 @@ class Datum:
         return self._classname
 
 
+class ColumnarData:
+    """A list of Datum stored as a few numpy arrays.
+
+    Labels and domains are integer arrays, image paths are one utf-8
+    buffer plus offsets and class names are indices into a table. Unlike
+    a list of Datum, which holds several Python objects per image, it
+    holds a fixed number of objects, so that data-loader workers forked
+    from the main process do not write to (and thereby copy) its pages
+    when updating reference counts.
+
+    Indexing returns a Datum built on the fly, so code that works on
+    lists of Datum keeps working. Code that scans the whole list should
+    use the labels and domains arrays instead.
+
+    Args:
+        path_buffer (np.ndarray): uint8 array of the concatenated paths.
+        path_offsets (np.ndarray): start of each path in path_buffer,
+            followed by the end of the last one.
+        labels (np.ndarray): class labels.
+        domains (np.ndarray): domain labels.
+        classnames (np.ndarray): table of class names.
+        classname_idxs (np.ndarray): index of each class name in the table.
+    """
+
+    def __init__(
+        self, path_buffer, path_offsets, labels, domains, classnames,
+        classname_idxs
+    ):
+        self.path_buffer = path_buffer
+        self.path_offsets = path_offsets
+        self.labels = labels
+        self.domains = domains
+        self.classnames = classnames
+        self.classname_idxs = classname_idxs
+
+    @classmethod
+    def from_datums(cls, data_source):
+        impaths = [item.impath.encode() for item in data_source]
+        path_offsets = np.zeros(len(impaths) + 1, dtype=np.int64)
+        np.cumsum([len(impath) for impath in impaths], out=path_offsets[1:])
+        classnames, classname_idxs = np.unique(
+            np.array([item.classname for item in data_source], dtype=str),
+            return_inverse=True,
+        )
+        return cls(
+            np.frombuffer(b"".join(impaths), dtype=np.uint8),
+            path_offsets,
+            np.array([item.label for item in data_source], dtype=np.int64),
+            np.array([item.domain for item in data_source], dtype=np.int64),
+            classnames,
+            classname_idxs,
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("ColumnarData index out of range")
+        return Datum(
+            self.impath(idx),
+            int(self.labels[idx]),
+            int(self.domains[idx]),
+            str(self.classnames[self.classname_idxs[idx]]),
+            check_file=False,
+        )
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __add__(self, other):
+        if not isinstance(other, ColumnarData):
+            other = ColumnarData.from_datums(other)
+        classnames, classname_idxs = np.unique(
+            np.concatenate(
+                [
+                    self.classnames[self.classname_idxs],
+                    other.classnames[other.classname_idxs]
+                ]
+            ),
+            return_inverse=True,
+        )
+        return ColumnarData(
+            np.concatenate([self.path_buffer, other.path_buffer]),
+            np.concatenate(
+                [
+                    self.path_offsets[:-1],
+                    other.path_offsets + self.path_offsets[-1]
+                ]
+            ),
+            np.concatenate([self.labels, other.labels]),
+            np.concatenate([self.domains, other.domains]),
+            classnames,
+            classname_idxs,
+        )
+
+    def impath(self, idx):
+        start, end = self.path_offsets[idx], self.path_offsets[idx + 1]
+        return self.path_buffer[start:end].tobytes().decode()
+
+
 class DatasetBase:
     """A unified dataset class for
     1) domain adaptation
@@ -79,6 +188,14 @@ class DatasetBase:
     def test(self):
         return self._test
 
+    def to_columnar(self):
+        """Store the splits as ColumnarData (see DATASET.COLUMNAR)."""
+        for name in ["_train_x", "_train_u", "_val", "_test"]:
+            data_source = getattr(self, name)
+            if data_source is None or isinstance(data_source, ColumnarData):
+                continue
+            setattr(self, name, ColumnarData.from_datums(data_source))
+
     @property
     def lab2cname(self):
         return self._lab2cname
@@ -98,6 +215,8 @@ class DatasetBase:
         Args:
             data_source (list): a list of Datum objects.
         """
+        if isinstance(data_source, ColumnarData):
+            return int(data_source.labels.max()) + 1
         label_set = set()
         for item in data_source:
             label_set.add(item.label)
@@ -110,15 +229,39 @@ class DatasetBase:
         Args:
             data_source (list): a list of Datum objects.
         """
-        container = set()
-        for item in data_source:
-            container.add((item.label, item.classname))
+        if isinstance(data_source, ColumnarData):
+            pairs = np.unique(
+                np.stack([data_source.labels, data_source.classname_idxs]),
+                axis=1
+            )
+            container = {
+                (int(label), str(data_source.classnames[idx]))
+                for label, idx in pairs.T
+            }
+        else:
+            container = set()
+            for item in data_source:
+                container.add((item.label, item.classname))
         mapping = {label: classname for label, classname in container}
         labels = list(mapping.keys())
         labels.sort()
         classnames = [mapping[label] for label in labels]
         return mapping, classnames
 
+    def manifest_paths(self):
+        """Paths whose modification times validate a saved manifest
+        of the dataset (see manifest.py).
+
+        The default is the directory of every image, whose mtime changes
+        when images are added, removed or renamed. Datasets read from
+        split files should add them.
+        """
+        dirnames = set()
+        for data_source in [self.train_x, self.train_u, self.val, self.test]:
+            if data_source:
+                dirnames.update(osp.dirname(item.impath) for item in data_source)
+        return sorted(dirnames)
+
     def check_input_domains(self, source_domains, target_domains):
         assert len(source_domains) > 0, "source_domains (list) is empty"
         assert len(target_domains) > 0, "target_domains (list) is empty"
@@ -1,5 +1,7 @@
 from dassl.utils import Registry, check_availability
 
+from .manifest import build_dataset_from_manifest
+
 DATASET_REGISTRY = Registry("DATASET")
 
 
@@ -8,4 +10,11 @@ def build_dataset(cfg):
     check_availability(cfg.DATASET.NAME, avai_datasets)
     if cfg.VERBOSE:
         print("Loading dataset: {}".format(cfg.DATASET.NAME))
-    return DATASET_REGISTRY.get(cfg.DATASET.NAME)(cfg)
+    dataset_cls = DATASET_REGISTRY.get(cfg.DATASET.NAME)
+    if cfg.DATASET.MANIFEST_DIR:
+        dataset = build_dataset_from_manifest(cfg, dataset_cls)
+    else:
+        dataset = dataset_cls(cfg)
+    if cfg.DATASET.COLUMNAR:
+        dataset.to_columnar()
+    return dataset
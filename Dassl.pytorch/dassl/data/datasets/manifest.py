@@ -0,0 +1,115 @@
+import os
+import hashlib
+import os.path as osp
+import numpy as np
+
+from dassl.utils import mkdir_if_missing
+
+from .base_dataset import ColumnarData, DatasetBase
+
+SPLITS = ["train_x", "train_u", "val", "test"]
+COLUMNS = [
+    "path_buffer", "path_offsets", "labels", "domains", "classnames",
+    "classname_idxs"
+]
+
+
+def manifest_path(cfg):
+    """Path of the manifest of the dataset built from cfg.
+
+    The file name hashes all DATASET options that select the data
+    (domains, number of labels, ...) and SEED.
+    """
+    key = []
+    for k, v in sorted(cfg.DATASET.items()):
+        if k in ["PACKED_DIR", "MANIFEST_DIR"]:
+            continue
+        if isinstance(v, tuple):
+            v = list(v)
+        key.append(f"{k}={v}")
+    key.append(f"SEED={cfg.SEED}")
+    digest = hashlib.md5("|".join(key).encode()).hexdigest()[:16]
+    return osp.join(cfg.DATASET.MANIFEST_DIR, f"{cfg.DATASET.NAME}-{digest}.npz")
+
+
+def save_manifest(fpath, dataset):
+    """Save the splits of a dataset in a single npz file.
+
+    Each split is stored as the arrays of its ColumnarData. The
+    modification times of dataset.manifest_paths() are stored too, to
+    validate the file.
+    """
+    arrays = {}
+    for split in SPLITS:
+        data_source = getattr(dataset, split)
+        if data_source is None:
+            continue
+        if not isinstance(data_source, ColumnarData):
+            data_source = ColumnarData.from_datums(data_source)
+        for name in COLUMNS:
+            arrays[f"{split}_{name}"] = getattr(data_source, name)
+
+    watch = dataset.manifest_paths()
+    arrays["watch"] = np.array(watch, dtype=str)
+    arrays["mtime"] = np.array(
+        [os.stat(path).st_mtime_ns for path in watch], dtype=np.int64
+    )
+
+    mkdir_if_missing(osp.dirname(fpath))
+    fpath_tmp = fpath + ".tmp"
+    with open(fpath_tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(fpath_tmp, fpath)
+    print(f'Saved the dataset manifest to "{fpath}"')
+
+
+def load_manifest(fpath, columnar=False):
+    """Load the splits saved by save_manifest().
+
+    Returns a dict mapping each split to a list of Datum (ColumnarData if
+    columnar is True) or None, or None if the file is missing or any
+    watched path has changed.
+    """
+    if not osp.exists(fpath):
+        return None
+
+    with np.load(fpath) as manifest:
+        arrays = dict(manifest)
+
+    for path, mtime in zip(arrays["watch"], arrays["mtime"]):
+        if not osp.exists(path) or os.stat(path).st_mtime_ns != mtime:
+            print(f'Dataset manifest "{fpath}" is outdated ({path} changed)')
+            return None
+
+    splits = {}
+    for split in SPLITS:
+        if f"{split}_labels" not in arrays:
+            splits[split] = None
+            continue
+        # The files were checked when the manifest was saved
+        data_source = ColumnarData(
+            *[arrays[f"{split}_{name}"] for name in COLUMNS]
+        )
+        splits[split] = data_source if columnar else list(data_source)
+
+    print(f'Loaded the dataset manifest from "{fpath}"')
+    return splits
+
+
+def build_dataset_from_manifest(cfg, dataset_cls):
+    """Build a dataset, going through its manifest in DATASET.MANIFEST_DIR.
+
+    On a hit the dataset object only holds the splits, its __init__ is
+    not run. On a miss (or if the watched paths changed) the dataset is
+    built as usual and its manifest is saved.
+    """
+    fpath = manifest_path(cfg)
+    splits = load_manifest(fpath, columnar=cfg.DATASET.COLUMNAR)
+    if splits is not None:
+        dataset = dataset_cls.__new__(dataset_cls)
+        DatasetBase.__init__(dataset, **splits)
+        return dataset
+
+    dataset = dataset_cls(cfg)
+    save_manifest(fpath, dataset)
+    return dataset
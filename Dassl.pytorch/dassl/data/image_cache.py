@@ -0,0 +1,169 @@
+import multiprocessing as mp
+import numpy as np
+import torch
+import torchvision.transforms as T
+from PIL import Image
+
+from dassl.utils import read_image
+
+from .transforms import INTERPOLATION_MODES
+
+
+class SharedImageCache:
+    """Cache of decoded images shared by all data-loader workers.
+
+    Images are decoded once, resized to INPUT.SIZE and stored as uint8
+    arrays in shared memory, so that every worker of the training loaders
+    (train_x and train_u) reads them from there in later epochs. Since all
+    images have the same size the memory is split into fixed slots; when
+    the byte budget cannot hold the whole dataset, slots are recycled with
+    the CLOCK (second chance) policy.
+
+    Workers fill the cache on first touch. Writes take a lock, reads do
+    not: each slot has a version counter that is odd while the slot is
+    being written, and a read is only trusted if the version did not
+    change while copying.
+
+    Note that the training transforms then start from the resized image,
+    e.g. random_resized_crop crops a resized image instead of the
+    original one. The test transform, whose Resize(max(INPUT.SIZE)) and
+    CenterCrop would get an image already squashed to INPUT.SIZE, needs a
+    test cache (is_train=False) instead: it stores the images resized and
+    center cropped as by the test transform, which is then applied without
+    these two ops, see test_transform().
+
+    Args:
+        impaths (list): paths of all images that can be cached.
+        size (tuple): (height, width) of the cached images.
+        interpolation (str): interpolation used to resize.
+        budget (int): maximum number of bytes of image data.
+        is_train (bool): cache the training or the test geometry.
+    """
+
+    def __init__(self, impaths, size, interpolation, budget, is_train=True):
+        assert len(size) == 2, "INPUT.SIZE must be (height, width)"
+        height, width = size
+        slot_bytes = height * width * 3
+        num_slots = min(len(impaths), budget // slot_bytes)
+
+        self.index = {impath: i for i, impath in enumerate(impaths)}
+        self.num_slots = num_slots
+        interp_mode = INTERPOLATION_MODES[interpolation]
+        if is_train:
+            self.resize = T.Resize(size, interpolation=interp_mode)
+        else:
+            # Same as the first two ops of build_transform(is_train=False)
+            self.resize = T.Compose([
+                T.Resize(max(size), interpolation=interp_mode),
+                T.CenterCrop(size)
+            ])
+
+        self.data = torch.empty(num_slots, height, width, 3, dtype=torch.uint8)
+        self.slot_of = torch.full((len(impaths), ), -1, dtype=torch.int64)
+        self.owner = torch.full((num_slots, ), -1, dtype=torch.int64)
+        self.version = torch.zeros(num_slots, dtype=torch.int64)
+        self.referenced = torch.zeros(num_slots, dtype=torch.uint8)
+        self.hand = torch.zeros(1, dtype=torch.int64)
+        for tensor in [
+            self.data, self.slot_of, self.owner, self.version,
+            self.referenced, self.hand
+        ]:
+            tensor.share_memory_()
+        self.lock = mp.Lock()
+
+        print(
+            f"Image cache: {num_slots:,}/{len(impaths):,} images "
+            f"({num_slots * slot_bytes / 1024**2:,.0f} MB)"
+        )
+
+    @classmethod
+    def from_cfg(cls, cfg, dataset):
+        """Training cache of train_x and train_u."""
+        impaths = []
+        for data_source in [dataset.train_x, dataset.train_u]:
+            if data_source:
+                impaths += [item.impath for item in data_source]
+        impaths = list(dict.fromkeys(impaths))
+        return cls(
+            impaths,
+            cfg.INPUT.SIZE,
+            cfg.INPUT.INTERPOLATION,
+            cfg.DATALOADER.IMAGE_CACHE_MB * 1024**2,
+        )
+
+    @staticmethod
+    def test_transform(tfm_test):
+        """Return the test transform to apply to the images of a test
+        cache, i.e. without the Resize and CenterCrop already applied."""
+        transforms = tfm_test.transforms
+        assert isinstance(transforms[0], T.Resize)
+        assert isinstance(transforms[1], T.CenterCrop)
+        return T.Compose(transforms[2:])
+
+    def read(self, impath, decode=read_image):
+        """Return the resized (and cropped) image as a PIL image.
+
+        decode is used to read the image on a miss.
+        """
+        i = self.index.get(impath)
+        if i is None:
+            return self.resize(decode(impath))
+
+        img = self._lookup(i)
+        if img is not None:
+            return img
+
+        img = self.resize(decode(impath))
+        if self.num_slots > 0:
+            self._insert(i, np.asarray(img))
+        return img
+
+    def _lookup(self, i):
+        slot = int(self.slot_of[i])
+        if slot < 0:
+            return None
+
+        version = int(self.version[slot])
+        if version % 2 == 1 or int(self.owner[slot]) != i:
+            return None
+
+        array = self.data[slot].numpy().copy()
+        if int(self.version[slot]) != version or int(self.owner[slot]) != i:
+            # Evicted while copying
+            return None
+
+        self.referenced[slot] = 1
+        return Image.fromarray(array)
+
+    def _insert(self, i, array):
+        with self.lock:
+            if int(self.slot_of[i]) >= 0:
+                # Filled by another worker in the meantime
+                return
+            slot = self._evict()
+            self.version[slot] += 1  # odd: being written
+            old = int(self.owner[slot])
+            if old >= 0:
+                self.slot_of[old] = -1
+            self.owner[slot] = i
+            self.slot_of[i] = slot
+
+        self.data[slot].numpy()[:] = array
+        self.version[slot] += 1  # even: ready
+
+    def _evict(self):
+        """Pick a slot with the CLOCK policy (to be called with the lock)."""
+        hand = int(self.hand[0])
+        while True:
+            slot = hand % self.num_slots
+            hand += 1
+            if int(self.version[slot]) % 2 == 1:
+                # Being written by another worker
+                continue
+            if self.referenced[slot]:
+                # Second chance
+                self.referenced[slot] = 0
+                continue
+            break
+        self.hand[0] = hand % self.num_slots
+        return slot
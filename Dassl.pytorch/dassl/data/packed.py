@@ -0,0 +1,152 @@
+import io
+import os
+import os.path as osp
+import numpy as np
+import torchvision.transforms as T
+from PIL import Image
+from tqdm import tqdm
+
+from dassl.utils import read_image, mkdir_if_missing
+
+from .transforms import INTERPOLATION_MODES
+
+
+class PackedImages:
+    """Images packed into a few large shard files.
+
+    The directory holds shard-XXXXX.bin files and index.npz, which gives
+    for each image (keyed by its path relative to DATASET.ROOT) the shard,
+    byte offset and length of its record, plus its label and domain. A
+    record is either the original encoded file or, when the dataset was
+    packed with a size, raw uint8 pixels of size (height, width, 3).
+
+    Shards are memory-mapped on first use, so that each data-loader
+    worker maps its own copy and reads images without opening any file.
+    Images that were not packed are read from disk.
+
+    Args:
+        directory (str): directory written by pack_images().
+        root (str): dataset root the image paths are relative to.
+    """
+
+    def __init__(self, directory, root):
+        self.directory = directory
+        self.root = root
+        self._shards = None
+
+    def _load(self):
+        index = np.load(osp.join(self.directory, "index.npz"))
+        self._index = {impath: i for i, impath in enumerate(index["impaths"])}
+        self._shard = index["shard"]
+        self._offset = index["offset"]
+        self._length = index["length"]
+        self._height = index["height"]
+        self._width = index["width"]
+        self._shards = [
+            np.memmap(
+                osp.join(self.directory, f"shard-{i:05d}.bin"),
+                dtype=np.uint8,
+                mode="r"
+            ) for i in range(int(index["num_shards"]))
+        ]
+
+    def read(self, impath):
+        """Return the image as a PIL image."""
+        if self._shards is None:
+            self._load()
+
+        i = self._index.get(osp.relpath(impath, self.root))
+        if i is None:
+            return read_image(impath)
+
+        start = self._offset[i]
+        buf = self._shards[self._shard[i]][start:start + self._length[i]]
+        if self._height[i] > 0:
+            array = buf.reshape(self._height[i], self._width[i], 3)
+            return Image.fromarray(np.array(array))
+        return Image.open(io.BytesIO(buf)).convert("RGB")
+
+
+def pack_images(
+    data_source,
+    root,
+    directory,
+    size=None,
+    interpolation="bilinear",
+    shard_bytes=1024**3
+):
+    """Pack images into shards readable by PackedImages.
+
+    Args:
+        data_source (list): list of Datum, duplicate paths are packed once.
+        root (str): dataset root the image paths are made relative to.
+        directory (str): output directory.
+        size (tuple, optional): (height, width) to resize the images to.
+            Resized images are stored as raw pixels, so reading them needs
+            no decoding. Otherwise the original files are copied as is.
+        interpolation (str, optional): interpolation of the resize, as
+            INPUT.INTERPOLATION, so that the pixels are the same as those
+            of the data loaders.
+        shard_bytes (int, optional): maximum size of a shard file.
+    """
+    mkdir_if_missing(directory)
+    items = list({item.impath: item for item in data_source}.values())
+
+    resize = None
+    if size is not None:
+        # Same resize as DatasetWrapper
+        resize = T.Resize(size, interpolation=INTERPOLATION_MODES[interpolation])
+
+    impaths, shard, offset, length = [], [], [], []
+    height, width, label, domain = [], [], [], []
+    shard_id = 0
+    shard_pos = 0
+    f = open(osp.join(directory, f"shard-{shard_id:05d}.bin"), "wb")
+
+    for item in tqdm(items):
+        if size is not None:
+            img = resize(read_image(item.impath))
+            buf = np.asarray(img).tobytes()
+            h, w = size
+        else:
+            with open(item.impath, "rb") as img_file:
+                buf = img_file.read()
+            h, w = 0, 0
+
+        if shard_pos > 0 and shard_pos + len(buf) > shard_bytes:
+            f.close()
+            shard_id += 1
+            shard_pos = 0
+            f = open(osp.join(directory, f"shard-{shard_id:05d}.bin"), "wb")
+
+        f.write(buf)
+        impaths.append(osp.relpath(item.impath, root))
+        shard.append(shard_id)
+        offset.append(shard_pos)
+        length.append(len(buf))
+        height.append(h)
+        width.append(w)
+        label.append(item.label)
+        domain.append(item.domain)
+        shard_pos += len(buf)
+
+    f.close()
+
+    index_tmp = osp.join(directory, "index.npz.tmp")
+    with open(index_tmp, "wb") as index_file:
+        np.savez(
+            index_file,
+            impaths=np.array(impaths),
+            shard=np.array(shard, dtype=np.int32),
+            offset=np.array(offset, dtype=np.int64),
+            length=np.array(length, dtype=np.int64),
+            height=np.array(height, dtype=np.int32),
+            width=np.array(width, dtype=np.int32),
+            label=np.array(label, dtype=np.int64),
+            domain=np.array(domain, dtype=np.int64),
+            num_shards=shard_id + 1,
+        )
+    # The index is written last so that a complete index means complete shards
+    os.replace(index_tmp, osp.join(directory, "index.npz"))
+
+    print(f"Packed {len(items):,} images into {shard_id + 1} shard(s)")
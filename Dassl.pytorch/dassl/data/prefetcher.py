@@ -0,0 +1,84 @@
+import torch
+
+
+def to_device(data, device, non_blocking=False):
+    """Move the tensors of a (nested) batch to device."""
+    if torch.is_tensor(data):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(v, device, non_blocking) for v in data)
+    return data
+
+
+def _pin_memory(data):
+    if torch.is_tensor(data):
+        return data if data.is_pinned() else data.pin_memory()
+    if isinstance(data, dict):
+        return {k: _pin_memory(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(_pin_memory(v) for v in data)
+    return data
+
+
+def _record_stream(data, stream):
+    if torch.is_tensor(data):
+        data.record_stream(stream)
+    elif isinstance(data, dict):
+        for v in data.values():
+            _record_stream(v, stream)
+    elif isinstance(data, (list, tuple)):
+        for v in data:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    """Copy batches to the device one step ahead.
+
+    While the batch of step t is being used, the host-to-device copies of
+    batch t+1 run on a side CUDA stream from pinned memory. Batches can be
+    any nesting of dicts, lists and tuples of tensors, e.g. (batch_x,
+    batch_u) pairs. On cpu batches are passed through.
+
+    Args:
+        iterable: iterable of batches.
+        device (torch.device): target device.
+    """
+
+    _END = object()
+
+    def __init__(self, iterable, device):
+        self.iterable = iterable
+        self.device = device
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.iterable:
+                yield to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.iterable)
+        next_batch = self._preload(batches, stream)
+
+        while next_batch is not self._END:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # The memory was allocated on the side stream
+            _record_stream(batch, current_stream)
+            next_batch = self._preload(batches, stream)
+            yield batch
+
+    def _preload(self, batches, stream):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return self._END
+
+        with torch.cuda.stream(stream):
+            return to_device(_pin_memory(batch), self.device, non_blocking=True)
@@ -1,14 +1,36 @@
-import copy
 import numpy as np
-import random
-from collections import defaultdict
+import torch
 from torch.utils.data.sampler import Sampler, RandomSampler, SequentialSampler
 
+from .datasets import ColumnarData
+
+
+def column(data_source, name):
+    """Return the values of a Datum attribute, e.g. "domain", over a
+    data source."""
+    if isinstance(data_source, ColumnarData):
+        return getattr(data_source, name + "s")
+    return [getattr(item, name) for item in data_source]
+
+
+def group_indices(keys):
+    """Return a dict mapping each key to the array of its indices, in
+    order of first appearance."""
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind="stable")
+    uniq, starts = np.unique(keys[order], return_index=True)
+    groups = dict(zip(uniq.tolist(), np.split(order, starts[1:])))
+    return {key: groups[key] for key in dict.fromkeys(keys.tolist())}
+
 
 class RandomDomainSampler(Sampler):
     """Randomly samples N domains each with K images
     to form a minibatch of size N*K.
 
+    Sampling stops once a sampled domain has less than K images left.
+    Which domain runs out first depends on the random draws, so unless
+    all domains are sampled in each minibatch len() is an estimate.
+
     Args:
         data_source (list): list of Datums.
         batch_size (int): batch size.
@@ -17,11 +39,11 @@ class RandomDomainSampler(Sampler):
 
     def __init__(self, data_source, batch_size, n_domain):
         self.data_source = data_source
+        # Random generator, see ResumableSampler
+        self.rng = np.random
 
         # Keep track of image indices for each domain
-        self.domain_dict = defaultdict(list)
-        for i, item in enumerate(data_source):
-            self.domain_dict[item.domain].append(i)
+        self.domain_dict = group_indices(column(data_source, "domain"))
         self.domains = list(self.domain_dict.keys())
 
         # Make sure each domain has equal number of images
@@ -33,29 +55,40 @@ class RandomDomainSampler(Sampler):
         self.batch_size = batch_size
         # n_domain denotes number of domains sampled in a minibatch
         self.n_domain = n_domain
-        self.length = len(list(self.__iter__()))
+
+        # Each domain is sampled in n_domain/len(domains) of the minibatches
+        min_rounds = min(
+            len(idxs) // self.n_img_per_domain
+            for idxs in self.domain_dict.values()
+        )
+        n_round = min_rounds * len(self.domains) // n_domain
+        self.length = n_round * batch_size
 
     def __iter__(self):
-        domain_dict = copy.deepcopy(self.domain_dict)
+        k = self.n_img_per_domain
+        perms = [
+            self.rng.permutation(self.domain_dict[domain])
+            for domain in self.domains
+        ]
+        cursors = [0] * len(self.domains)
         final_idxs = []
         stop_sampling = False
 
         while not stop_sampling:
-            selected_domains = random.sample(self.domains, self.n_domain)
-
-            for domain in selected_domains:
-                idxs = domain_dict[domain]
-                selected_idxs = random.sample(idxs, self.n_img_per_domain)
-                final_idxs.extend(selected_idxs)
+            selected = self.rng.choice(
+                len(self.domains), self.n_domain, replace=False
+            )
 
-                for idx in selected_idxs:
-                    domain_dict[domain].remove(idx)
+            for d in selected:
+                start = cursors[d]
+                final_idxs.append(perms[d][start:start + k])
+                cursors[d] = start + k
 
-                remaining = len(domain_dict[domain])
-                if remaining < self.n_img_per_domain:
+                remaining = len(perms[d]) - cursors[d]
+                if remaining < k:
                     stop_sampling = True
 
-        return iter(final_idxs)
+        return iter(np.concatenate(final_idxs).tolist())
 
     def __len__(self):
         return self.length
@@ -72,11 +105,11 @@ class SeqDomainSampler(Sampler):
 
     def __init__(self, data_source, batch_size):
         self.data_source = data_source
+        # Random generator, see ResumableSampler
+        self.rng = np.random
 
         # Keep track of image indices for each domain
-        self.domain_dict = defaultdict(list)
-        for i, item in enumerate(data_source):
-            self.domain_dict[item.domain].append(i)
+        self.domain_dict = group_indices(column(data_source, "domain"))
         self.domains = list(self.domain_dict.keys())
         self.domains.sort()
 
@@ -88,27 +121,25 @@ class SeqDomainSampler(Sampler):
         self.batch_size = batch_size
         # n_domain denotes number of domains sampled in a minibatch
         self.n_domain = n_domain
-        self.length = len(list(self.__iter__()))
+        # Minibatches are formed until the smallest domain runs out
+        self.n_round = min(
+            len(idxs) // self.n_img_per_domain
+            for idxs in self.domain_dict.values()
+        )
+        self.length = self.n_round * batch_size
 
     def __iter__(self):
-        domain_dict = copy.deepcopy(self.domain_dict)
-        final_idxs = []
-        stop_sampling = False
-
-        while not stop_sampling:
-            for domain in self.domains:
-                idxs = domain_dict[domain]
-                selected_idxs = random.sample(idxs, self.n_img_per_domain)
-                final_idxs.extend(selected_idxs)
-
-                for idx in selected_idxs:
-                    domain_dict[domain].remove(idx)
-
-                remaining = len(domain_dict[domain])
-                if remaining < self.n_img_per_domain:
-                    stop_sampling = True
-
-        return iter(final_idxs)
+        n = self.n_round * self.n_img_per_domain
+        # (n_round, n_domain, n_img_per_domain)
+        final_idxs = np.stack(
+            [
+                self.rng.permutation(self.domain_dict[domain])[:n].reshape(
+                    self.n_round, self.n_img_per_domain
+                ) for domain in self.domains
+            ],
+            1,
+        )
+        return iter(final_idxs.flatten().tolist())
 
     def __len__(self):
         return self.length
@@ -120,6 +151,11 @@ class RandomClassSampler(Sampler):
 
     Modified from https://github.com/KaiyangZhou/deep-person-reid.
 
+    Classes whose instances are used up leave the pool, and sampling
+    stops when less than N classes are left. Which classes are left
+    depends on the random draws, so len() is an estimate: the largest
+    number of minibatches the per-class counts allow.
+
     Args:
         data_source (list): list of Datums.
         batch_size (int): batch size.
@@ -136,48 +172,170 @@ class RandomClassSampler(Sampler):
         self.data_source = data_source
         self.batch_size = batch_size
         self.n_ins = n_ins
+        # Random generator, see ResumableSampler
+        self.rng = np.random
         self.ncls_per_batch = self.batch_size // self.n_ins
-        self.index_dic = defaultdict(list)
-        for index, item in enumerate(data_source):
-            self.index_dic[item.label].append(index)
+        self.index_dic = group_indices(column(data_source, "label"))
         self.labels = list(self.index_dic.keys())
         assert len(self.labels) >= self.ncls_per_batch
 
-        # estimate number of images in an epoch
-        self.length = len(list(self.__iter__()))
+        # Largest r such that sum_c min(n_chunks_c, r) >= ncls_per_batch * r
+        n_chunks = np.array(
+            [
+                max(len(idxs), self.n_ins) // self.n_ins
+                for idxs in self.index_dic.values()
+            ]
+        )
+        lo, hi = 0, n_chunks.sum() // self.ncls_per_batch
+        while lo < hi:
+            r = (lo+hi+1) // 2
+            if np.minimum(n_chunks, r).sum() >= self.ncls_per_batch * r:
+                lo = r
+            else:
+                hi = r - 1
+        n_round = lo
+        self.length = n_round * self.ncls_per_batch * self.n_ins
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
+        # (n_chunks, n_ins) array of shuffled indices for each class
+        batch_idxs_dict = {}
         for label in self.labels:
-            idxs = copy.deepcopy(self.index_dic[label])
+            idxs = self.index_dic[label]
             if len(idxs) < self.n_ins:
-                idxs = np.random.choice(idxs, size=self.n_ins, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.n_ins:
-                    batch_idxs_dict[label].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_labels = copy.deepcopy(self.labels)
+                idxs = self.rng.choice(idxs, size=self.n_ins, replace=True)
+            else:
+                idxs = self.rng.permutation(idxs)
+            n_chunks = len(idxs) // self.n_ins
+            batch_idxs_dict[label] = idxs[:n_chunks * self.n_ins].reshape(
+                n_chunks, self.n_ins
+            )
+
+        avai_labels = list(self.labels)
+        cursors = dict.fromkeys(self.labels, 0)
         final_idxs = []
 
         while len(avai_labels) >= self.ncls_per_batch:
-            selected_labels = random.sample(avai_labels, self.ncls_per_batch)
+            selected = self.rng.choice(
+                len(avai_labels), self.ncls_per_batch, replace=False
+            )
+            selected_labels = [avai_labels[i] for i in selected]
             for label in selected_labels:
-                batch_idxs = batch_idxs_dict[label].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[label]) == 0:
+                final_idxs.append(batch_idxs_dict[label][cursors[label]])
+                cursors[label] += 1
+                if cursors[label] == len(batch_idxs_dict[label]):
                     avai_labels.remove(label)
 
-        return iter(final_idxs)
+        return iter(np.concatenate(final_idxs).tolist())
 
     def __len__(self):
         return self.length
 
 
+class ResumableSampler(Sampler):
+    """Make the order of a sampler reproducible, so that iteration can
+    be stopped and restarted at the same sample.
+
+    Pass i (the i-th iteration) runs the wrapped sampler with a private
+    random generator seeded from (seed, i), so the global generators are
+    neither used nor reseeded. A pass is thus given by its index alone,
+    and the state is the seed, the index of the next pass and the number
+    of its samples to skip.
+
+    Args:
+        sampler (Sampler): RandomSampler, or a sampler drawing from a
+            numpy RandomState in its rng attribute, as the samplers of
+            this module.
+        seed (int, optional): base seed, drawn from numpy if not given.
+    """
+
+    def __init__(self, sampler, seed=None):
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.sampler = sampler
+        self.seed = seed
+        self.pass_idx = 0
+        self.skip = 0
+
+    def __iter__(self):
+        idxs = self._draw(self.pass_idx)
+        skip = self.skip
+        self.pass_idx += 1
+        self.skip = 0
+        return iter(idxs[skip:])
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def _draw(self, pass_idx):
+        seed = np.random.SeedSequence([self.seed, pass_idx]).generate_state(1)
+        seed = int(seed[0])
+        if isinstance(self.sampler, RandomSampler):
+            self.sampler.generator = torch.Generator().manual_seed(seed)
+        else:
+            self.sampler.rng = np.random.RandomState(seed)
+        return list(self.sampler)
+
+    def state_dict(self):
+        """Where the next iteration starts."""
+        return {"seed": self.seed, "pass_idx": self.pass_idx, "skip": self.skip}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.pass_idx = state_dict["pass_idx"]
+        self.skip = state_dict["skip"]
+
+
+class InfiniteSampler(Sampler):
+    """Repeat a sampler endlessly.
+
+    Each pass draws a new order from the wrapped sampler, e.g. a new
+    domain-balanced shuffle for SeqDomainSampler, so that a data loader
+    built on it is iterated once and never restarts its workers. len()
+    is the length of one pass.
+
+    If the wrapped sampler is a ResumableSampler, state_at() gives the
+    state to restart the stream at any of its samples.
+
+    Args:
+        sampler (Sampler): sampler to repeat.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        # (stream position, state of the sampler) at the start of each pass
+        self._passes = []
+
+    def __iter__(self):
+        self._passes = []
+        offset = 0
+        while True:
+            if isinstance(self.sampler, ResumableSampler):
+                self._passes.append((offset, self.sampler.state_dict()))
+            for idx in self.sampler:
+                offset += 1
+                yield idx
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def state_at(self, num_samples):
+        """State to restart after the first num_samples samples of the
+        current iteration."""
+        i = 0
+        while i + 1 < len(self._passes) and self._passes[i + 1][0] <= num_samples:
+            i += 1
+        # Positions are only asked in increasing order
+        del self._passes[:i]
+        offset, state = self._passes[0]
+        return dict(state, skip=state["skip"] + num_samples - offset)
+
+    def state_dict(self):
+        return self.sampler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.sampler.load_state_dict(state_dict)
+
+
 def build_sampler(
     sampler_type,
     cfg=None,
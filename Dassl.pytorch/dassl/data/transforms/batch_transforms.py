@@ -0,0 +1,333 @@
+"""
+Batched versions of the training augmentations.
+
+They take a float tensor of size (B, C, H, W) with pixel values in
+[0, 255], collated from uint8 images, and draw random parameters per
+image. Each op rounds its output like the PIL version does on uint8
+images, so that chains of ops behave alike.
+"""
+import math
+import torch
+import torch.nn.functional as F
+from torchvision.transforms import Compose
+
+
+def _uniform(n, low, high, device):
+    return torch.rand(n, device=device) * (high-low) + low
+
+
+def _random_sign(v):
+    return torch.where(torch.rand_like(v) > 0.5, -v, v)
+
+
+def _blend(degenerate, imgs, factor):
+    # Same as PIL.Image.blend(), used by PIL.ImageEnhance
+    out = degenerate + factor.view(-1, 1, 1, 1) * (imgs-degenerate)
+    return out.clamp(0, 255).floor()
+
+
+def _grayscale(imgs):
+    # ITU-R 601-2 luma transform with PIL's fixed-point rounding
+    r, g, b = imgs.unbind(1)
+    gray = (r*19595 + g*38470 + b*7471 + 32768) / 65536
+    return gray.floor().unsqueeze(1)
+
+
+def _affine(imgs, matrix):
+    """Resample with PIL's affine convention (nearest, black fill).
+
+    matrix (N, 2, 3) maps output pixel centers to input coordinates.
+    """
+    n, c, h, w = imgs.shape
+    ys, xs = torch.meshgrid(
+        torch.arange(h, device=imgs.device, dtype=torch.float64) + 0.5,
+        torch.arange(w, device=imgs.device, dtype=torch.float64) + 0.5,
+        indexing="ij",
+    )
+    coords = torch.stack([xs, ys, torch.ones_like(xs)], -1)  # (H, W, 3)
+    src = torch.einsum("hwk,njk->nhwj", coords, matrix.double()).floor().long()
+    src_x, src_y = src[..., 0], src[..., 1]
+    valid = (src_x >= 0) & (src_x < w) & (src_y >= 0) & (src_y < h)
+    idxs = src_y.clamp(0, h - 1) * w + src_x.clamp(0, w - 1)
+    out = imgs.flatten(2).gather(2, idxs.view(n, 1, h * w).expand(-1, c, -1))
+    return out.view(n, c, h, w) * valid.unsqueeze(1)
+
+
+def _shift_matrix(v, tx, ty, sx, sy):
+    n = v.size(0)
+    matrix = torch.zeros(n, 2, 3, device=v.device)
+    matrix[:, 0, 0] = 1
+    matrix[:, 1, 1] = 1
+    matrix[:, 0, 2] = tx
+    matrix[:, 1, 2] = ty
+    matrix[:, 0, 1] = sx
+    matrix[:, 1, 0] = sy
+    return matrix
+
+
+def shear_x(imgs, v):
+    v = _random_sign(v)
+    zero = torch.zeros_like(v)
+    return _affine(imgs, _shift_matrix(v, zero, zero, v, zero))
+
+
+def shear_y(imgs, v):
+    v = _random_sign(v)
+    zero = torch.zeros_like(v)
+    return _affine(imgs, _shift_matrix(v, zero, zero, zero, v))
+
+
+def translate_x(imgs, v):
+    v = _random_sign(v) * imgs.size(3)
+    zero = torch.zeros_like(v)
+    return _affine(imgs, _shift_matrix(v, v, zero, zero, zero))
+
+
+def translate_y(imgs, v):
+    v = _random_sign(v) * imgs.size(2)
+    zero = torch.zeros_like(v)
+    return _affine(imgs, _shift_matrix(v, zero, v, zero, zero))
+
+
+def rotate(imgs, v):
+    # Counter-clockwise around the center, as PIL.Image.rotate()
+    v = _random_sign(v)
+    h, w = imgs.shape[2:]
+    angle = -v * math.pi / 180
+    cos, sin = angle.cos(), angle.sin()
+    cx, cy = w / 2, h / 2
+    matrix = torch.stack(
+        [
+            torch.stack([cos, sin, cx - cos*cx - sin*cy], 1),
+            torch.stack([-sin, cos, cy + sin*cx - cos*cy], 1),
+        ],
+        1,
+    )
+    return _affine(imgs, matrix)
+
+
+def auto_contrast(imgs, _):
+    lo = imgs.amin(dim=(2, 3), keepdim=True)
+    hi = imgs.amax(dim=(2, 3), keepdim=True)
+    scale = 255 / (hi-lo).clamp(min=1)
+    out = (imgs * scale - lo*scale).floor().clamp(0, 255)
+    return torch.where(hi > lo, out, imgs)
+
+
+def equalize(imgs, _):
+    n, c, h, w = imgs.shape
+    x = imgs.long().view(n * c, h * w)
+    hist = torch.zeros(n * c, 256, device=imgs.device, dtype=torch.long)
+    hist.scatter_add_(1, x, torch.ones_like(x))
+
+    # Count of the last non-empty bin
+    last = 255 - (hist.flip(1) > 0).long().argmax(1)
+    step = (h*w - hist.gather(1, last[:, None])) // 255
+    cum = hist.cumsum(1) - hist  # pixels strictly below each value
+    lut = ((step // 2 + cum) // step.clamp(min=1)).clamp(max=255)
+    identity = torch.arange(256, device=imgs.device).expand_as(lut)
+    lut = torch.where(step > 0, lut, identity)
+    return lut.gather(1, x).view(n, c, h, w).to(imgs.dtype)
+
+
+def identity(imgs, _):
+    return imgs
+
+
+def posterize(imgs, v):
+    bits = v.long()
+    mask = (0xFF << (8-bits)) & 0xFF
+    return (imgs.long() & mask.view(-1, 1, 1, 1)).to(imgs.dtype)
+
+
+def solarize(imgs, v):
+    v = v.view(-1, 1, 1, 1)
+    return torch.where(imgs < v, imgs, 255 - imgs)
+
+
+def contrast(imgs, v):
+    mean = _grayscale(imgs).mean(dim=(1, 2, 3), keepdim=True)
+    degenerate = (mean + 0.5).floor().expand_as(imgs)
+    return _blend(degenerate, imgs, v)
+
+
+def color(imgs, v):
+    return _blend(_grayscale(imgs).expand_as(imgs), imgs, v)
+
+
+def brightness(imgs, v):
+    return _blend(torch.zeros_like(imgs), imgs, v)
+
+
+def sharpness(imgs, v):
+    # PIL's SMOOTH filter, borders are left untouched
+    c = imgs.size(1)
+    kernel = torch.ones(3, 3, device=imgs.device, dtype=imgs.dtype)
+    kernel[1, 1] = 5
+    kernel = (kernel / 13).expand(c, 1, 3, 3)
+    smooth = F.conv2d(imgs, kernel, groups=c).round()
+    degenerate = imgs.clone()
+    degenerate[:, :, 1:-1, 1:-1] = smooth
+    return _blend(degenerate, imgs, v)
+
+
+def fixmatch_list():
+    # Same ops and ranges as randaugment.fixmatch_list()
+    return [
+        (auto_contrast, 0, 1),
+        (brightness, 0.05, 0.95),
+        (color, 0.05, 0.95),
+        (contrast, 0.05, 0.95),
+        (equalize, 0, 1),
+        (identity, 0, 1),
+        (posterize, 4, 8),
+        (rotate, -30, 30),
+        (sharpness, 0.05, 0.95),
+        (shear_x, -0.3, 0.3),
+        (shear_y, -0.3, 0.3),
+        (solarize, 0, 256),
+        (translate_x, -0.3, 0.3),
+        (translate_y, -0.3, 0.3),
+    ]
+
+
+class BatchRandAugmentFixMatch:
+    """Batched RandAugmentFixMatch: each image draws its own n ops and
+    magnitudes."""
+
+    def __init__(self, n=2):
+        self.n = n
+        self.augment_list = fixmatch_list()
+
+    def __call__(self, imgs):
+        b = imgs.size(0)
+        for _ in range(self.n):
+            op_idxs = torch.randint(
+                len(self.augment_list), (b, ), device=imgs.device
+            )
+            m = torch.rand(b, device=imgs.device)
+            imgs = imgs.clone()
+            for i, (op, minval, maxval) in enumerate(self.augment_list):
+                idxs = (op_idxs == i).nonzero().flatten()
+                if len(idxs) == 0:
+                    continue
+                val = m[idxs] * (maxval-minval) + minval
+                imgs[idxs] = op(imgs[idxs], val)
+        return imgs
+
+
+class BatchRandom2DTranslation:
+    """Batched Random2DTranslation, on images already of size
+    (height, width)."""
+
+    def __init__(self, height, width, p=0.5):
+        self.height = height
+        self.width = width
+        self.p = p
+
+    def __call__(self, imgs):
+        b, c = imgs.shape[:2]
+        device = imgs.device
+        new_width = int(round(self.width * 1.125))
+        new_height = int(round(self.height * 1.125))
+        resized = F.interpolate(
+            imgs,
+            size=(new_height, new_width),
+            mode="bilinear",
+            align_corners=False
+        ).round().clamp(0, 255)
+
+        x1 = _uniform(b, 0, new_width - self.width, device).round().long()
+        y1 = _uniform(b, 0, new_height - self.height, device).round().long()
+        rows = y1[:, None] + torch.arange(self.height, device=device)
+        cols = x1[:, None] + torch.arange(self.width, device=device)
+        cropped = resized[
+            torch.arange(b, device=device)[:, None, None, None],
+            torch.arange(c, device=device)[None, :, None, None],
+            rows[:, None, :, None],
+            cols[:, None, None, :],
+        ]
+
+        apply = torch.rand(b, device=device) <= self.p
+        return torch.where(apply.view(-1, 1, 1, 1), cropped, imgs)
+
+
+class BatchRandomHorizontalFlip:
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        flip = torch.rand(imgs.size(0), device=imgs.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), imgs.flip(3), imgs)
+
+
+class BatchToTensor:
+    """Map pixel values from [0, 255] to [0, 1]."""
+
+    def __call__(self, imgs):
+        return imgs / 255
+
+
+class BatchCutout:
+    """Batched Cutout, on images of size (B, C, H, W)."""
+
+    def __init__(self, n_holes=1, length=16):
+        self.n_holes = n_holes
+        self.length = length
+
+    def __call__(self, imgs):
+        b, _, h, w = imgs.shape
+        device = imgs.device
+        ys = torch.arange(h, device=device)
+        xs = torch.arange(w, device=device)
+        mask = torch.ones(b, h, w, dtype=torch.bool, device=device)
+
+        for _ in range(self.n_holes):
+            y = torch.randint(h, (b, 1), device=device)
+            x = torch.randint(w, (b, 1), device=device)
+            in_y = (ys >= y - self.length//2) & (ys < y + self.length//2)
+            in_x = (xs >= x - self.length//2) & (xs < x + self.length//2)
+            mask &= ~(in_y[:, :, None] & in_x[:, None, :])
+
+        return imgs * mask.unsqueeze(1)
+
+
+class BatchNormalize:
+
+    def __init__(self, mean, std):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, imgs):
+        mean = self.mean.to(imgs.device)
+        std = self.std.to(imgs.device)
+        return (imgs-mean) / std
+
+
+class BatchTransform:
+    """Transform split into a per-image part, run by the data-loader
+    workers, and a batched part, run on collated batches.
+
+    Args:
+        sample_transforms (list): transforms mapping a PIL image to a
+            uint8 tensor of size (C, H, W).
+        batch_transforms (list): batched transforms.
+    """
+
+    def __init__(self, sample_transforms, batch_transforms):
+        self.sample_transform = Compose(sample_transforms)
+        self.batch_transforms = batch_transforms
+
+    def __call__(self, img):
+        return self.sample_transform(img)
+
+    def apply_batch(self, imgs):
+        """
+        Args:
+            imgs (torch.Tensor): uint8 tensor of size (B, C, H, W).
+        """
+        imgs = imgs.float()
+        for tfm in self.batch_transforms:
+            imgs = tfm(imgs)
+        return imgs
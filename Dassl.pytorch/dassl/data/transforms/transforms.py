@@ -4,13 +4,18 @@ import torch
 import torchvision.transforms.functional as F
 from torchvision.transforms import (
     Resize, Compose, ToTensor, Normalize, CenterCrop, RandomCrop, ColorJitter,
-    RandomApply, GaussianBlur, RandomGrayscale, RandomResizedCrop,
+    RandomApply, GaussianBlur, PILToTensor, RandomGrayscale, RandomResizedCrop,
     RandomHorizontalFlip
 )
 from torchvision.transforms.functional import InterpolationMode
 
 from .autoaugment import SVHNPolicy, CIFAR10Policy, ImageNetPolicy
 from .randaugment import RandAugment, RandAugment2, RandAugmentFixMatch
+from .batch_transforms import (
+    BatchCutout, BatchNormalize, BatchToTensor, BatchTransform,
+    BatchRandAugmentFixMatch, BatchRandom2DTranslation,
+    BatchRandomHorizontalFlip
+)
 
 AVAI_CHOICES = [
     "random_flip",
@@ -33,6 +38,15 @@ AVAI_CHOICES = [
     "gaussian_blur",
 ]
 
+# Choices supported by INPUT.BATCH_TRANSFORM
+BATCH_CHOICES = [
+    "random_flip",
+    "random_translation",
+    "randaugment_fixmatch",
+    "cutout",
+    "normalize",
+]
+
 INTERPOLATION_MODES = {
     "bilinear": InterpolationMode.BILINEAR,
     "bicubic": InterpolationMode.BICUBIC,
@@ -197,6 +211,8 @@ def build_transform(cfg, is_train=True, choices=None):
 
     normalize = Normalize(mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD)
 
+    if is_train and cfg.INPUT.BATCH_TRANSFORM:
+        return _build_transform_train_batch(cfg, choices, target_size)
     if is_train:
         return _build_transform_train(cfg, choices, target_size, normalize)
     else:
@@ -323,6 +339,57 @@ def _build_transform_train(cfg, choices, target_size, normalize):
     return tfm_train
 
 
+def _build_transform_train_batch(cfg, choices, target_size):
+    """Same pipeline as _build_transform_train() where the workers only
+    resize the images, and the augmentations run on collated batches
+    (see DatasetWrapper.apply_batch_transform())."""
+    print("Building transform_train (batched)")
+    for choice in choices:
+        if choice not in BATCH_CHOICES:
+            raise ValueError(
+                f"{choice} is not supported by INPUT.BATCH_TRANSFORM, "
+                f"choose from {BATCH_CHOICES}"
+            )
+
+    interp_mode = INTERPOLATION_MODES[cfg.INPUT.INTERPOLATION]
+    input_size = cfg.INPUT.SIZE
+
+    print(f"+ resize to {target_size}")
+    print("+ to uint8 torch tensor")
+    sample_tfm = [Resize(input_size, interpolation=interp_mode), PILToTensor()]
+    batch_tfm = []
+
+    if "random_translation" in choices:
+        print("+ random translation")
+        batch_tfm += [BatchRandom2DTranslation(input_size[0], input_size[1])]
+
+    if "random_flip" in choices:
+        print("+ random flip")
+        batch_tfm += [BatchRandomHorizontalFlip()]
+
+    if "randaugment_fixmatch" in choices:
+        n_ = cfg.INPUT.RANDAUGMENT_N
+        print(f"+ randaugment_fixmatch (n={n_})")
+        batch_tfm += [BatchRandAugmentFixMatch(n_)]
+
+    print("+ to range [0, 1]")
+    batch_tfm += [BatchToTensor()]
+
+    if "cutout" in choices:
+        cutout_n = cfg.INPUT.CUTOUT_N
+        cutout_len = cfg.INPUT.CUTOUT_LEN
+        print(f"+ cutout (n_holes={cutout_n}, length={cutout_len})")
+        batch_tfm += [BatchCutout(cutout_n, cutout_len)]
+
+    if "normalize" in choices:
+        print(
+            f"+ normalization (mean={cfg.INPUT.PIXEL_MEAN}, std={cfg.INPUT.PIXEL_STD})"
+        )
+        batch_tfm += [BatchNormalize(cfg.INPUT.PIXEL_MEAN, cfg.INPUT.PIXEL_STD)]
+
+    return BatchTransform(sample_tfm, batch_tfm)
+
+
 def _build_transform_test(cfg, choices, target_size, normalize):
     print("Building transform_test")
     tfm_test = []
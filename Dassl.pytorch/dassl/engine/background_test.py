@@ -0,0 +1,198 @@
+import copy
+import queue
+import contextlib
+import threading
+import torch
+import torch.nn as nn
+
+from dassl.evaluation import EvaluatorBase
+
+
+def _unwrap(module):
+    """Strip torch.compile and DataParallel wrappers."""
+    while True:
+        if hasattr(module, "_orig_mod"):
+            module = module._orig_mod
+        elif isinstance(module, nn.DataParallel):
+            module = module.module
+        else:
+            return module
+
+
+def _same_weights(a, b):
+    # E.g. a scripted module shares the parameters of the original one
+    ptrs_a = [p.data_ptr() for p in a.parameters()]
+    ptrs_b = [p.data_ptr() for p in b.parameters()]
+    return len(ptrs_a) > 0 and ptrs_a == ptrs_b
+
+
+def _to_cpu(state):
+    """Copy a (nested) state_dict with its tensors moved to the cpu."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return copy.deepcopy(state)
+
+
+def snapshot(trainer):
+    """Return a CPU copy of the state of the registered models: for each
+    name, the "state_dict" of the model and those of its "optimizer" and
+    "scheduler" (None if not registered)."""
+    return {
+        name: {
+            "state_dict": _to_cpu(model.state_dict()),
+            "optimizer": _to_cpu(
+                trainer._optims[name] and trainer._optims[name].state_dict()
+            ),
+            "scheduler": _to_cpu(
+                trainer._scheds[name] and trainer._scheds[name].state_dict()
+            ),
+        }
+        for name, model in trainer._models.items()
+    }
+
+
+class BackgroundTester:
+    """Run trainer.test() on snapshots of the models in a background
+    thread while training continues (TEST.BACKGROUND).
+
+    The registered models are copied once into eval-only replicas. Each
+    submitted test carries a CPU snapshot of their state_dicts, which the
+    worker loads into the replicas before calling test() on a shallow copy
+    of the trainer whose model attributes point to the replicas. On cuda
+    the worker runs on its own stream, with the lowest priority. CUDA also
+    gives it to the default stream, so the test kernels do not yield to
+    those of training, they only overlap with them.
+
+    The worker draws from its own random generators, so that tests do not
+    change the random draws of training: one for the base seed of the
+    test data loaders, and test_generator for the random draws of
+    model_inference() on the device, e.g. of an ensemble.
+
+    Results are handed back by collect(), which is called from the
+    training thread: the scalars are written and the callbacks are called
+    there, in submission order.
+
+    Args:
+        trainer (SimpleTrainer): trainer to test.
+        device (torch.device): device of the replicas.
+    """
+
+    def __init__(self, trainer, device):
+        self.trainer = trainer
+        self.device = device
+        self.loader_generator = torch.Generator()
+        self.test_generator = torch.Generator(device)
+
+        models = trainer._models
+        self.replicas = {
+            name: copy.deepcopy(_unwrap(model)).to(device).eval()
+            for name, model in models.items()
+        }
+        for replica in self.replicas.values():
+            replica.requires_grad_(False)
+
+        # Trainer attributes holding a registered model, possibly wrapped
+        self.attrs = {}
+        for attr, value in vars(trainer).items():
+            if not isinstance(value, nn.Module):
+                continue
+            for name, model in models.items():
+                if _unwrap(value) is model or _same_weights(value, model):
+                    self.attrs[attr] = name
+
+        self.num_pending = 0
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, split=None, callback=None, subset=False):
+        """Test the current weights in the background.
+
+        callback(epoch, result, state_dicts) is called by collect() once
+        the result is in, state_dicts being the snapshot() of the tested
+        weights.
+        """
+        state_dicts = snapshot(self.trainer)
+        self.num_pending += 1
+        self._jobs.put(
+            (self.trainer.epoch, split, subset, state_dicts, callback)
+        )
+
+    def collect(self, wait=False):
+        """Post the finished results, or all of them if wait=True."""
+        while self.num_pending > 0:
+            try:
+                item = self._results.get(block=wait)
+            except queue.Empty:
+                return
+            self.num_pending -= 1
+
+            error, epoch, result, scalars, state_dicts, callback = item
+            if error is not None:
+                raise RuntimeError("Background test failed") from error
+
+            for tag, value, step in scalars:
+                self.trainer.write_scalar(tag, value, step)
+            if callback is not None:
+                callback(epoch, result, state_dicts)
+
+    def _run(self):
+        stream = None
+        if self.device.type == "cuda":
+            # A larger number is a lower priority
+            priority = max(torch.cuda.Stream.priority_range())
+            stream = torch.cuda.Stream(self.device, priority=priority)
+
+        while True:
+            epoch, split, subset, state_dicts, callback = self._jobs.get()
+            scalars = []
+            try:
+                with (
+                    torch.cuda.stream(stream)
+                    if stream is not None else contextlib.nullcontext()
+                ):
+                    result = self._test(
+                        epoch, split, subset, state_dicts, scalars
+                    )
+                if stream is not None:
+                    stream.synchronize()
+                error = None
+            except Exception as e:
+                result, error = None, e
+            self._results.put(
+                (error, epoch, result, scalars, state_dicts, callback)
+            )
+
+    def _test(self, epoch, split, subset, state_dicts, scalars):
+        for name, state in state_dicts.items():
+            self.replicas[name].load_state_dict(state["state_dict"])
+
+        tester = copy.copy(self.trainer)
+        for attr, value in list(vars(tester).items()):
+            if isinstance(value, EvaluatorBase):
+                setattr(tester, attr, copy.deepcopy(value))
+        for attr, name in self.attrs.items():
+            setattr(tester, attr, self.replicas[name])
+        tester._models = dict(self.replicas)
+        tester.device = self.device
+        tester.epoch = epoch
+        tester.write_scalar = lambda *args: scalars.append(args)
+        tester.get_test_loader = self._get_test_loader
+        tester.test_generator = self.test_generator
+
+        print(f"Background test of epoch {epoch + 1}")
+        return tester.test(split, subset)
+
+    def _get_test_loader(self, split=None, subset=False):
+        split, data_loader, population = self.trainer.get_test_loader(
+            split, subset
+        )
+        # Same loader, seeding its workers from loader_generator
+        data_loader = copy.copy(data_loader)
+        data_loader.generator = self.loader_generator
+        return split, data_loader, population
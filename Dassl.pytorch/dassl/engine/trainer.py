@@ -1,4 +1,6 @@
 import time
+import copy
+import itertools
 import numpy as np
 import os.path as osp
 import datetime
@@ -9,6 +11,7 @@ from tqdm import tqdm
 from torch.utils.tensorboard import SummaryWriter
 
 from dassl.data import DataManager
+from dassl.data.prefetcher import DevicePrefetcher
 from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.utils import (
     MetricMeter, AverageMeter, tolist_if_not, count_num_param, load_checkpoint,
@@ -18,6 +21,9 @@ from dassl.utils import (
 from dassl.modeling import build_head, build_backbone
 from dassl.evaluation import build_evaluator
 
+from .tta import TestTimeAugmentation
+from .background_test import BackgroundTester
+
 
 class SimpleNet(nn.Module):
     """A simple neural network composed of a CNN backbone
@@ -82,6 +88,9 @@ class TrainerBase:
         self._optims = OrderedDict()
         self._scheds = OrderedDict()
         self._writer = None
+        self._amp_device = "cpu"
+        self._amp_dtype = None
+        self._scaler = None
 
     def register_model(self, name="model", model=None, optim=None, sched=None):
         if self.__dict__.get("_models") is None:
@@ -116,20 +125,47 @@ class TrainerBase:
             return names_real
 
     def save_model(
-        self, epoch, directory, is_best=False, val_result=None, model_name=""
+        self,
+        epoch,
+        directory,
+        is_best=False,
+        val_result=None,
+        model_name="",
+        state_dicts=None
     ):
+        """Save the models.
+
+        state_dicts (dict, optional) gives for each model the
+        "state_dict", "optimizer" and "scheduler" to save instead of the
+        current ones, e.g. a snapshot tested in the background. The
+        training state is then not saved, as it belongs to the current
+        weights, and the checkpoint file, from which training resumes,
+        keeps pointing to the last checkpoint of the current weights.
+        """
         names = self.get_model_names()
+        train_state = None
+        if state_dicts is None:
+            train_state = self.train_state_dict()
+
+        scaler_dict = None
+        if self._scaler is not None:
+            scaler_dict = self._scaler.state_dict()
 
         for name in names:
-            model_dict = self._models[name].state_dict()
+            if state_dicts is not None:
+                model_dict = state_dicts[name]["state_dict"]
+                optim_dict = state_dicts[name]["optimizer"]
+                sched_dict = state_dicts[name]["scheduler"]
+            else:
+                model_dict = self._models[name].state_dict()
 
-            optim_dict = None
-            if self._optims[name] is not None:
-                optim_dict = self._optims[name].state_dict()
+                optim_dict = None
+                if self._optims[name] is not None:
+                    optim_dict = self._optims[name].state_dict()
 
-            sched_dict = None
-            if self._scheds[name] is not None:
-                sched_dict = self._scheds[name].state_dict()
+                sched_dict = None
+                if self._scheds[name] is not None:
+                    sched_dict = self._scheds[name].state_dict()
 
             save_checkpoint(
                 {
@@ -137,11 +173,14 @@ class TrainerBase:
                     "epoch": epoch + 1,
                     "optimizer": optim_dict,
                     "scheduler": sched_dict,
-                    "val_result": val_result
+                    "val_result": val_result,
+                    "train_state": train_state,
+                    "scaler": scaler_dict
                 },
                 osp.join(directory, name),
                 is_best=is_best,
                 model_name=model_name,
+                update_checkpoint=state_dicts is None,
             )
 
     def resume_model_if_exist(self, directory):
@@ -167,8 +206,28 @@ class TrainerBase:
                 self._scheds[name]
             )
 
+        checkpoint = self._load_last_checkpoint(osp.join(directory, names[0]))
+        if checkpoint.get("train_state") is not None:
+            self.load_train_state_dict(checkpoint["train_state"])
+        if self._scaler is not None and checkpoint.get("scaler") is not None:
+            self._scaler.load_state_dict(checkpoint["scaler"])
+            print("Loaded grad scaler")
+
         return start_epoch
 
+    def _load_last_checkpoint(self, path):
+        with open(osp.join(path, "checkpoint"), "r") as checkpoint:
+            model_name = checkpoint.readlines()[0].strip("\n")
+        return load_checkpoint(osp.join(path, model_name))
+
+    def train_state_dict(self):
+        """Return the state of the training loop, e.g. the position in
+        the data loaders, saved along with the models (optional)."""
+        return None
+
+    def load_train_state_dict(self, state_dict):
+        pass
+
     def load_model(self, directory, epoch=None):
         if not directory:
             print(
@@ -195,8 +254,10 @@ class TrainerBase:
             state_dict = checkpoint["state_dict"]
             epoch = checkpoint["epoch"]
             val_result = checkpoint["val_result"]
+            if val_result is not None:
+                val_result = f"{val_result:.1f}"
             print(
-                f"Load {model_path} to {name} (epoch={epoch}, val_result={val_result:.1f})"
+                f"Load {model_path} to {name} (epoch={epoch}, val_result={val_result})"
             )
             self._models[name].load_state_dict(state_dict)
 
@@ -218,6 +279,44 @@ class TrainerBase:
             if self._scheds[name] is not None:
                 self._scheds[name].step()
 
+    def init_amp(self, precision, device):
+        """Set up automatic mixed precision.
+
+        Args:
+            precision (str): fp32, fp16 or bf16.
+            device (torch.device): device used for training.
+        """
+        self._amp_device = device.type
+
+        if precision == "fp32":
+            return
+
+        elif precision == "fp16":
+            if device.type != "cuda":
+                raise ValueError("fp16 training requires CUDA, use bf16 instead")
+            self._amp_dtype = torch.float16
+            # A single scaler is shared by all registered optimizers
+            if hasattr(torch.amp, "GradScaler"):
+                self._scaler = torch.amp.GradScaler("cuda")
+            else:
+                # torch < 2.3
+                self._scaler = torch.cuda.amp.GradScaler()
+
+        elif precision == "bf16":
+            self._amp_dtype = torch.bfloat16
+
+        else:
+            raise ValueError(f"Unknown precision: {precision}")
+
+        print(f"Use automatic mixed precision ({precision})")
+
+    def autocast(self, enabled=True):
+        return torch.autocast(
+            device_type=self._amp_device,
+            dtype=self._amp_dtype,
+            enabled=enabled and self._amp_dtype is not None
+        )
+
     def detect_anomaly(self, loss):
         if not torch.isfinite(loss).all():
             raise FloatingPointError("Loss is infinite or NaN!")
@@ -289,13 +388,28 @@ class TrainerBase:
 
     def model_backward(self, loss):
         self.detect_anomaly(loss)
-        loss.backward()
+        with self.autocast(enabled=False):
+            if self._scaler is not None:
+                loss = self._scaler.scale(loss)
+            loss.backward()
 
     def model_update(self, names=None):
         names = self.get_model_names(names)
-        for name in names:
-            if self._optims[name] is not None:
-                self._optims[name].step()
+        with self.autocast(enabled=False):
+            for name in names:
+                optim = self._optims[name]
+                if optim is None:
+                    continue
+                if self._scaler is None:
+                    optim.step()
+                elif any(
+                    p.grad is not None for group in optim.param_groups
+                    for p in group["params"]
+                ):
+                    # GradScaler refuses optimizers without any gradient
+                    self._scaler.step(optim)
+            if self._scaler is not None:
+                self._scaler.update()
 
     def model_backward_and_update(self, loss, names=None):
         self.model_zero_grad(names)
@@ -315,16 +429,51 @@ class SimpleTrainer(TrainerBase):
         else:
             self.device = torch.device("cpu")
 
+        self.init_amp(cfg.TRAIN.PRECISION, self.device)
+
         # Save as attributes some frequently used variables
         self.start_epoch = self.epoch = 0
         self.max_epoch = cfg.OPTIM.MAX_EPOCH
         self.output_dir = cfg.OUTPUT_DIR
 
         self.cfg = cfg
+        self._infinite_iters = {}
+        self.start_batch_idx = 0
         self.build_data_loader()
         self.build_model()
         self.evaluator = build_evaluator(cfg, lab2cname=self.lab2cname)
         self.best_result = -np.inf
+        self._background_tester = None
+        # Generator of the random draws of model_inference(), None for the
+        # default one (the background tester has its own)
+        self.test_generator = None
+        self.tta = self.build_tta()
+
+    def build_tta(self, extra_views=None):
+        """Build the test-time augmentation of TEST.TTA (None if off).
+
+        extra_views (dict, optional) gives trainer-specific views, see
+        TestTimeAugmentation.
+        """
+        views = self.cfg.TEST.TTA
+        if not views:
+            return None
+        print(f"Apply test-time augmentation: {', '.join(views)}")
+        return TestTimeAugmentation(
+            views, self.cfg.TEST.TTA_CROP_SCALE, extra_views
+        )
+
+    def infinite_iter(self, data_loader):
+        """Return the iterator of an endless training data loader
+        (DATALOADER.INFINITE).
+
+        It is created on first use and kept across epochs, so that the
+        workers are spawned once.
+        """
+        key = id(data_loader)
+        if key not in self._infinite_iters:
+            self._infinite_iters[key] = iter(data_loader)
+        return self._infinite_iters[key]
 
     def check_cfg(self, cfg):
         """Check whether some variables are set correctly for
@@ -399,8 +548,12 @@ class SimpleTrainer(TrainerBase):
         # Remember the starting time (for computing the elapsed time)
         self.time_start = time.time()
 
+    def before_epoch(self):
+        self.collect_tests()
+
     def after_train(self):
         print("Finish training")
+        self.collect_tests(wait=True)
 
         do_test = not self.cfg.TEST.NO_TEST
         if do_test:
@@ -428,26 +581,56 @@ class SimpleTrainer(TrainerBase):
         )
 
         if do_test and self.cfg.TEST.FINAL_MODEL == "best_val":
-            curr_result = self.test(split="val")
-            is_best = curr_result > self.best_result
-            if is_best:
-                self.best_result = curr_result
-                self.save_model(
-                    self.epoch,
-                    self.output_dir,
-                    val_result=curr_result,
-                    model_name="model-best.pth.tar"
-                )
+            self.test_in_background(split="val", callback=self.save_if_best)
 
         if meet_checkpoint_freq or last_epoch:
             self.save_model(self.epoch, self.output_dir)
 
-    @torch.no_grad()
-    def test(self, split=None):
-        """A generic testing pipeline."""
-        self.set_model_mode("eval")
-        self.evaluator.reset()
+    def save_if_best(self, epoch, curr_result, state_dicts=None):
+        is_best = curr_result > self.best_result
+        if is_best:
+            self.best_result = curr_result
+            self.save_model(
+                epoch,
+                self.output_dir,
+                val_result=curr_result,
+                model_name="model-best.pth.tar",
+                state_dicts=state_dicts
+            )
+
+    def test_in_background(self, split=None, callback=None, subset=False):
+        """Test a snapshot of the models while training goes on if
+        TEST.BACKGROUND, otherwise test right away.
+
+        callback(epoch, result, state_dicts) receives the result, where
+        state_dicts is the snapshot of the tested weights, optimizers and
+        schedulers (None when tested right away).
+        """
+        if not self.cfg.TEST.BACKGROUND:
+            result = self.test(split, subset)
+            if callback is not None:
+                callback(self.epoch, result)
+            return
+
+        if self._background_tester is None:
+            device = self.cfg.TEST.BACKGROUND_DEVICE
+            device = torch.device(device) if device else self.device
+            self._background_tester = BackgroundTester(self, device)
+        self._background_tester.submit(split, callback, subset)
+
+    def collect_tests(self, wait=False):
+        """Post the results of the finished background tests, or wait for
+        all of them."""
+        if self._background_tester is not None:
+            self._background_tester.collect(wait)
+
+    def get_test_loader(self, split=None, subset=False):
+        """Return the split to test, its data loader and the number of
+        items per class of the split when only a subset is tested.
 
+        With subset=True, the fixed class-stratified subset of the split
+        is tested if TEST.SUBSET_SIZE is set.
+        """
         if split is None:
             split = self.cfg.TEST.SPLIT
 
@@ -457,22 +640,81 @@ class SimpleTrainer(TrainerBase):
             split = "test"  # in case val_loader is None
             data_loader = self.test_loader
 
+        population = None
+        subsets = getattr(self, "dm", None) and self.dm.subsets
+        if subset and subsets and split in subsets:
+            data_loader, population = subsets[split]
+
+        return split, data_loader, population
+
+    @torch.no_grad()
+    def test(self, split=None, subset=False):
+        """A generic testing pipeline.
+
+        model_inference() may return a dict of the outputs of several
+        heads. Each head is evaluated separately: the first one gives the
+        result and is written under {split}/, the others under
+        {split}/{head}/.
+        """
+        self.set_model_mode("eval")
+        split, data_loader, population = self.get_test_loader(split, subset)
+        evaluators = {}
+
         print(f"Evaluate on the *{split}* set")
 
+        num_images = 0
+        inference_time = 0
+        time_start = time.time()
         for batch_idx, batch in enumerate(tqdm(data_loader)):
             input, label = self.parse_batch_test(batch)
-            output = self.model_inference(input)
-            self.evaluator.process(output, label)
-
-        results = self.evaluator.evaluate()
+            self.synchronize()
+            inference_start = time.time()
+            with self.autocast():
+                outputs = self.model_inference(input)
+            self.synchronize()
+            inference_time += time.time() - inference_start
+            if not isinstance(outputs, dict):
+                outputs = {None: outputs}
+            for head, output in outputs.items():
+                if head not in evaluators:
+                    evaluator = self.evaluator
+                    if evaluators:
+                        evaluator = copy.deepcopy(evaluator)
+                    evaluator.reset(population)
+                    evaluators[head] = evaluator
+                evaluators[head].process(output, label)
+            num_images += label.size(0)
+        self.synchronize()
+        # Data loading included
+        speed = num_images / (time.time() - time_start)
+        inference_speed = num_images / inference_time
+
+        for i, (head, evaluator) in enumerate(evaluators.items()):
+            if head is not None:
+                print(f"Head: {head}")
+            results = evaluator.evaluate()
+            prefix = split if i == 0 else f"{split}/{head}"
+            for k, v in results.items():
+                self.write_scalar(f"{prefix}/{k}", v, self.epoch)
+            if i == 0:
+                result = list(results.values())[0]
+        print(f"* throughput: {speed:,.1f} images/sec")
+        print(f"* model_inference: {inference_speed:,.1f} images/sec")
+        self.write_scalar(f"{split}/images_per_sec", speed, self.epoch)
+        self.write_scalar(
+            f"{split}/inference_images_per_sec", inference_speed, self.epoch
+        )
 
-        for k, v in results.items():
-            tag = f"{split}/{k}"
-            self.write_scalar(tag, v, self.epoch)
+        return result
 
-        return list(results.values())[0]
+    def synchronize(self):
+        """Wait for the work queued on the device, for timing."""
+        if self.device.type == "cuda":
+            torch.cuda.current_stream(self.device).synchronize()
 
     def model_inference(self, input):
+        if self.tta is not None:
+            return self.tta(input, self.model)
         return self.model(input)
 
     def parse_batch_test(self, batch):
@@ -518,25 +760,15 @@ class TrainerXU(SimpleTrainer):
         else:
             raise ValueError
 
-        train_loader_x_iter = iter(self.train_loader_x)
-        train_loader_u_iter = iter(self.train_loader_u)
+        train_batches = self.train_batches()
 
         end = time.time()
-        for self.batch_idx in range(self.num_batches):
-            try:
-                batch_x = next(train_loader_x_iter)
-            except StopIteration:
-                train_loader_x_iter = iter(self.train_loader_x)
-                batch_x = next(train_loader_x_iter)
-
-            try:
-                batch_u = next(train_loader_u_iter)
-            except StopIteration:
-                train_loader_u_iter = iter(self.train_loader_u)
-                batch_u = next(train_loader_u_iter)
-
+        for self.batch_idx, (batch_x, batch_u) in enumerate(
+            train_batches, self.start_batch_idx
+        ):
             data_time.update(time.time() - end)
-            loss_summary = self.forward_backward(batch_x, batch_u)
+            with self.autocast():
+                loss_summary = self.forward_backward(batch_x, batch_u)
             batch_time.update(time.time() - end)
             losses.update(loss_summary)
 
@@ -566,8 +798,134 @@ class TrainerXU(SimpleTrainer):
                 self.write_scalar("train/" + name, meter.avg, n_iter)
             self.write_scalar("train/lr", self.get_current_lr(), n_iter)
 
+            iter_freq = self.cfg.TRAIN.CHECKPOINT_ITER_FREQ
+            if iter_freq > 0 and (self.batch_idx + 1) % iter_freq == 0:
+                self.save_last_model()
+
             end = time.time()
 
+        self.start_batch_idx = 0
+
+    def save_last_model(self):
+        """Save model-last.pth.tar, from which training resumes at the
+        next batch."""
+        last_batch = (self.batch_idx + 1) == self.num_batches
+        # The checkpoint records the last complete epoch
+        epoch = self.epoch if last_batch else self.epoch - 1
+        self.save_model(epoch, self.output_dir, model_name="model-last.pth.tar")
+
+    def train_state_dict(self):
+        """Position of the next batch: epoch, batch_idx and the state of
+        the samplers of train_loader_x and train_loader_u.
+
+        The samplers are only resumable with TRAIN.CHECKPOINT_ITER_FREQ,
+        otherwise training resumes at the start of an epoch."""
+        if getattr(self, "batch_idx", None) is None:
+            return None
+        if self.cfg.TRAIN.CHECKPOINT_ITER_FREQ <= 0:
+            return None
+
+        state = {"epoch": self.epoch, "batch_idx": self.batch_idx + 1}
+        if state["batch_idx"] == self.num_batches:
+            state = {"epoch": self.epoch + 1, "batch_idx": 0}
+
+        for name in ["train_x", "train_u"]:
+            data_loader = getattr(self, f"train_loader_{name[-1]}")
+            state[name] = self._sampler_state(name, data_loader, state)
+        return state
+
+    def _sampler_state(self, name, data_loader, state):
+        sampler = data_loader.sampler
+        num_batches = self.batch_idx + 1
+
+        if self.cfg.DATALOADER.INFINITE:
+            if id(data_loader) not in self._infinite_iters:
+                return sampler.state_dict()
+            step = self.epoch * self.num_batches + num_batches
+            num_samples = (step - self._stream_start) * data_loader.batch_size
+            return sampler.state_at(num_samples)
+
+        if state["batch_idx"] == 0:
+            # The next epoch starts with new passes
+            return sampler.state_dict()
+
+        # Pass the last batch was taken from
+        first_batch, pass_state = [
+            p for p in self._loader_passes[name] if p[0] < num_batches
+        ][-1]
+        skip = (num_batches-first_batch) * data_loader.batch_size
+        return dict(pass_state, skip=pass_state["skip"] + skip)
+
+    def load_train_state_dict(self, state_dict):
+        print(
+            f"Resume at epoch {state_dict['epoch'] + 1}, "
+            f"batch {state_dict['batch_idx'] + 1}"
+        )
+        self.start_batch_idx = state_dict["batch_idx"]
+        self.train_loader_x.sampler.load_state_dict(state_dict["train_x"])
+        self.train_loader_u.sampler.load_state_dict(state_dict["train_u"])
+
+    def train_batches(self):
+        """Yield num_batches pairs of (batch_x, batch_u).
+
+        The shorter loader is restarted when it runs out, unless the
+        loaders are endless (DATALOADER.INFINITE). Subclasses can
+        wrap this generator to preprocess upcoming batches.
+        """
+        batches = self._train_loader_batches()
+        if self.cfg.DATALOADER.DEVICE_PREFETCH:
+            batches = DevicePrefetcher(batches, self.device)
+
+        for batch_x, batch_u in batches:
+            batch_x = self.train_loader_x.dataset.apply_batch_transform(
+                batch_x, self.device
+            )
+            batch_u = self.train_loader_u.dataset.apply_batch_transform(
+                batch_u, self.device
+            )
+            yield batch_x, batch_u
+
+    def _train_loader_batches(self):
+        start = self.start_batch_idx
+
+        if self.cfg.DATALOADER.INFINITE:
+            if id(self.train_loader_x) not in self._infinite_iters:
+                # Step at which the endless streams start
+                self._stream_start = self.epoch * self.num_batches + start
+            train_loader_x_iter = self.infinite_iter(self.train_loader_x)
+            train_loader_u_iter = self.infinite_iter(self.train_loader_u)
+            for _ in range(start, self.num_batches):
+                yield next(train_loader_x_iter), next(train_loader_u_iter)
+            return
+
+        # (first batch_idx, sampler state) of each pass, see train_state_dict()
+        self._loader_passes = {"train_x": [], "train_u": []}
+        train_loader_x_iter = self._iter_pass("train_x", start)
+        train_loader_u_iter = self._iter_pass("train_u", start)
+
+        for batch_idx in range(start, self.num_batches):
+            try:
+                batch_x = next(train_loader_x_iter)
+            except StopIteration:
+                train_loader_x_iter = self._iter_pass("train_x", batch_idx)
+                batch_x = next(train_loader_x_iter)
+
+            try:
+                batch_u = next(train_loader_u_iter)
+            except StopIteration:
+                train_loader_u_iter = self._iter_pass("train_u", batch_idx)
+                batch_u = next(train_loader_u_iter)
+
+            yield batch_x, batch_u
+
+    def _iter_pass(self, name, batch_idx):
+        data_loader = getattr(self, f"train_loader_{name[-1]}")
+        if self.cfg.TRAIN.CHECKPOINT_ITER_FREQ > 0:
+            self._loader_passes[name].append(
+                (batch_idx, data_loader.sampler.state_dict())
+            )
+        return iter(data_loader)
+
     def parse_batch_train(self, batch_x, batch_u):
         input_x = batch_x["img"]
         label_x = batch_x["label"]
@@ -590,10 +948,22 @@ class TrainerX(SimpleTrainer):
         data_time = AverageMeter()
         self.num_batches = len(self.train_loader_x)
 
+        train_loader_x = self.train_loader_x
+        if self.cfg.DATALOADER.INFINITE:
+            train_loader_x = itertools.islice(
+                self.infinite_iter(train_loader_x), self.num_batches
+            )
+        if self.cfg.DATALOADER.DEVICE_PREFETCH:
+            train_loader_x = DevicePrefetcher(train_loader_x, self.device)
+
         end = time.time()
-        for self.batch_idx, batch in enumerate(self.train_loader_x):
+        for self.batch_idx, batch in enumerate(train_loader_x):
+            batch = self.train_loader_x.dataset.apply_batch_transform(
+                batch, self.device
+            )
             data_time.update(time.time() - end)
-            loss_summary = self.forward_backward(batch)
+            with self.autocast():
+                loss_summary = self.forward_backward(batch)
             batch_time.update(time.time() - end)
             losses.update(loss_summary)
 
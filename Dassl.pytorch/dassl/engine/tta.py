@@ -0,0 +1,67 @@
+import torch
+import torch.nn.functional as F
+
+
+def five_crops(input, scale):
+    """Four corner crops and a center crop of relative size scale,
+    resized back to the input size."""
+    h, w = input.shape[2:]
+    crop_h, crop_w = int(round(h * scale)), int(round(w * scale))
+    tops = [0, 0, h - crop_h, h - crop_h, (h-crop_h) // 2]
+    lefts = [0, w - crop_w, 0, w - crop_w, (w-crop_w) // 2]
+    crops = torch.cat(
+        [
+            input[:, :, top:top + crop_h, left:left + crop_w]
+            for top, left in zip(tops, lefts)
+        ]
+    )
+    crops = F.interpolate(
+        crops, size=(h, w), mode="bilinear", align_corners=False
+    )
+    return list(crops.chunk(5))
+
+
+class TestTimeAugmentation:
+    """Score a test batch under several views with one model call.
+
+    The test images and their views are stacked into a single batch, so
+    that the model runs once, and the class probabilities of all views
+    are averaged on the device.
+
+    Args:
+        views (list): views added to the test images, among "flip" and
+            "crops" (four corner and one center crops).
+        crop_scale (float, optional): relative size of the crops.
+        extra_views (dict, optional): other views, mapping a name to a
+            function which returns a list of views of a batch.
+    """
+
+    def __init__(self, views, crop_scale=0.875, extra_views=None):
+        builtin_views = {
+            "flip": lambda input: [input.flip(3)],
+            "crops": lambda input: five_crops(input, crop_scale),
+        }
+        if extra_views is not None:
+            builtin_views.update(extra_views)
+
+        self.view_fns = []
+        for view in views:
+            if view not in builtin_views:
+                raise ValueError(f"Unknown test-time augmentation: {view}")
+            self.view_fns.append(builtin_views[view])
+
+    def views(self, input):
+        """Return the images and their views, stacked along the batch
+        dimension."""
+        views = [input]
+        for view_fn in self.view_fns:
+            views += view_fn(input)
+        return torch.cat(views)
+
+    def aggregate(self, output, batch_size):
+        """Average the class probabilities of the views of each image."""
+        prob = F.softmax(output.float(), 1)
+        return prob.view(-1, batch_size, prob.size(1)).mean(0)
+
+    def __call__(self, input, forward):
+        return self.aggregate(forward(self.views(input)), input.size(0))
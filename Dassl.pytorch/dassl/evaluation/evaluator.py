@@ -1,8 +1,7 @@
 import numpy as np
 import os.path as osp
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 import torch
-from sklearn.metrics import f1_score, confusion_matrix
 
 from .build import EVALUATOR_REGISTRY
 
@@ -13,7 +12,12 @@ class EvaluatorBase:
     def __init__(self, cfg):
         self.cfg = cfg
 
-    def reset(self):
+    def reset(self, population=None):
+        """Start a new evaluation.
+
+        population (np.ndarray, optional): number of items per class of
+        the split, when the evaluated items are a stratified subset of it.
+        """
         raise NotImplementedError
 
     def process(self, mo, gt):
@@ -25,88 +29,95 @@ class EvaluatorBase:
 
 @EVALUATOR_REGISTRY.register()
 class Classification(EvaluatorBase):
-    """Evaluator for classification."""
+    """Evaluator for classification.
+
+    A confusion matrix (rows: ground truth, columns: prediction) is
+    accumulated on the device of the model output, and all results are
+    derived from it in evaluate(), so process() never waits for the
+    device.
+    """
 
     def __init__(self, cfg, lab2cname=None, **kwargs):
         super().__init__(cfg)
         self._lab2cname = lab2cname
-        self._correct = 0
-        self._total = 0
-        self._per_class_res = None
-        self._y_true = []
-        self._y_pred = []
-        if cfg.TEST.PER_CLASS_RESULT:
+        self._cmat = None
+        self._population = None
+        self._per_class = cfg.TEST.PER_CLASS_RESULT
+        if self._per_class:
             assert lab2cname is not None
-            self._per_class_res = defaultdict(list)
 
-    def reset(self):
-        self._correct = 0
-        self._total = 0
-        self._y_true = []
-        self._y_pred = []
-        if self._per_class_res is not None:
-            self._per_class_res = defaultdict(list)
+    def reset(self, population=None):
+        self._cmat = None
+        self._population = population
 
     def process(self, mo, gt):
         # mo (torch.Tensor): model output [batch, num_classes]
         # gt (torch.LongTensor): ground truth [batch]
-        pred = mo.max(1)[1]
-        matches = pred.eq(gt).float()
-        self._correct += int(matches.sum().item())
-        self._total += gt.shape[0]
-
-        self._y_true.extend(gt.data.cpu().numpy().tolist())
-        self._y_pred.extend(pred.data.cpu().numpy().tolist())
-
-        if self._per_class_res is not None:
-            for i, label in enumerate(gt):
-                label = label.item()
-                matches_i = int(matches[i].item())
-                self._per_class_res[label].append(matches_i)
+        num_classes = mo.shape[1]
+        if self._cmat is None:
+            self._cmat = torch.zeros(
+                num_classes, num_classes, dtype=torch.long, device=mo.device
+            )
+        pred = mo.argmax(1)
+        gt = gt.to(pred.device)
+        # Same as a bincount with minlength, which would need a sync on cuda
+        self._cmat.view(-1).index_add_(
+            0, gt*num_classes + pred, torch.ones_like(pred)
+        )
 
     def evaluate(self):
         results = OrderedDict()
-        acc = 100.0 * self._correct / self._total
+        cmat = self._cmat.cpu().numpy()
+        tp = np.diag(cmat)
+        n_true = cmat.sum(1)
+        n_pred = cmat.sum(0)
+        total = int(cmat.sum())
+        correct = int(tp.sum())
+        acc = 100.0 * correct / total
         err = 100.0 - acc
-        macro_f1 = 100.0 * f1_score(
-            self._y_true,
-            self._y_pred,
-            average="macro",
-            labels=np.unique(self._y_true)
-        )
+
+        # Macro F1 over the classes present in the ground truth
+        labels = np.flatnonzero(n_true)
+        f1 = 2 * tp[labels] / (n_true[labels] + n_pred[labels])
+        macro_f1 = 100.0 * f1.mean()
+
+        acc_info = f"{acc:.1f}%"
+        if self._population is not None:
+            acc, ci = self._stratified_accuracy(tp, n_true)
+            err = 100.0 - acc
+            acc_info = (
+                f"{acc:.1f}% +- {ci:.1f} "
+                f"(95% CI, subset of {int(self._population.sum()):,})"
+            )
 
         # The first value will be returned by trainer.test()
         results["accuracy"] = acc
         results["error_rate"] = err
         results["macro_f1"] = macro_f1
+        if self._population is not None:
+            results["accuracy_ci"] = ci
 
         print(
             "=> result\n"
-            f"* total: {self._total:,}\n"
-            f"* correct: {self._correct:,}\n"
-            f"* accuracy: {acc:.1f}%\n"
+            f"* total: {total:,}\n"
+            f"* correct: {correct:,}\n"
+            f"* accuracy: {acc_info}\n"
             f"* error: {err:.1f}%\n"
             f"* macro_f1: {macro_f1:.1f}%"
         )
 
-        if self._per_class_res is not None:
-            labels = list(self._per_class_res.keys())
-            labels.sort()
-
+        if self._per_class:
             print("=> per-class result")
             accs = []
 
             for label in labels:
                 classname = self._lab2cname[label]
-                res = self._per_class_res[label]
-                correct = sum(res)
-                total = len(res)
-                acc = 100.0 * correct / total
+                acc = 100.0 * tp[label] / n_true[label]
                 accs.append(acc)
                 print(
                     f"* class: {label} ({classname})\t"
-                    f"total: {total:,}\t"
-                    f"correct: {correct:,}\t"
+                    f"total: {n_true[label]:,}\t"
+                    f"correct: {tp[label]:,}\t"
                     f"acc: {acc:.1f}%"
                 )
             mean_acc = np.mean(accs)
@@ -115,11 +126,32 @@ class Classification(EvaluatorBase):
             results["perclass_accuracy"] = mean_acc
 
         if self.cfg.TEST.COMPUTE_CMAT:
-            cmat = confusion_matrix(
-                self._y_true, self._y_pred, normalize="true"
-            )
+            # Restricted to the classes seen in the ground truth or the
+            # predictions and normalized over the ground truth, as
+            # sklearn's confusion_matrix(normalize="true")
+            seen = np.flatnonzero(n_true + n_pred)
+            cmat = cmat[np.ix_(seen, seen)].astype(np.float64)
+            with np.errstate(invalid="ignore"):
+                cmat = cmat / cmat.sum(1, keepdims=True)
+            cmat = np.nan_to_num(cmat)
             save_path = osp.join(self.cfg.OUTPUT_DIR, "cmat.pt")
             torch.save(cmat, save_path)
             print(f"Confusion matrix is saved to {save_path}")
 
         return results
+
+    def _stratified_accuracy(self, tp, n_true):
+        """Estimate the accuracy on the whole split from a class-stratified
+        subset, and the half-width of its 95% confidence interval."""
+        population = self._population
+        labels = np.flatnonzero(n_true)
+        weight = population[labels] / population.sum()
+        n, size = n_true[labels], population[labels]
+        p = tp[labels] / n
+
+        acc = np.sum(weight * p)
+        # Unbiased variance of each class mean, with the finite population
+        # correction
+        var = p * (1-p) / np.maximum(n - 1, 1) * (1 - n/size)
+        ci = 1.96 * np.sqrt(np.sum(weight**2 * var))
+        return float(100.0 * acc), float(100.0 * ci)
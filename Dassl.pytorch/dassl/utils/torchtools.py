@@ -29,7 +29,8 @@ def save_checkpoint(
     save_dir,
     is_best=False,
     remove_module_from_keys=True,
-    model_name=""
+    model_name="",
+    update_checkpoint=True
 ):
     r"""Save checkpoint.
 
@@ -41,6 +42,9 @@ def save_checkpoint(
         remove_module_from_keys (bool, optional): whether to remove "module."
             from layer names. Default is True.
         model_name (str, optional): model name to save.
+        update_checkpoint (bool, optional): whether to record the model name
+            in the ``checkpoint`` file, from which training resumes.
+            Default is True.
     """
     mkdir_if_missing(save_dir)
 
@@ -63,10 +67,11 @@ def save_checkpoint(
     print(f"Checkpoint saved to {fpath}")
 
     # save current model name
-    checkpoint_file = osp.join(save_dir, "checkpoint")
-    checkpoint = open(checkpoint_file, "w+")
-    checkpoint.write("{}\n".format(osp.basename(fpath)))
-    checkpoint.close()
+    if update_checkpoint:
+        checkpoint_file = osp.join(save_dir, "checkpoint")
+        checkpoint = open(checkpoint_file, "w+")
+        checkpoint.write("{}\n".format(osp.basename(fpath)))
+        checkpoint.close()
 
     if is_best:
         best_fpath = osp.join(osp.dirname(fpath), "model-best.pth.tar")
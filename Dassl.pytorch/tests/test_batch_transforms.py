@@ -0,0 +1,104 @@
+"""
+Parity of the batched augmentations with the PIL ones of randaugment.py.
+
+Run with python -m unittest discover tests
+"""
+import unittest
+import numpy as np
+import torch
+from PIL import Image
+from unittest import mock
+
+from dassl.data.transforms import randaugment as R
+from dassl.data.transforms import batch_transforms as B
+
+
+def _image():
+    # Gradients plus noise, so that every op changes some pixels
+    rng = np.random.RandomState(0)
+    yy, xx = np.mgrid[0:48, 0:64]
+    arr = np.stack([xx * 3, yy * 4, (xx+yy) * 2], -1)
+    arr = arr + rng.randint(0, 40, arr.shape)
+    return np.clip(arr, 0, 255).astype(np.uint8)
+
+
+class TestBatchTransforms(unittest.TestCase):
+
+    def setUp(self):
+        self.arr = _image()
+        self.imgs = torch.from_numpy(self.arr).permute(2, 0, 1)[None].float()
+
+    def check(self, pil_op, batch_op, v, max_frac=0.0):
+        """Compare the outputs with the same parameter v, without the
+        random sign flips of the geometric ops.
+
+        Pixels may differ by 1 from rounding. max_frac is the fraction of
+        pixels allowed to differ by more, for resampling at the pixel
+        boundaries.
+        """
+        with mock.patch.object(R.random, "random", return_value=0.0):
+            ref = np.array(pil_op(Image.fromarray(self.arr), v))
+        with mock.patch.object(B, "_random_sign", side_effect=lambda x: x):
+            out = batch_op(self.imgs, torch.tensor([float(v)]))
+
+        self.assertEqual(out.shape, self.imgs.shape)
+        out = out[0].permute(1, 2, 0).numpy()
+        diff = np.abs(out - ref.astype(np.float32))
+        self.assertLessEqual((diff > 1).mean(), max_frac)
+        if max_frac == 0:
+            self.assertLessEqual(diff.max(), 1)
+
+    def test_auto_contrast(self):
+        self.check(R.AutoContrast, B.auto_contrast, 0)
+
+    def test_brightness(self):
+        self.check(R.Brightness, B.brightness, 0.7)
+
+    def test_color(self):
+        self.check(R.Color, B.color, 0.3)
+
+    def test_contrast(self):
+        self.check(R.Contrast, B.contrast, 0.3)
+
+    def test_equalize(self):
+        self.check(R.Equalize, B.equalize, 0)
+
+    def test_identity(self):
+        self.check(R.Identity, B.identity, 0)
+
+    def test_posterize(self):
+        self.check(R.Posterize, B.posterize, 5.7)
+
+    def test_rotate(self):
+        self.check(R.Rotate, B.rotate, 20, max_frac=0.005)
+
+    def test_sharpness(self):
+        self.check(R.Sharpness, B.sharpness, 0.2)
+
+    def test_shear_x(self):
+        self.check(R.ShearX, B.shear_x, 0.213)
+
+    def test_shear_y(self):
+        self.check(R.ShearY, B.shear_y, -0.187)
+
+    def test_solarize(self):
+        self.check(R.Solarize, B.solarize, 100)
+
+    def test_translate_x(self):
+        self.check(R.TranslateX, B.translate_x, 0.2)
+
+    def test_translate_y(self):
+        self.check(R.TranslateY, B.translate_y, -0.1)
+
+    def test_fixmatch_list(self):
+        # Same ops and ranges as the PIL list
+        pil_ops = [(op.__name__, lo, hi) for op, lo, hi in R.fixmatch_list()]
+        batch_ops = [
+            ("".join(s.capitalize() for s in op.__name__.split("_")), lo, hi)
+            for op, lo, hi in B.fixmatch_list()
+        ]
+        self.assertEqual(batch_ops, pil_ops)
+
+
+if __name__ == "__main__":
+    unittest.main()
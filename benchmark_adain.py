@@ -0,0 +1,85 @@
+import argparse
+import time
+import torch
+
+from trainers.adain.adain import AdaIN, FastAdaIN
+
+
+def benchmark(adain, content, style, iters, warmup):
+    for _ in range(warmup):
+        adain(content.clone(), style.clone())
+    if content.is_cuda:
+        torch.cuda.synchronize()
+
+    elapsed = 0
+    for _ in range(iters):
+        # AdaIN modifies its inputs in place
+        c, s = content.clone(), style.clone()
+        if content.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        adain(c, s)
+        if content.is_cuda:
+            torch.cuda.synchronize()
+        elapsed += time.time() - start
+
+    return iters * content.size(0) / elapsed
+
+
+def main(args):
+    if torch.cuda.is_available() and not args.cpu:
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+    torch.manual_seed(0)
+
+    norm_mean = [0.485, 0.456, 0.406]
+    norm_std = [0.229, 0.224, 0.225]
+    content = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    style = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+
+    adain = AdaIN(
+        args.decoder, args.vgg, device, norm_mean=norm_mean, norm_std=norm_std
+    )
+    ref = adain(content.clone(), style.clone())
+    speed = benchmark(adain, content, style, args.iters, args.warmup)
+    print(f"AdaIN (fp32): {speed:.1f} images/sec")
+
+    for precision in args.precision:
+        fast_adain = FastAdaIN(
+            args.decoder,
+            args.vgg,
+            device,
+            norm_mean=norm_mean,
+            norm_std=norm_std,
+            precision=precision,
+        )
+        out = fast_adain(content, style)
+        max_err = (out - ref).abs().max().item()
+        fast_speed = benchmark(fast_adain, content, style, args.iters, args.warmup)
+        print(
+            f"FastAdaIN ({precision}): {fast_speed:.1f} images/sec "
+            f"(x{fast_speed / speed:.2f}, max abs diff {max_err:.2e})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of AdaIN and FastAdaIN"
+    )
+    parser.add_argument("--decoder", type=str, required=True, help="decoder weights")
+    parser.add_argument("--vgg", type=str, required=True, help="vgg weights")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--size", type=int, default=224, help="image size")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument(
+        "--precision",
+        type=str,
+        nargs="+",
+        default=["fp32", "bf16"],
+        help="FastAdaIN precisions to test (fp32, fp16, bf16)",
+    )
+    parser.add_argument("--cpu", action="store_true", help="run on cpu")
+    args = parser.parse_args()
+    main(args)
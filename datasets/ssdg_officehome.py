@@ -45,8 +45,10 @@ class SSDGOfficeHome(DatasetBase):
         src_domains = cfg.DATASET.SOURCE_DOMAINS
         tgt_domain = cfg.DATASET.TARGET_DOMAINS[0]
         split_ssdg_path = osp.join(
-            self.split_ssdg_dir, f"{tgt_domain}_nlab{num_labeled}_seed{seed}.json"
+            cfg.DATASET.SPLIT_SSDG_DIR or self.split_ssdg_dir,
+            f"{tgt_domain}_nlab{num_labeled}_seed{seed}.json"
         )
+        self.split_ssdg_path = split_ssdg_path
 
         if not osp.exists(split_ssdg_path):
             train_x, train_u = self._read_data_train(
@@ -67,6 +69,11 @@ class SSDGOfficeHome(DatasetBase):
 
         super().__init__(train_x=train_x, train_u=train_u, val=val, test=test)
 
+    def manifest_paths(self):
+        paths = super().manifest_paths()
+        paths.append(self.split_ssdg_path)
+        return paths
+
     def _read_data_train(self, input_domains, split, num_labeled):
         items_x, items_u = [], []
         num_labeled_per_class = None
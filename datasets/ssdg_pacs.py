@@ -1,4 +1,5 @@
 import os.path as osp
+import glob
 import random
 from collections import defaultdict
 
@@ -48,8 +49,10 @@ class SSDGPACS(DatasetBase):
         src_domains = cfg.DATASET.SOURCE_DOMAINS
         tgt_domain = cfg.DATASET.TARGET_DOMAINS[0]
         split_ssdg_path = osp.join(
-            self.split_ssdg_dir, f"{tgt_domain}_nlab{num_labeled}_seed{seed}.json"
+            cfg.DATASET.SPLIT_SSDG_DIR or self.split_ssdg_dir,
+            f"{tgt_domain}_nlab{num_labeled}_seed{seed}.json"
         )
+        self.split_ssdg_path = split_ssdg_path
 
         if not osp.exists(split_ssdg_path):
             train_x, train_u = self._read_data_train(
@@ -70,6 +73,12 @@ class SSDGPACS(DatasetBase):
 
         super().__init__(train_x=train_x, train_u=train_u, val=val, test=test)
 
+    def manifest_paths(self):
+        paths = super().manifest_paths()
+        paths += sorted(glob.glob(osp.join(self.split_dir, "*.txt")))
+        paths.append(self.split_ssdg_path)
+        return paths
+
     @staticmethod
     def read_json_train(filepath, src_domains, image_dir):
         """
@@ -0,0 +1,202 @@
+import argparse
+import ast
+import csv
+import glob
+import os.path as osp
+from collections import OrderedDict
+from tabulate import tabulate
+
+from dassl.utils import set_random_seed
+from dassl.engine import build_trainer
+from dassl.data.image_cache import SharedImageCache
+from dassl.data.transforms import build_transform
+from dassl.data.data_manager import build_data_loader
+
+from train import setup_cfg
+
+
+def read_run_args(run_dir):
+    """Return the arguments train.py was called with, read from the
+    "** Arguments **" block of the run's log.txt."""
+    with open(osp.join(run_dir, "log.txt"), "r") as f:
+        lines = f.read().splitlines()
+
+    args = argparse.Namespace()
+    for line in lines[lines.index("** Arguments **") + 2:]:
+        if line.startswith("*"):
+            break
+        key, _, value = line.partition(": ")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass  # a plain string
+        setattr(args, key, value)
+    return args
+
+
+def load_run_cfg(run_dir, args):
+    run_args = read_run_args(run_dir)
+    if args.root:
+        run_args.root = args.root
+    run_args.output_dir = run_dir
+    # The decoded test images are cached once per test set by main()
+    run_args.opts = (
+        list(run_args.opts or []) + ["DATALOADER.IMAGE_CACHE_MB", "0"] +
+        args.opts
+    )
+    return setup_cfg(run_args)
+
+
+def test_set_key(cfg):
+    return str(
+        (cfg.DATASET.NAME, cfg.DATASET.ROOT, cfg.DATASET.TARGET_DOMAINS, cfg.INPUT)
+    )
+
+
+def model_key(cfg):
+    """Runs that only differ in these options share a trainer."""
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.SEED = -1
+    cfg.OUTPUT_DIR = ""
+    cfg.DATASET.NUM_LABELED = -1
+    return cfg.dump()
+
+
+def build_shared_test_loader(cfg, dataset, cache_mb):
+    """Test loader whose decoded images are kept in a shared cache, so
+    that the test set is decoded once for all the runs that use it.
+
+    The cache stores the images resized and center cropped as by the test
+    transform, which the loader then applies without these two ops.
+    """
+    image_cache = SharedImageCache(
+        [item.impath for item in dataset.test],
+        cfg.INPUT.SIZE,
+        cfg.INPUT.INTERPOLATION,
+        cache_mb * 1024**2,
+        is_train=False
+    )
+    tfm_test = build_transform(cfg, is_train=False)
+    return build_data_loader(
+        cfg,
+        sampler_type=cfg.DATALOADER.TEST.SAMPLER,
+        data_source=dataset.test,
+        batch_size=cfg.DATALOADER.TEST.BATCH_SIZE,
+        tfm=SharedImageCache.test_transform(tfm_test),
+        is_train=False,
+        image_cache=image_cache
+    )
+
+
+def test_run(trainer, run_dir, load_epoch):
+    results = OrderedDict()
+
+    # The trainer is shared by the runs of a model config, the outputs of
+    # the test (e.g. cmat.pt) go to the directory of the tested run
+    trainer.cfg.defrost()
+    trainer.cfg.OUTPUT_DIR = run_dir
+    trainer.cfg.freeze()
+    trainer.output_dir = run_dir
+
+    def write_scalar(tag, scalar_value, global_step=None):
+        results[tag.split("/", 1)[1]] = scalar_value
+
+    trainer.write_scalar = write_scalar
+    trainer.load_model(run_dir, epoch=load_epoch)
+    trainer.test(split="test")
+    return results
+
+
+def main(args):
+    run_dirs = set()
+    for pattern in args.run_dirs:
+        run_dirs.update(
+            d for d in glob.glob(pattern) if osp.isfile(osp.join(d, "log.txt"))
+        )
+    print(f"Found {len(run_dirs)} run(s)")
+
+    # {test set: {model config: [(run_dir, cfg)]}}
+    groups = OrderedDict()
+    for run_dir in sorted(run_dirs):
+        cfg = load_run_cfg(run_dir, args)
+        runs = groups.setdefault(test_set_key(cfg), OrderedDict())
+        runs.setdefault(model_key(cfg), []).append((run_dir, cfg))
+
+    rows = []
+    for runs_by_model in groups.values():
+        test_loader = None
+
+        for runs in runs_by_model.values():
+            trainer = build_trainer(runs[0][1])
+            if test_loader is None:
+                test_loader = build_shared_test_loader(
+                    trainer.cfg, trainer.dm.dataset, args.cache_mb
+                )
+            trainer.test_loader = test_loader
+
+            for run_dir, cfg in runs:
+                print(f"** {run_dir} **")
+                if cfg.SEED >= 0:
+                    set_random_seed(cfg.SEED)
+                load_epoch = args.load_epoch
+                if load_epoch is None:
+                    load_epoch = cfg.OPTIM.MAX_EPOCH
+                row = OrderedDict()
+                row["run"] = run_dir
+                row["trainer"] = cfg.TRAINER.NAME
+                row["target"] = ",".join(cfg.DATASET.TARGET_DOMAINS)
+                row["num_labeled"] = cfg.DATASET.NUM_LABELED
+                row["seed"] = cfg.SEED
+                row.update(test_run(trainer, run_dir, load_epoch))
+                rows.append(row)
+
+    columns = list(OrderedDict.fromkeys(k for row in rows for k in row))
+    print(tabulate(
+        [[row.get(k, "") for k in columns] for row in rows],
+        headers=columns,
+        floatfmt=".1f"
+    ))
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Test the checkpoints of many runs of train.py, "
+        "decoding each test set once"
+    )
+    parser.add_argument(
+        "--run-dirs",
+        type=str,
+        nargs="+",
+        required=True,
+        help="output directories of train.py, or glob patterns of them",
+    )
+    parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument(
+        "--load-epoch",
+        type=int,
+        help="test the weights at this epoch (default: the last epoch)",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=8192,
+        help="memory for the decoded images of a test set",
+    )
+    parser.add_argument(
+        "--output", type=str, default="results.csv", help="results table"
+    )
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="modify config options using the command-line",
+    )
+    args = parser.parse_args()
+    main(args)
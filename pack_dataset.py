@@ -0,0 +1,83 @@
+import argparse
+import tempfile
+import os.path as osp
+
+from dassl.data.datasets import build_dataset
+from dassl.data.packed import pack_images
+
+from train import setup_cfg
+
+
+def main(args):
+    # Only the options that setup_cfg() reads
+    args.seed = -1
+    args.output_dir = ""
+    args.model_dir = ""
+    args.resume = ""
+    args.transforms = None
+    args.trainer = ""
+    args.backbone = ""
+    args.head = ""
+
+    # The SSDG datasets save the labeled/unlabeled split of the seed on
+    # first use. train_x + train_u hold all the source images whatever the
+    # split, so it is made in a temporary directory rather than left in the
+    # dataset directory for training runs to reuse
+    with tempfile.TemporaryDirectory() as split_dir:
+        args.opts = args.opts + ["DATASET.SPLIT_SSDG_DIR", split_dir]
+        cfg = setup_cfg(args)
+        dataset = build_dataset(cfg)
+    data_source = dataset.train_x + dataset.train_u + dataset.test
+    if dataset.val:
+        data_source += dataset.val
+
+    root = osp.abspath(osp.expanduser(cfg.DATASET.ROOT))
+    size = cfg.INPUT.SIZE if args.resize else None
+    pack_images(
+        data_source,
+        root,
+        args.pack_dir,
+        size=size,
+        interpolation=cfg.INPUT.INTERPOLATION,
+        shard_bytes=args.shard_mb * 1024**2
+    )
+    print(f"Use it with DATASET.PACKED_DIR {args.pack_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pack the images of a dataset into a few shard files"
+    )
+    parser.add_argument("pack_dir", type=str, help="output directory")
+    parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument(
+        "--source-domains", type=str, nargs="+", help="source domains for DA/DG"
+    )
+    parser.add_argument(
+        "--target-domains", type=str, nargs="+", help="target domains for DA/DG"
+    )
+    parser.add_argument(
+        "--config-file", type=str, default="", help="path to config file"
+    )
+    parser.add_argument(
+        "--dataset-config-file",
+        type=str,
+        default="",
+        help="path to config file for dataset setup",
+    )
+    parser.add_argument(
+        "--resize",
+        action="store_true",
+        help="store images resized to INPUT.SIZE as raw pixels",
+    )
+    parser.add_argument(
+        "--shard-mb", type=int, default=1024, help="maximum size of a shard"
+    )
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="modify config options using the command-line",
+    )
+    args = parser.parse_args()
+    main(args)
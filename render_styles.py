@@ -0,0 +1,77 @@
+import argparse
+import torch
+
+from dassl.utils import set_random_seed
+from dassl.data.datasets import build_dataset
+
+from train import setup_cfg
+from trainers.adain.adain import build_adain
+from trainers.adain.style_cache import StyleCache, render_style_cache
+
+
+def main(args):
+    # Only the options that setup_cfg() reads
+    args.output_dir = ""
+    args.model_dir = ""
+    args.resume = ""
+    args.transforms = None
+    args.trainer = ""
+    args.backbone = ""
+    args.head = ""
+    cfg = setup_cfg(args)
+    assert cfg.TRAINER.STYLEMATCH.STYLE_CACHE, "TRAINER.STYLEMATCH.STYLE_CACHE is not set"
+
+    if cfg.SEED >= 0:
+        print("Setting fixed seed: {}".format(cfg.SEED))
+        set_random_seed(cfg.SEED)
+
+    if torch.cuda.is_available() and cfg.USE_CUDA:
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    adain = build_adain(cfg, device)
+
+    cache = StyleCache.from_cfg(cfg)
+    if cache.exists() and not args.overwrite:
+        print(f"Style cache already exists at {cache.directory}")
+        return
+
+    dataset = build_dataset(cfg)
+    render_style_cache(cfg, adain, dataset, cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pre-render stylized training images for TRAINER.STYLEMATCH.STYLE_CACHE"
+    )
+    parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument(
+        "--seed", type=int, default=-1, help="only positive value enables a fixed seed"
+    )
+    parser.add_argument(
+        "--source-domains", type=str, nargs="+", help="source domains for DA/DG"
+    )
+    parser.add_argument(
+        "--target-domains", type=str, nargs="+", help="target domains for DA/DG"
+    )
+    parser.add_argument(
+        "--config-file", type=str, default="", help="path to config file"
+    )
+    parser.add_argument(
+        "--dataset-config-file",
+        type=str,
+        default="",
+        help="path to config file for dataset setup",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="render again even if the cache exists"
+    )
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="modify config options using the command-line",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,62 @@
+"""
+StylePrefetcher fed by DevicePrefetcher, as with DATALOADER.DEVICE_PREFETCH
+and TRAINER.STYLEMATCH.STYLE_PREFETCH.
+
+Run with python -m unittest discover tests
+"""
+import unittest
+import torch
+
+from dassl.data.prefetcher import DevicePrefetcher
+
+from trainers.adain.style_prefetch import StylePrefetcher
+
+
+def transfer(x0, u0):
+    # Slow enough to overlap with the copies of the next batches
+    for _ in range(20):
+        x0 = x0 @ x0.new_ones(x0.size(-1), x0.size(-1)) / x0.size(-1)
+        u0 = u0 @ u0.new_ones(u0.size(-1), u0.size(-1)) / u0.size(-1)
+    return x0, u0
+
+
+def make_batches(n, size):
+    gen = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(n):
+        batch_x = {"img0": torch.rand(8, 3, size, size, generator=gen)}
+        batch_u = {"img0": torch.rand(8, 3, size, size, generator=gen)}
+        batches.append((batch_x, batch_u))
+    return batches
+
+
+class TestStylePrefetch(unittest.TestCase):
+
+    def check(self, device, size):
+        batches = make_batches(6, size)
+        expected = [
+            transfer(batch_x["img0"].double(), batch_u["img0"].double())
+            for batch_x, batch_u in batches
+        ]
+
+        prefetcher = StylePrefetcher(transfer, device, depth=2)
+        stream = prefetcher(DevicePrefetcher(batches, device))
+        for (batch_x, batch_u), (x_sty, u_sty) in zip(stream, expected):
+            # Clobber the freed memory to expose early reuse
+            torch.full((8, 3, size, size), float("nan"), device=device)
+            # Loose tolerance for TF32 matmuls
+            for out, ref in [(batch_x["img_sty"], x_sty), (batch_u["img_sty"], u_sty)]:
+                self.assertTrue(
+                    torch.allclose(out.cpu().double(), ref, rtol=1e-2, atol=1e-3)
+                )
+
+    def test_cpu(self):
+        self.check(torch.device("cpu"), 32)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires cuda")
+    def test_cuda(self):
+        self.check(torch.device("cuda"), 256)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Test-time augmentation views of the StyleMatch trainers.
+
+Run with python -m unittest discover tests
+"""
+import unittest
+import torch
+from unittest import mock
+
+from dassl.engine.tta import TestTimeAugmentation
+
+from trainers.adain import net
+from trainers.adain.adain import AdaIN, FastAdaIN
+from trainers.adain.style_transfer import StyleTransferMixin
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+class Restyler(StyleTransferMixin):
+
+    def __init__(self, adain):
+        self.adain = adain
+        # Two domain styles, of size (1, 512, 1, 1)
+        self.tta_styles = [
+            (torch.full((1, 512, 1, 1), 0.1 * i), torch.ones(1, 512, 1, 1))
+            for i in range(2)
+        ]
+
+
+def build_adain(adain_class):
+    # Random weights instead of the pretrained files
+    weights = {
+        "decoder": net.decoder.state_dict(),
+        "vgg": net.vgg.state_dict(),
+    }
+    with mock.patch("torch.load", side_effect=weights.get):
+        return adain_class(
+            "decoder",
+            "vgg",
+            torch.device("cpu"),
+            norm_mean=MEAN,
+            norm_std=STD,
+        )
+
+
+class TestAdaINViews(unittest.TestCase):
+
+    def check_views(self, adain_class):
+        restyler = Restyler(build_adain(adain_class))
+        tta = TestTimeAugmentation(
+            ["flip", "adain"], extra_views={"adain": restyler.restyle_views}
+        )
+        input = torch.randn(2, 3, 32, 32)
+        original = input.clone()
+
+        views = tta.views(input)
+
+        self.assertTrue(torch.equal(input, original))
+        self.assertEqual(views.shape, (8, 3, 32, 32))
+        self.assertTrue(torch.equal(views[:2], original))
+
+    def test_adain_views(self):
+        self.check_views(AdaIN)
+
+    def test_fast_adain_views(self):
+        self.check_views(FastAdaIN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -71,18 +71,27 @@ def reset_cfg(cfg, args):
 
 
 def extend_cfg(cfg):
+    cfg.DATASET.SPLIT_SSDG_DIR = ""  # directory of the saved labeled/unlabeled splits (default: in the dataset directory)
+
     cfg.TRAINER.STYLEMATCH = CN()
     cfg.TRAINER.STYLEMATCH.INFERENCE_MODE = "deterministic"
     cfg.TRAINER.STYLEMATCH.N_ENSEMBLE = 10  # number of classifiers to sample during test (when INFERENCE_MODE='ensemble')
+    cfg.TRAINER.STYLEMATCH.TEST_BOTH_MODES = False  # also evaluate the other inference mode on the same backbone features
     cfg.TRAINER.STYLEMATCH.CONF_THRE = 0.95  # confidence threshold
     cfg.TRAINER.STYLEMATCH.STRONG_TRANSFORMS = ()  # strong augmentations
     cfg.TRAINER.STYLEMATCH.C_OPTIM = copy.deepcopy(cfg.OPTIM)  # classifier's optim setting
     cfg.TRAINER.STYLEMATCH.ADAIN_DECODER = ""  # path to decoder's weights
     cfg.TRAINER.STYLEMATCH.ADAIN_VGG = ""  # path to vgg's weights
+    cfg.TRAINER.STYLEMATCH.ADAIN_FAST = False  # use FastAdaIN (folded normalization, channels_last)
+    cfg.TRAINER.STYLEMATCH.ADAIN_PRECISION = "fp32"  # precision of FastAdaIN: fp32, fp16 or bf16
     cfg.TRAINER.STYLEMATCH.APPLY_AUG = True  # compute loss_u_aug
     cfg.TRAINER.STYLEMATCH.APPLY_STY = True  # compute loss_u_sty
     cfg.TRAINER.STYLEMATCH.CLASSIFIER = "stochastic"  # stochastic or normal
     cfg.TRAINER.STYLEMATCH.SAVE_SIGMA = False  # save sigma (classifier's std) during training
+    cfg.TRAINER.STYLEMATCH.STYLE_BANK = False  # draw style statistics from a precomputed per-domain bank
+    cfg.TRAINER.STYLEMATCH.STYLE_CACHE = ""  # directory of pre-rendered stylized images (empty: off)
+    cfg.TRAINER.STYLEMATCH.STYLE_CACHE_N = 2  # variants per image and other source domain
+    cfg.TRAINER.STYLEMATCH.STYLE_PREFETCH = 0  # stylized batches prepared ahead in the background (0: off)
 
     ##########UPCSC#########
     cfg.TRAINER.UPCSC = CN()
@@ -90,6 +99,11 @@ def extend_cfg(cfg):
     cfg.TRAINER.UPCSC.P_OPTIM = copy.deepcopy(cfg.OPTIM)
     cfg.TRAINER.UPCSC.Adaptive_SC = True
     cfg.TRAINER.UPCSC.NORMALIZE_SC = False
+    cfg.TRAINER.UPCSC.FUSED_FORWARD = False  # encode all views with a single G pass per step
+    cfg.TRAINER.UPCSC.LOSS_BLOCK_SIZE = 0  # rows per block in the UPCSC loss (0: dense)
+    cfg.TRAINER.UPCSC.QUEUE_SIZE = 0  # past features kept as extra UPCSC negatives (0: off)
+    cfg.TRAINER.UPCSC.COMPILE = False  # compile G, C, fP, cP and the UPCSC loss
+    cfg.TRAINER.UPCSC.COMPILE_CACHE_DIR = ""  # default: ~/.cache/upcsc_compile
 
 
 
@@ -1,5 +1,5 @@
 import contextlib
-import random
+import hashlib
 import os
 import time
 import datetime
@@ -8,6 +8,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from dassl.data import DataManager
 from dassl.engine import TRAINER_REGISTRY, TrainerXU, SimpleNet
@@ -15,7 +16,10 @@ from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.data.transforms import build_transform
 from dassl.utils import count_num_param
 
-from .adain.adain import AdaIN
+from .classifiers import (
+    StochasticClassifier, NormalClassifier, ClassifierInferenceMixin
+)
+from .adain.style_transfer import StyleTransferMixin
 import copy
 
 
@@ -32,17 +36,88 @@ def freeze_models_params(models):
                 param.requires_grad_(True)
 
 
+def upc_block_logsumexp(feature_blk, feature, pos_blk, pred_class_blk, pred_class, scale):
+    """Log-sum-exp of [positive, negatives] for a block of rows against
+    all keys in `feature`.
+
+    Two samples form a negative pair when their candidate classes do not
+    intersect, which is computed as a zero in the product of the (float)
+    candidate masks.
+    """
+    neg_matrix = torch.matmul(pred_class_blk, pred_class.T) == 0  # (b,B)
+    sim = torch.matmul(feature_blk, feature.T) * neg_matrix
+    neg_pair = sim.masked_fill(sim < 1e-6, -np.inf)
+    logits = torch.cat([pos_blk.unsqueeze(1), neg_pair], dim=1)  # (b, 1+B)
+    return torch.logsumexp(scale * logits, dim=1)
+
+
+def script_or_eager(model, name):
+    """TorchScript fallback for PyTorch versions without torch.compile."""
+    try:
+        return torch.jit.script(model)
+    except Exception as e:
+        print(f"Cannot script {name} ({e}), keep it in eager mode")
+        return model
+
+
+def compile_cache_dir(cfg):
+    """Cache directory shared by runs with the same compile-relevant config."""
+    key = str((cfg.MODEL, cfg.INPUT.SIZE, cfg.TRAINER, cfg.TRAIN.PRECISION))
+    digest = hashlib.md5(key.encode()).hexdigest()[:12]
+    root = cfg.TRAINER.UPCSC.COMPILE_CACHE_DIR
+    if not root:
+        root = os.path.join(os.path.expanduser("~"), ".cache", "upcsc_compile")
+    return os.path.join(root, digest)
+
+
+class NegativeQueue(nn.Module):
+    """Fixed-size ring buffer of past projected features and their
+    candidate-class masks, used as extra negatives in adaptiveUPCSCLoss.
+
+    The write position and fill count are buffers too, so that the queue is
+    saved with checkpoints and a compiled loss sees the same shapes at every
+    step.
+    """
+
+    def __init__(self, size, dim, num_classes):
+        super().__init__()
+        self.size = size
+        self.register_buffer("feature", torch.zeros(size, dim))
+        self.register_buffer(
+            "pred_class", torch.zeros(size, num_classes, dtype=torch.bool)
+        )
+        self.register_buffer("ptr", torch.zeros((), dtype=torch.long))
+        self.register_buffer("num_filled", torch.zeros((), dtype=torch.long))
+
+    @torch.no_grad()
+    def enqueue(self, feature, pred_class):
+        n = min(feature.size(0), self.size)
+        idx = (self.ptr + torch.arange(n, device=self.feature.device)) % self.size
+        self.feature[idx] = feature[-n:].to(self.feature.dtype)
+        self.pred_class[idx] = pred_class[-n:]
+        self.ptr.copy_((self.ptr + n) % self.size)
+        self.num_filled.copy_((self.num_filled + n).clamp(max=self.size))
+
+    def get(self):
+        """Return all the slots, the empty ones as zero features, which
+        have a zero similarity and are thus masked out of the negatives."""
+        filled = torch.arange(self.size, device=self.feature.device) < self.num_filled
+        return self.feature * filled.unsqueeze(1), self.pred_class & filled.unsqueeze(1)
+
+
 class adaptiveUPCSCLoss(nn.Module):
-    def __init__(self, cfg, num_classes, scale=1):
+    def __init__(self, cfg, num_classes, scale=1, block_size=0):
         super().__init__()
         self.cfg = cfg
         self.soft_plus = nn.Softplus()
         self.scale = scale
         self.num_classes = num_classes
         self.low_thre = 1/num_classes
+        # Rows of the similarity matrix processed at once (0 = dense)
+        self.block_size = block_size
 
 
-    def forward(self, feature, cP, C, prob_detach, conf_mask): 
+    def forward(self, feature, cP, C, prob_detach, conf_mask, queue=None): 
         feature = F.normalize(feature, p=2, dim=1)
         proxy = C.get_proxy()    # (C, fdim) or (C, fdim+1)
         proxy = F.normalize(cP(proxy), p=2.0, dim=1)   # (C,dim)
@@ -56,7 +131,7 @@ class adaptiveUPCSCLoss(nn.Module):
         pred_class = class_candidates * ~conf_mask.unsqueeze(1) + top1_class * conf_mask.unsqueeze(1)
 
         sc_weight = prob_detach * class_candidates
-        sc_proxy = (sc_weight.unsqueeze(2) * proxy).sum(dim=1)  # (B,dim)
+        sc_proxy = torch.matmul(sc_weight, proxy)  # (B,dim)
         sc_sim = (feature * sc_proxy).sum(dim=1)  # (B,)
 
         p_maxval, target = prob_detach.max(1)
@@ -64,18 +139,21 @@ class adaptiveUPCSCLoss(nn.Module):
         proxy_sim = pred[torch.arange(feature.shape[0]), target]    # (B,)
         pos_pair = proxy_sim * conf_mask + sc_sim * ~conf_mask
 
-        pred_class_1 = pred_class.unsqueeze(1)  # (B, 1, C)
-        pred_class_2 = pred_class.unsqueeze(0)  # (1, B, C)
-        intersection = (pred_class_1 & pred_class_2).any(dim=2).bool()  # (B,B)
-        neg_matrix = ~intersection
+        # Negatives are drawn from the batch and, if given, the queue
+        key_feature = feature
+        key_pred_class = pred_class
+        if queue is not None:
+            queue_feature, queue_pred_class = queue.get()
+            key_feature = torch.cat([feature, queue_feature.to(feature.dtype)], 0)
+            key_pred_class = torch.cat([pred_class, queue_pred_class], 0)
 
-        feature = torch.matmul(feature, feature.transpose(1, 0))
-        feature = feature * neg_matrix
-        neg_pair = feature.masked_fill(feature < 1e-6, -np.inf)
+        if self.block_size > 0:
+            loss = self.blocked_loss(feature, pos_pair, pred_class, key_feature, key_pred_class)
+        else:
+            loss = self.dense_loss(feature, pos_pair, pred_class, key_feature, key_pred_class)
 
-        logits = torch.cat([pos_pair.unsqueeze(1), neg_pair], dim=1)  # (N, 1+N)
-        label = torch.zeros(logits.size(0), dtype=torch.long).to(feature.device)
-        loss = F.nll_loss(F.log_softmax(self.scale * logits, dim=1), label)
+        if queue is not None:
+            queue.enqueue(feature.detach(), pred_class)
 
         if (~conf_mask).sum() != 0:
             SC_num = (class_candidates * ~conf_mask.unsqueeze(1)).sum() / (~conf_mask).sum()
@@ -84,57 +162,50 @@ class adaptiveUPCSCLoss(nn.Module):
 
         return loss, SC_num
 
-class StochasticClassifier(nn.Module):
-    def __init__(self, num_features, num_classes, temp=0.05):
-        super().__init__()
-        self.mu = nn.Parameter(0.01 * torch.randn(num_classes, num_features))
-        self.sigma = nn.Parameter(torch.zeros(num_classes, num_features))
-        self.temp = temp
-
-    def forward(self, x, stochastic=True):
-        mu = self.mu
-        sigma = self.sigma
-
-        if stochastic:
-            sigma = F.softplus(sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
-            weight = sigma * torch.randn_like(mu) + mu
-        else:
-            weight = mu
-
-        weight = F.normalize(weight, p=2, dim=1)
-        x = F.normalize(x, p=2, dim=1)
-
-        score = F.linear(x, weight)
-        score = score / self.temp
-
-        return score
-    
-    def get_proxy(self, stochastic=False):
-        mu = self.mu
-        
-        if stochastic:
-            sigma = F.softplus(self.sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
-            weight = sigma * torch.randn_like(mu) + mu
-        else:
-            weight = mu
-
-        return weight
-
-
-class NormalClassifier(nn.Module):
-    def __init__(self, num_features, num_classes, bias=True):
-        super().__init__()
-        self.linear = nn.Linear(num_features, num_classes, bias)
+    def dense_loss(self, feature, pos_pair, pred_class, key_feature, key_pred_class):
+        pred_class_1 = pred_class.unsqueeze(1)  # (B, 1, C)
+        pred_class_2 = key_pred_class.unsqueeze(0)  # (1, B+Q, C)
+        intersection = (pred_class_1 & pred_class_2).any(dim=2).bool()  # (B,B+Q)
+        neg_matrix = ~intersection
 
-    def forward(self, x, stochastic=True):
-        return self.linear(x)
-    
-    def get_proxy(self, stochastic=True):
-        return self.linear.weight
+        feature = torch.matmul(feature, key_feature.transpose(1, 0))
+        feature = feature * neg_matrix
+        neg_pair = feature.masked_fill(feature < 1e-6, -np.inf)
 
+        logits = torch.cat([pos_pair.unsqueeze(1), neg_pair], dim=1)  # (N, 1+N+Q)
+        label = torch.zeros(logits.size(0), dtype=torch.long).to(feature.device)
+        loss = F.nll_loss(F.log_softmax(self.scale * logits, dim=1), label)
+        return loss
+
+    def blocked_loss(self, feature, pos_pair, pred_class, key_feature, key_pred_class):
+        """Same loss as dense_loss() computed over row blocks.
+
+        Each block is recomputed in the backward pass, so at most a
+        (block_size, B) slice of the logits is alive at any time instead
+        of the full (B, B) matrix and the (B, B, C) class intersection.
+        """
+        pred_class = pred_class.float()
+        key_pred_class = key_pred_class.float()
+        lse = []
+        for start in range(0, feature.size(0), self.block_size):
+            end = start + self.block_size
+            lse.append(
+                checkpoint(
+                    upc_block_logsumexp,
+                    feature[start:end],
+                    key_feature,
+                    pos_pair[start:end],
+                    pred_class[start:end],
+                    key_pred_class,
+                    self.scale,
+                    use_reentrant=False,
+                )
+            )
+        lse = torch.cat(lse, dim=0)
+        return (lse - self.scale * pos_pair).mean()
 
 @TRAINER_REGISTRY.register()
-class UPCSC(TrainerXU):
+class UPCSC(ClassifierInferenceMixin, StyleTransferMixin, TrainerXU):
     """StyleMatch for semi-supervised domain generalization.
 
     Reference:
@@ -147,35 +218,21 @@ class UPCSC(TrainerXU):
         # Confidence threshold
         self.conf_thre = cfg.TRAINER.STYLEMATCH.CONF_THRE
 
-        # Inference mode: 1) deterministic 2) ensemble
-        self.inference_mode = cfg.TRAINER.STYLEMATCH.INFERENCE_MODE
-        self.n_ensemble = cfg.TRAINER.STYLEMATCH.N_ENSEMBLE
-        if self.inference_mode == "ensemble":
-            print(f"Apply ensemble (n={self.n_ensemble}) at test time")
-
-        norm_mean = None
-        norm_std = None
-
-        if "normalize" in cfg.INPUT.TRANSFORMS:
-            norm_mean = cfg.INPUT.PIXEL_MEAN
-            norm_std = cfg.INPUT.PIXEL_STD
-
-        self.adain = AdaIN(
-            cfg.TRAINER.STYLEMATCH.ADAIN_DECODER,
-            cfg.TRAINER.STYLEMATCH.ADAIN_VGG,
-            self.device,
-            norm_mean=norm_mean,
-            norm_std=norm_std,
-        )
+        self.build_inference()
 
         self.apply_aug = cfg.TRAINER.STYLEMATCH.APPLY_AUG
         self.apply_sty = cfg.TRAINER.STYLEMATCH.APPLY_STY
 
+        self.build_style_transfer()
+
         self.save_sigma = cfg.TRAINER.STYLEMATCH.SAVE_SIGMA
         self.sigma_log = {"raw": [], "std": []}
         if self.save_sigma:
             assert cfg.TRAINER.STYLEMATCH.CLASSIFIER == "stochastic"
 
+        # Encode all views with one backbone pass per step
+        self.fused_forward = cfg.TRAINER.UPCSC.FUSED_FORWARD
+
     def check_cfg(self, cfg):
         assert len(cfg.TRAINER.STYLEMATCH.STRONG_TRANSFORMS) > 0
         assert cfg.DATALOADER.TRAIN_X.SAMPLER == "SeqDomainSampler"
@@ -188,7 +245,11 @@ class UPCSC(TrainerXU):
         choices = cfg.TRAINER.STYLEMATCH.STRONG_TRANSFORMS
         tfm_train_strong = build_transform(cfg, is_train=True, choices=choices)
         custom_tfm_train += [tfm_train_strong]
-        dm = DataManager(self.cfg, custom_tfm_train=custom_tfm_train)
+        dm = DataManager(
+            self.cfg,
+            custom_tfm_train=custom_tfm_train,
+            dataset_wrapper=self.style_dataset_wrapper()
+        )
         self.train_loader_x = dm.train_loader_x
         self.train_loader_u = dm.train_loader_u
         self.val_loader = dm.val_loader
@@ -196,13 +257,24 @@ class UPCSC(TrainerXU):
         self.num_classes = dm.num_classes
         self.num_source_domains = dm.num_source_domains
         self.lab2cname = dm.lab2cname
+        self.dm = dm
 
     def build_model(self):
         cfg = self.cfg
 
         ############################
         self.dim = cfg.TRAINER.UPCSC.DIM
-        self.upcscloss = adaptiveUPCSCLoss(cfg, self.num_classes)
+        self.upcscloss = adaptiveUPCSCLoss(
+            cfg, self.num_classes, block_size=cfg.TRAINER.UPCSC.LOSS_BLOCK_SIZE
+        )
+
+        self.queue = None
+        if cfg.TRAINER.UPCSC.QUEUE_SIZE > 0:
+            print(f"Building negative queue (size={cfg.TRAINER.UPCSC.QUEUE_SIZE})")
+            self.queue = NegativeQueue(
+                cfg.TRAINER.UPCSC.QUEUE_SIZE, self.dim, self.num_classes
+            )
+            self.queue.to(self.device)
 
         ############################
 
@@ -246,6 +318,49 @@ class UPCSC(TrainerXU):
         self.sched_cP = build_lr_scheduler(self.optim_cP, cfg.TRAINER.UPCSC.P_OPTIM)
         self.register_model("cP", self.cP, self.optim_cP, self.sched_cP)
 
+        if self.queue is not None:
+            # No parameters, registered so that it is saved and resumed
+            self.register_model("queue", self.queue)
+
+        if cfg.TRAINER.UPCSC.COMPILE:
+            self.compile_models()
+
+    def compile_models(self):
+        """Replace G, C, fP, cP and the UPCSC loss with compiled versions.
+
+        torch.compile wraps the registered (eager) modules, so checkpoints
+        and train/eval switching are unaffected. The TorchScript fallback
+        returns new modules that share the parameters but not the
+        train/eval mode, so they are registered in place of the eager ones.
+
+        Compilation happens at the first calls, during training, so errors
+        are suppressed for the whole process and the graphs that fail to
+        compile run in eager mode. A TORCHINDUCTOR_CACHE_DIR set by the
+        user is kept.
+        """
+        cache_dir = os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR", compile_cache_dir(self.cfg)
+        )
+
+        if hasattr(torch, "compile"):
+            print(f"Compile G, C, fP, cP and the UPCSC loss (cache: {cache_dir})")
+            print(
+                "Graphs that fail to compile run in eager mode "
+                "(torch._dynamo.config.suppress_errors = True)"
+            )
+            torch._dynamo.config.suppress_errors = True
+            self.G = torch.compile(self.G)
+            self.C = torch.compile(self.C)
+            self.fP = torch.compile(self.fP)
+            self.cP = torch.compile(self.cP)
+            self.upcscloss = torch.compile(self.upcscloss)
+        else:
+            # C.get_proxy() and the loss are not scriptable, keep them eager
+            print("torch.compile is unavailable, script G, fP and cP instead")
+            for name in ["G", "fP", "cP"]:
+                model = script_or_eager(getattr(self, name), name)
+                setattr(self, name, model)
+                self._models[name] = model
 
     def assess_y_pred_quality(self, y_pred, y_true, mask):
         n_masked_correct = (y_pred.eq(y_true).float() * mask).sum()
@@ -255,7 +370,31 @@ class UPCSC(TrainerXU):
         output = {"acc_thre": acc_thre, "acc_raw": acc_raw, "keep_rate": keep_rate}
         return output
 
+    def pseudo_label(self, p_xu, y_u_true, K):
+        p_xu_maxval, y_xu_pred = p_xu.max(1)
+        mask_xu = (p_xu_maxval >= self.conf_thre).float()
+
+        y_xu_pred = y_xu_pred.chunk(K)
+        mask_xu = mask_xu.chunk(K)
+
+        # Calculate pseudo-label's accuracy
+        y_u_pred = []
+        mask_u = []
+        for y_xu_k_pred, mask_xu_k in zip(y_xu_pred, mask_xu):
+            y_u_pred.append(
+                y_xu_k_pred.chunk(2)[1]
+            )  # only take the 2nd half (unlabeled data)
+            mask_u.append(mask_xu_k.chunk(2)[1])
+        y_u_pred = torch.cat(y_u_pred, 0)
+        mask_u = torch.cat(mask_u, 0)
+        y_u_pred_stats = self.assess_y_pred_quality(y_u_pred, y_u_true, mask_u)
+
+        return y_xu_pred, mask_xu, y_u_pred_stats
+
     def forward_backward(self, batch_x, batch_u):
+        if self.fused_forward:
+            return self.forward_backward_fused(batch_x, batch_u)
+
         parsed_batch = self.parse_batch_train(batch_x, batch_u)
 
         x0 = parsed_batch["x0"]
@@ -286,43 +425,13 @@ class UPCSC(TrainerXU):
                 p_xu.append(p_xu_k)
             p_xu = torch.cat(p_xu, 0)
 
-            p_xu_maxval, y_xu_pred = p_xu.max(1)
-            mask_xu = (p_xu_maxval >= self.conf_thre).float()
-
-            y_xu_pred = y_xu_pred.chunk(K)
-            mask_xu = mask_xu.chunk(K)
-
-            # Calculate pseudo-label's accuracy
-            y_u_pred = []
-            mask_u = []
-            for y_xu_k_pred, mask_xu_k in zip(y_xu_pred, mask_xu):
-                y_u_pred.append(
-                    y_xu_k_pred.chunk(2)[1]
-                )  # only take the 2nd half (unlabeled data)
-                mask_u.append(mask_xu_k.chunk(2)[1])
-            y_u_pred = torch.cat(y_u_pred, 0)
-            mask_u = torch.cat(mask_u, 0)
-            y_u_pred_stats = self.assess_y_pred_quality(y_u_pred, y_u_true, mask_u)
+            y_xu_pred, mask_xu, y_u_pred_stats = self.pseudo_label(p_xu, y_u_true, K)
 
         ####################
         # Generate style transferred images
         ####################
         if self.apply_sty:
-            xu_sty = []
-            for k in range(K):
-                # Content
-                x_k = x0[k]
-                u_k = u0[k]
-                xu_k = torch.cat([x_k, u_k], 0)
-                # Style
-                other_domains = [i for i in range(K) if i != k]
-                k2 = random.choice(other_domains)
-                x_k2 = x0[k2]
-                u_k2 = u0[k2]
-                xu_k2 = torch.cat([x_k2, u_k2], 0)
-                # Transfer
-                xu_k_sty = self.adain(xu_k, xu_k2)
-                xu_sty.append(xu_k_sty)
+            xu_sty = self.transfer_style(parsed_batch, K)
 
         ####################
         # Supervised loss
@@ -408,9 +517,116 @@ class UPCSC(TrainerXU):
         conf_mask = torch.cat(conf_mask, dim=0).bool()
         
         
-        loss_upcsc, SC_num = self.upcscloss(rep, self.cP, self.C, rep_p, conf_mask)
-                
+        loss_upcsc, SC_num = self.upcscloss(
+            rep, self.cP, self.C, rep_p, conf_mask, queue=self.queue
+        )
+
+        return self.update_and_summarize(
+            loss_x, loss_upcsc, loss_u_aug, loss_u_sty, SC_num, y_u_pred_stats
+        )
+
+    def forward_backward_fused(self, batch_x, batch_u):
+        """Same objective as forward_backward() with a single backbone
+        pass per gradient mode.
+
+        The weak views of x and u are encoded once without grad to get
+        pseudo labels. The weak, strong and style views are then stacked
+        into one batch and encoded once with grad, and the features are
+        sliced back out for the supervised, pseudo-label and UPCSC losses.
+
+        Note that batch norm statistics are computed over the fused batch
+        instead of per domain, and the stochastic classifier draws one
+        weight sample per step instead of one per domain and view.
+        """
+        parsed_batch = self.parse_batch_train(batch_x, batch_u)
+
+        x0 = parsed_batch["x0"]
+        x = parsed_batch["x"]
+        x_aug = parsed_batch["x_aug"]
+        y_x_true = parsed_batch["y_x_true"]
+
+        u0 = parsed_batch["u0"]
+        u = parsed_batch["u"]
+        u_aug = parsed_batch["u_aug"]
+        y_u_true = parsed_batch["y_u_true"]  # tensor
+
+        K = self.num_source_domains
+        # NOTE: If num_source_domains=1, we split a batch into two halves
+        K = 2 if K == 1 else K
+
+        # Every view is laid out as [x_1, u_1, x_2, u_2, ...] so that
+        # chunk(K) gives the domains and chunk(2) splits x from u
+        def split_x(t):
+            return torch.cat([t_k.chunk(2)[0] for t_k in t.chunk(K)], 0)
+
+        def split_u(t):
+            return torch.cat([t_k.chunk(2)[1] for t_k in t.chunk(K)], 0)
+
+        xu = torch.cat([torch.cat([x[k], u[k]], 0) for k in range(K)], 0)
+
+        ####################
+        # Generate pseudo labels
+        ####################
+        with torch.no_grad():
+            p_xu = F.softmax(self.C(self.G(xu), stochastic=False), 1)
+            y_xu_pred, mask_xu, y_u_pred_stats = self.pseudo_label(p_xu, y_u_true, K)
+
+        ####################
+        # Encode all views at once
+        ####################
+        views = [xu]
+        if self.apply_aug:
+            views.append(
+                torch.cat([torch.cat([x_aug[k], u_aug[k]], 0) for k in range(K)], 0)
+            )
+        if self.apply_sty:
+            views.append(torch.cat(self.transfer_style(parsed_batch, K), 0))
+
+        f_views = self.G(torch.cat(views, 0)).split(xu.size(0))
+        z_views = self.C(torch.cat(f_views, 0), stochastic=True).split(xu.size(0))
+
+        ####################
+        # Supervised loss
+        ####################
+        loss_x = 0
+        for z_x_k, y_x_k_true in zip(split_x(z_views[0]).chunk(K), y_x_true):
+            loss_x += F.cross_entropy(z_x_k, y_x_k_true)
+
+        ####################
+        # Unsupervised loss
+        ####################
+        def unsup_loss(z_xu):
+            loss_u = 0
+            for z_xu_k, y_xu_k_pred, mask_xu_k in zip(z_xu.chunk(K), y_xu_pred, mask_xu):
+                loss = F.cross_entropy(z_xu_k, y_xu_k_pred, reduction="none")
+                loss_u += (loss * mask_xu_k).mean()
+            return loss_u
+
+        loss_u_aug = 0
+        loss_u_sty = 0
+        if self.apply_aug:
+            loss_u_aug = unsup_loss(z_views[1])
+        if self.apply_sty:
+            loss_u_sty = unsup_loss(z_views[-1])
+
+        ########## UPCSC ##########
+        # Weak, strong and style views in this order, as in forward_backward()
+        n_view = len(f_views)
+        rep = self.fP(torch.cat([split_u(f) for f in f_views], 0))
+        rep_p = split_u(p_xu).repeat(n_view, 1)
+        conf_mask = split_u(torch.cat(mask_xu, 0)).repeat(n_view).bool()
+
+        loss_upcsc, SC_num = self.upcscloss(
+            rep, self.cP, self.C, rep_p, conf_mask, queue=self.queue
+        )
+
+        return self.update_and_summarize(
+            loss_x, loss_upcsc, loss_u_aug, loss_u_sty, SC_num, y_u_pred_stats
+        )
 
+    def update_and_summarize(
+        self, loss_x, loss_upcsc, loss_u_aug, loss_u_sty, SC_num, y_u_pred_stats
+    ):
         loss_summary = {}
 
         loss_all = 0
@@ -494,31 +710,17 @@ class UPCSC(TrainerXU):
             "y_u_true": y_u_true,  # kept intact
         }
 
-        return batch
-
-    def model_inference(self, input):
-        features = self.G(input)
-
-        if self.inference_mode == "deterministic":
-            prediction = self.C(features, stochastic=False)
-
-        elif self.inference_mode == "ensemble":
-            prediction = 0
-            for _ in range(self.n_ensemble):
-                prediction += self.C(features, stochastic=True)
-            prediction = prediction / self.n_ensemble
+        batch.update(self.parse_batch_style(batch_x, batch_u, K))
 
-        else:
-            raise NotImplementedError
-
-        return prediction
+        return batch
 
     def after_epoch(self):
         if (self.epoch+1) % 5 == 0 and (self.epoch+1) != self.cfg.OPTIM.MAX_EPOCH:
-            self.test()
+            self.test_in_background(subset=True)
             
     def after_train(self):
         print("Finish training")
+        self.collect_tests(wait=True)
 
         # Do testing
         if not self.cfg.TEST.NO_TEST:
@@ -1,11 +1,19 @@
 """
 Credit to: https://github.com/naoto0804/pytorch-AdaIN
 """
+import copy
 import torch
 import torch.nn as nn
+from tqdm import tqdm
+
+from dassl.data.data_manager import build_data_loader
+from dassl.data.transforms import build_transform
 
 from .net import decoder, vgg
-from .function import adaptive_instance_normalization
+from .function import (
+    calc_mean_std, adaptive_instance_normalization_from_stats,
+    adaptive_instance_normalization_mix
+)
 
 
 class UndoNorm:
@@ -18,13 +26,12 @@ class UndoNorm:
     def __call__(self, tensor):
         """
         Input:
-            tensor (torch.Tensor): tensor image of size (B, C, H, W)
+            tensor (torch.Tensor): tensor image of size (B, C, H, W), left
+                unchanged as it is the caller's, e.g. a test batch
         """
-        tensor = tensor.permute(1, 0, 2, 3)  # to (C, B, H, W)
-        for t, m, s in zip(tensor, self.mean, self.std):
-            t.mul_(s).add_(m)
-        tensor = tensor.permute(1, 0, 2, 3)  # to (B, C, H, W)
-        return tensor
+        mean = tensor.new_tensor(self.mean).view(1, -1, 1, 1)
+        std = tensor.new_tensor(self.std).view(1, -1, 1, 1)
+        return tensor*std + mean
 
 
 class Norm:
@@ -119,25 +126,51 @@ class AdaIN:
         for param in self.decoder.parameters():
             param.requires_grad = False
 
-    def __call__(self, content, style, alpha=None):
+    @torch.no_grad()
+    def encode_style(self, style):
+        """Compute the relu4_1 channel statistics of a style minibatch.
+
+        Input:
+            style (torch.Tensor): style minibatch of size (B, C, H, W)
+
+        Returns:
+            mean and std, each of size (B, 512, 1, 1)
+        """
+        if self.undo_norm is not None:
+            # Map pixel values to [0, 1]
+            style = self.undo_norm(style)
+
+        # Under autocast the encoder runs in reduced precision, while the
+        # channel statistics are computed in fp32 to avoid overflow
+        return calc_mean_std(self.vgg(style).float())
+
+    @torch.no_grad()
+    def __call__(self, content, style=None, alpha=None, style_stats=None):
         """
         Input:
             content (torch.Tensor): content minibatch of size (B, C, H, W)
-            style (torch.Tensor): style minibatch of size (B, C, H, W)
+            style (torch.Tensor, optional): style minibatch of size (B, C, H, W)
             alpha (float, optional): interpolation parameter within (0, 1]
+            style_stats (tuple, optional): precomputed (mean, std) of the style
+                features, e.g. from a StyleBank, used instead of style
         """
         vgg = self.vgg
         decoder = self.decoder
         alpha = self.alpha if alpha is None else alpha
+        dtype = content.dtype
+
+        if style_stats is None:
+            style_stats = self.encode_style(style)
+        style_mean, style_std = style_stats
 
         if self.undo_norm is not None:
             # Map pixel values to [0, 1]
             content = self.undo_norm(content)
-            style = self.undo_norm(style)
 
-        content_f = vgg(content)
-        style_f = vgg(style)
-        feat = adaptive_instance_normalization(content_f, style_f)
+        content_f = vgg(content).float()
+        feat = adaptive_instance_normalization_from_stats(
+            content_f, style_mean, style_std
+        )
         feat = feat * alpha + content_f * (1 - alpha)
         stylized = decoder(feat)
 
@@ -145,4 +178,254 @@ class AdaIN:
             # Normalize pixel values
             stylized = self.norm(stylized)
 
-        return stylized
+        return stylized.to(dtype)
+
+
+def fold_normalization(vgg, decoder, mean, std):
+    """Fold input normalization into the encoder and output
+    normalization into the decoder, in place.
+
+    The encoder starts with a 1x1 conv, so undoing the normalization
+    x = z * std + mean before it is an affine map on its input channels.
+    Likewise normalizing (y - mean) / std after the last decoder conv is an
+    affine map on its output channels.
+    """
+    mean = torch.tensor(mean, dtype=torch.float32)
+    std = torch.tensor(std, dtype=torch.float32)
+
+    first = vgg[0]
+    assert isinstance(first, nn.Conv2d) and first.kernel_size == (1, 1)
+    weight = first.weight.data.float()
+    first.bias.data += (weight.flatten(1) @ mean.to(weight.device)).to(first.bias.dtype)
+    first.weight.data *= std.to(weight.device).view(1, -1, 1, 1).to(first.weight.dtype)
+
+    last = decoder[-1]
+    assert isinstance(last, nn.Conv2d)
+    mean = mean.to(last.weight.device)
+    std = std.to(last.weight.device)
+    last.weight.data /= std.view(-1, 1, 1, 1).to(last.weight.dtype)
+    last.bias.data = ((last.bias.data.float() - mean) / std).to(last.bias.dtype)
+
+
+def merge_reflection_padding(model):
+    """Return a copy of a Sequential model in which every ReflectionPad2d
+    followed by a conv is replaced by the conv with reflect padding, and
+    ReLUs are made in place."""
+    layers = []
+    children = list(model.children())
+    i = 0
+    while i < len(children):
+        layer = children[i]
+        following = children[i + 1] if i + 1 < len(children) else None
+        if (
+            isinstance(layer, nn.ReflectionPad2d)
+            and isinstance(following, nn.Conv2d)
+            and following.padding == (0, 0)
+            and len(set(layer.padding)) == 1
+        ):
+            conv = nn.Conv2d(
+                following.in_channels,
+                following.out_channels,
+                following.kernel_size,
+                stride=following.stride,
+                padding=layer.padding[0],
+                padding_mode="reflect",
+                bias=following.bias is not None,
+            ).to(following.weight.device)
+            conv.load_state_dict(following.state_dict())
+            layers.append(conv)
+            i += 2
+            continue
+        if isinstance(layer, nn.ReLU):
+            layer = nn.ReLU(inplace=True)
+        layers.append(layer)
+        i += 1
+    return nn.Sequential(*layers)
+
+
+class FastAdaIN(AdaIN):
+    """AdaIN for inference.
+
+    Same output as AdaIN (up to the chosen precision), faster:
+        - Norm/UndoNorm are folded into the first encoder conv and the
+        last decoder conv.
+        - Reflection padding is done by the convs themselves.
+        - The encoder and decoder run in channels_last, in fp32, fp16 or
+        bf16.
+        - The alpha interpolation and AdaIN are a single affine map on
+        the content features.
+    """
+
+    def __init__(
+        self,
+        decoder_weights,
+        vgg_weights,
+        device,
+        alpha=0.5,
+        norm_mean=None,
+        norm_std=None,
+        precision="fp32",
+    ):
+        """
+        Args:
+            precision (str, optional): fp32, fp16 or bf16. fp16 requires cuda.
+            See AdaIN for the other arguments.
+        """
+        assert precision in ["fp32", "fp16", "bf16"]
+        if precision == "fp16":
+            assert device.type == "cuda", "fp16 style transfer requires cuda"
+        self.dtype = {
+            "fp32": torch.float32,
+            "fp16": torch.float16,
+            "bf16": torch.bfloat16,
+        }[precision]
+        self.norm_mean = norm_mean
+        self.norm_std = norm_std
+        super().__init__(
+            decoder_weights,
+            vgg_weights,
+            device,
+            alpha=alpha,
+            norm_mean=norm_mean,
+            norm_std=norm_std,
+        )
+
+    def build_models(self, decoder_weights, vgg_weights):
+        super().build_models(decoder_weights, vgg_weights)
+
+        # The modules from net.py are shared by all AdaIN instances
+        self.vgg = copy.deepcopy(self.vgg)
+        self.decoder = copy.deepcopy(self.decoder)
+
+        if self.norm_mean is not None and self.norm_std is not None:
+            fold_normalization(self.vgg, self.decoder, self.norm_mean, self.norm_std)
+
+        self.vgg = merge_reflection_padding(self.vgg)
+        self.decoder = merge_reflection_padding(self.decoder)
+
+        for model in [self.vgg, self.decoder]:
+            model.to(dtype=self.dtype, memory_format=torch.channels_last)
+            model.requires_grad_(False)
+
+    def _to_engine(self, x):
+        return x.to(dtype=self.dtype, memory_format=torch.channels_last)
+
+    @torch.no_grad()
+    def encode_style(self, style):
+        with torch.autocast(self.device.type, enabled=False):
+            return calc_mean_std(self.vgg(self._to_engine(style)).float())
+
+    @torch.no_grad()
+    def __call__(self, content, style=None, alpha=None, style_stats=None):
+        alpha = self.alpha if alpha is None else alpha
+        dtype = content.dtype
+
+        if style_stats is None:
+            style_stats = self.encode_style(style)
+        style_mean, style_std = style_stats
+
+        # The engine precision is fixed, whatever the caller's autocast state
+        with torch.autocast(self.device.type, enabled=False):
+            content_f = self.vgg(self._to_engine(content))
+            feat = adaptive_instance_normalization_mix(
+                content_f, style_mean, style_std, alpha
+            )
+            stylized = self.decoder(feat)
+
+        return stylized.to(dtype, memory_format=torch.contiguous_format)
+
+
+def build_adain(cfg, device):
+    """Build the style transfer model of TRAINER.STYLEMATCH."""
+    norm_mean = None
+    norm_std = None
+
+    if "normalize" in cfg.INPUT.TRANSFORMS:
+        norm_mean = cfg.INPUT.PIXEL_MEAN
+        norm_std = cfg.INPUT.PIXEL_STD
+
+    if cfg.TRAINER.STYLEMATCH.ADAIN_FAST:
+        return FastAdaIN(
+            cfg.TRAINER.STYLEMATCH.ADAIN_DECODER,
+            cfg.TRAINER.STYLEMATCH.ADAIN_VGG,
+            device,
+            norm_mean=norm_mean,
+            norm_std=norm_std,
+            precision=cfg.TRAINER.STYLEMATCH.ADAIN_PRECISION,
+        )
+
+    return AdaIN(
+        cfg.TRAINER.STYLEMATCH.ADAIN_DECODER,
+        cfg.TRAINER.STYLEMATCH.ADAIN_VGG,
+        device,
+        norm_mean=norm_mean,
+        norm_std=norm_std,
+    )
+
+
+def build_style_data_loader(cfg, dataset):
+    """Sequential test-time loader over the labeled and unlabeled
+    training images, each image once."""
+    # train_u may already contain train_x
+    data_source = dataset.train_x + dataset.train_u
+    data_source = list({item.impath: item for item in data_source}.values())
+    return build_data_loader(
+        cfg,
+        sampler_type="SequentialSampler",
+        data_source=data_source,
+        batch_size=cfg.DATALOADER.TEST.BATCH_SIZE,
+        tfm=build_transform(cfg, is_train=False),
+        is_train=False,
+    )
+
+
+class StyleBank:
+    """Per-domain bank of style statistics.
+
+    Every image is encoded once, and the relu4_1 channel mean/std are kept
+    (in fp16 on the CPU) so that style can be drawn from a whole domain
+    without running the encoder on a style minibatch.
+    """
+
+    def __init__(self, adain, data_loader, dtype=torch.float16):
+        """
+        Args:
+            adain (AdaIN): style transfer model used to encode the images
+            data_loader (DataLoader): yields dicts with "img" and "domain"
+            dtype (torch.dtype, optional): storage type of the statistics
+        """
+        print("Building style bank")
+        means, stds, domains = [], [], []
+
+        for batch in tqdm(data_loader):
+            mean, std = adain.encode_style(batch["img"].to(adain.device))
+            means.append(mean.flatten(1).to("cpu", dtype))
+            stds.append(std.flatten(1).to("cpu", dtype))
+            domains.append(batch["domain"])
+
+        self.mean = torch.cat(means)  # (N, 512)
+        self.std = torch.cat(stds)  # (N, 512)
+        domains = torch.cat(domains)
+
+        self.domain_idxs = {}
+        for domain in domains.unique().tolist():
+            self.domain_idxs[domain] = (domains == domain).nonzero().flatten()
+            print(f"* domain {domain}: {len(self.domain_idxs[domain]):,} styles")
+
+    def sample(self, domain, n, device):
+        """Draw n random (mean, std) pairs of the given domain."""
+        idxs = self.domain_idxs[domain]
+        idxs = idxs[torch.randint(len(idxs), (n, ))]
+        mean = self.mean[idxs].to(device).float()[:, :, None, None]
+        std = self.std[idxs].to(device).float()[:, :, None, None]
+        return mean, std
+
+    def domain_styles(self, device):
+        """Return the average (mean, std) of each domain, of size
+        (1, 512, 1, 1) each."""
+        styles = []
+        for domain, idxs in sorted(self.domain_idxs.items()):
+            mean = self.mean[idxs].float().mean(0).to(device)
+            std = self.std[idxs].float().mean(0).to(device)
+            styles.append((mean[None, :, None, None], std[None, :, None, None]))
+        return styles
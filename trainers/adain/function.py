@@ -17,8 +17,13 @@ def calc_mean_std(feat, eps=1e-5):
 
 def adaptive_instance_normalization(content_feat, style_feat):
     assert content_feat.size()[:2] == style_feat.size()[:2]
-    size = content_feat.size()
     style_mean, style_std = calc_mean_std(style_feat)
+    return adaptive_instance_normalization_from_stats(content_feat, style_mean, style_std)
+
+
+def adaptive_instance_normalization_from_stats(content_feat, style_mean, style_std):
+    # style_mean and style_std are (N, C, 1, 1) as returned by calc_mean_std()
+    size = content_feat.size()
     content_mean, content_std = calc_mean_std(content_feat)
 
     normalized_feat = (content_feat - content_mean.expand(size)) / content_std.expand(
@@ -27,6 +32,22 @@ def adaptive_instance_normalization(content_feat, style_feat):
     return normalized_feat * style_std.expand(size) + style_mean.expand(size)
 
 
+def adaptive_instance_normalization_mix(content_feat, style_mean, style_std, alpha):
+    """adaptive_instance_normalization_from_stats() interpolated with the
+    content features by alpha, written as a single affine map
+    content_feat * scale + shift with per-channel scale and shift.
+
+    The statistics are computed in fp32 whatever the dtype of content_feat.
+    """
+    content_mean, content_std = calc_mean_std(content_feat.float())
+    ratio = style_std / content_std
+    scale = alpha * ratio + (1 - alpha)
+    shift = alpha * (style_mean - content_mean * ratio)
+    return torch.addcmul(
+        shift.to(content_feat.dtype), content_feat, scale.to(content_feat.dtype)
+    )
+
+
 def _calc_feat_flatten_mean_std(feat):
     # takes 3D feat (C, H, W), return mean and std of array within channels
     assert feat.size()[0] == 3
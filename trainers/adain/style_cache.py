@@ -0,0 +1,262 @@
+"""
+Offline cache of stylized training images.
+
+Each training image is stylized toward every other source domain a few
+times and the results are stored as JPEG bytes in a single file, so that
+training only pays a read and a decode instead of a VGG/decoder pass.
+"""
+import io
+import os
+import random
+import hashlib
+import os.path as osp
+import functools
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from dassl.data import DatasetWrapper
+from dassl.utils import mkdir_if_missing
+
+from .adain import StyleBank, build_style_data_loader
+
+
+@functools.lru_cache(maxsize=None)
+def file_md5(fpath):
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def style_cache_key(cfg):
+    """Hash of everything the rendered images depend on."""
+    stylematch_cfg = cfg.TRAINER.STYLEMATCH
+    key = [
+        file_md5(stylematch_cfg.ADAIN_DECODER),
+        file_md5(stylematch_cfg.ADAIN_VGG),
+        str(cfg.DATASET.NAME),
+        str(list(cfg.DATASET.SOURCE_DOMAINS)),
+        str(list(cfg.INPUT.SIZE)),
+        str(cfg.INPUT.INTERPOLATION),
+        str(stylematch_cfg.STYLE_CACHE_N),
+        "relpath",  # index keyed by paths relative to DATASET.ROOT
+    ]
+    return hashlib.md5("|".join(key).encode()).hexdigest()[:16]
+
+
+class StyleCache:
+    """On-disk store of pre-rendered stylized images.
+
+    The store is a directory named after style_cache_key() that holds
+    data.bin (JPEG bytes of all variants back to back) and index.npz
+    (image paths relative to DATASET.ROOT, the range of variants of each
+    image and the byte offsets of each variant).
+    """
+
+    def __init__(self, directory, root):
+        self.directory = directory
+        self.root = root
+        self.data_path = osp.join(directory, "data.bin")
+        self.index_path = osp.join(directory, "index.npz")
+        self._data = None
+        self._index = None
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        cache_dir = osp.abspath(osp.expanduser(cfg.TRAINER.STYLEMATCH.STYLE_CACHE))
+        root = osp.abspath(osp.expanduser(cfg.DATASET.ROOT))
+        return cls(osp.join(cache_dir, style_cache_key(cfg)), root)
+
+    def exists(self):
+        return osp.exists(self.data_path) and osp.exists(self.index_path)
+
+    def _load(self):
+        # Opened lazily so that each data-loader worker maps its own copy
+        index = np.load(self.index_path)
+        self._index = {impath: i for i, impath in enumerate(index["impaths"])}
+        self._variant_ptr = index["variant_ptr"]
+        self._offsets = index["offsets"]
+        self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+
+    def _key(self, impath):
+        # The cache can be moved along with the dataset
+        return osp.relpath(impath, self.root)
+
+    def __contains__(self, impath):
+        if self._data is None:
+            self._load()
+        return self._key(impath) in self._index
+
+    def read(self, impath, variant=None):
+        """Return one stylized variant of an image as a PIL image.
+
+        A random variant is picked when variant is None.
+        """
+        if self._data is None:
+            self._load()
+        i = self._index[self._key(impath)]
+        start, end = self._variant_ptr[i], self._variant_ptr[i + 1]
+        j = random.randrange(start, end) if variant is None else start + variant
+        buf = self._data[self._offsets[j]:self._offsets[j + 1]]
+        return Image.open(io.BytesIO(buf.tobytes())).convert("RGB")
+
+    def writer(self):
+        """Return a StyleCacheWriter that fills the store."""
+        return StyleCacheWriter(self)
+
+
+class StyleCacheWriter:
+    """Write a StyleCache image by image.
+
+    The JPEG bytes go straight to data.bin.tmp, only the index is kept in
+    memory. Used as a context manager, the store is only exposed once it
+    is complete, and the partial file is removed on error.
+    """
+
+    def __init__(self, cache):
+        mkdir_if_missing(cache.directory)
+        self.cache = cache
+        self.impaths = []
+        self.variant_ptr = [0]
+        self.offsets = [0]
+        self.data_tmp = cache.data_path + ".tmp"
+        self.file = open(self.data_tmp, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.data_tmp)
+
+    @property
+    def num_variants(self):
+        return len(self.offsets) - 1
+
+    def add(self, impath, buffers):
+        """Append the variants of an image.
+
+        Args:
+            impath (str): absolute image path.
+            buffers (list): JPEG-encoded bytes of each variant.
+        """
+        for buf in buffers:
+            self.file.write(buf)
+            self.offsets.append(self.offsets[-1] + len(buf))
+        self.variant_ptr.append(self.variant_ptr[-1] + len(buffers))
+        self.impaths.append(impath)
+
+    def close(self):
+        self.file.close()
+
+        cache = self.cache
+        index_tmp = cache.index_path + ".tmp"
+        with open(index_tmp, "wb") as f:
+            np.savez(
+                f,
+                impaths=np.array([cache._key(impath) for impath in self.impaths]),
+                variant_ptr=np.array(self.variant_ptr, dtype=np.int64),
+                offsets=np.array(self.offsets, dtype=np.int64),
+            )
+
+        # Only expose the store once both files are complete
+        os.replace(self.data_tmp, cache.data_path)
+        os.replace(index_tmp, cache.index_path)
+
+
+def to_jpeg(images, quality=95):
+    """Encode a uint8 tensor of size (B, H, W, 3) to a list of JPEG bytes."""
+    out = []
+    for img in images.numpy():
+        buf = io.BytesIO()
+        Image.fromarray(img).save(buf, format="JPEG", quality=quality)
+        out.append(buf.getvalue())
+    return out
+
+
+def render_style_cache(cfg, adain, dataset, cache):
+    """Stylize every training image toward each other source domain.
+
+    Args:
+        cfg (CfgNode): config.
+        adain (AdaIN): style transfer model.
+        dataset (DatasetBase): dataset providing train_x and train_u.
+        cache (StyleCache): store to write.
+    """
+    n_variants = cfg.TRAINER.STYLEMATCH.STYLE_CACHE_N
+    print(f"Rendering style cache to {cache.directory}")
+
+    data_loader = build_style_data_loader(cfg, dataset)
+    style_bank = StyleBank(adain, data_loader)
+    domains = sorted(style_bank.domain_idxs.keys())
+
+    with cache.writer() as writer:
+        for batch in tqdm(data_loader):
+            content = batch["img"].to(adain.device)
+            domain = batch["domain"]
+            buffers = [[] for _ in range(content.size(0))]
+
+            for d in domains:
+                # With a single source domain, style comes from the same domain
+                mask = domain != d if len(domains) > 1 else torch.ones_like(domain).bool()
+                idxs = mask.nonzero().flatten().tolist()
+                if not idxs:
+                    continue
+
+                for _ in range(n_variants):
+                    style_stats = style_bank.sample(d, len(idxs), adain.device)
+                    stylized = adain(content[mask.to(content.device)], style_stats=style_stats)
+                    if adain.undo_norm is not None:
+                        stylized = adain.undo_norm(stylized)
+                    stylized = stylized.clamp(0, 1).mul(255).round().byte()
+                    stylized = stylized.permute(0, 2, 3, 1).cpu()
+                    for i, buf in zip(idxs, to_jpeg(stylized)):
+                        buffers[i].append(buf)
+
+            # Written batch by batch, only the offsets are kept in memory
+            for impath, buffers_i in zip(batch["impath"], buffers):
+                writer.add(impath, buffers_i)
+
+    print(f"Saved {writer.num_variants:,} stylized images")
+
+
+def build_style_cache(cfg, adain, dataset):
+    """Return the style cache of this config, rendering it if missing."""
+    cache = StyleCache.from_cfg(cfg)
+    if not cache.exists():
+        render_style_cache(cfg, adain, dataset, cache)
+    else:
+        print(f"Found style cache at {cache.directory}")
+    return cache
+
+
+class StyleCacheDatasetWrapper(DatasetWrapper):
+    """DatasetWrapper that also returns a random pre-rendered stylized view
+    ("img_sty") of each training image."""
+
+    def __init__(
+        self, cfg, data_source, transform=None, is_train=False, image_cache=None
+    ):
+        super().__init__(
+            cfg,
+            data_source,
+            transform=transform,
+            is_train=is_train,
+            image_cache=image_cache
+        )
+        self.style_cache = StyleCache.from_cfg(cfg) if is_train else None
+
+    def __getitem__(self, idx):
+        output = super().__getitem__(idx)
+
+        if self.style_cache is not None:
+            img_sty = self.style_cache.read(output["impath"])
+            output["img_sty"] = self.to_tensor(img_sty)
+
+        return output
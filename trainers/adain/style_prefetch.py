@@ -0,0 +1,132 @@
+"""
+Style transfer for upcoming batches, run in the background.
+
+Stylizing step t+1 does not depend on the weights updated at step t, so
+a producer thread can run AdaIN on the next batches (on its own CUDA
+stream when training on GPU) while the current step runs forward and
+backward. The time per step then tends to max(style, train) instead of
+their sum.
+"""
+import queue
+import threading
+import torch
+
+
+class _Error:
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class StylePrefetcher:
+    """Add stylized views to (batch_x, batch_u) pairs ahead of time.
+
+    The stylized views are stored as "img_sty" in batch_x and batch_u,
+    already on the device, which is the same layout used by the style
+    cache so that parse_batch_train() picks them up unchanged.
+
+    Args:
+        transfer_fn (callable): maps (x0, u0) tensors of size (B, C, H, W)
+            on the device to (x_sty, u_sty).
+        device (torch.device): device on which style transfer runs.
+        depth (int): number of stylized batches kept ready.
+        autocast (callable, optional): returns the autocast context used
+            by the trainer. Autocast state is per thread so it has to be
+            entered again in the producer.
+    """
+
+    _END = object()
+
+    def __init__(self, transfer_fn, device, depth=1, autocast=None):
+        self.transfer_fn = transfer_fn
+        self.device = device
+        self.depth = depth
+        self.autocast = autocast
+        self.stream = None
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+
+    def __call__(self, batches):
+        """Wrap an iterable of (batch_x, batch_u) pairs."""
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        thread = threading.Thread(
+            target=self._produce, args=(batches, buffer, stop), daemon=True
+        )
+        thread.start()
+
+        try:
+            while True:
+                item = buffer.get()
+                if item is self._END:
+                    break
+                if isinstance(item, _Error):
+                    raise item.exc
+                yield self._consume(*item)
+        finally:
+            # Unblock the producer if the consumer stops early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    buffer.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
+
+    def _produce(self, batches, buffer, stop):
+        try:
+            for batch_x, batch_u in batches:
+                if stop.is_set():
+                    return
+                item = self._stylize(batch_x, batch_u)
+                while not stop.is_set():
+                    try:
+                        buffer.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            buffer.put(_Error(e))
+            return
+        buffer.put(self._END)
+
+    @torch.no_grad()
+    def _stylize(self, batch_x, batch_u):
+        event = None
+        if self.stream is not None:
+            torch.cuda.set_device(self.device)
+            # img0 may have been copied to the device on another stream,
+            # e.g. by DevicePrefetcher, which made the current stream wait
+            # for the copies
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                x_sty, u_sty = self._transfer(batch_x, batch_u)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        else:
+            x_sty, u_sty = self._transfer(batch_x, batch_u)
+        return batch_x, batch_u, x_sty, u_sty, event
+
+    def _transfer(self, batch_x, batch_u):
+        x0 = batch_x["img0"].to(self.device, non_blocking=True)
+        u0 = batch_u["img0"].to(self.device, non_blocking=True)
+        if self.stream is not None:
+            # Keep their memory alive until the style stream is done
+            x0.record_stream(self.stream)
+            u0.record_stream(self.stream)
+        if self.autocast is None:
+            return self.transfer_fn(x0, u0)
+        with self.autocast():
+            return self.transfer_fn(x0, u0)
+
+    def _consume(self, batch_x, batch_u, x_sty, u_sty, event):
+        if event is not None:
+            # Make the training stream wait for the stylized views and
+            # keep their memory alive until it is done with them
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            x_sty.record_stream(current_stream)
+            u_sty.record_stream(current_stream)
+        batch_x["img_sty"] = x_sty
+        batch_u["img_sty"] = u_sty
+        return batch_x, batch_u
@@ -0,0 +1,158 @@
+"""
+Style transfer of training batches, shared by the StyleMatch trainers.
+"""
+import random
+import torch
+
+from .adain import StyleBank, build_adain, build_style_data_loader
+from .style_cache import StyleCacheDatasetWrapper, build_style_cache
+from .style_prefetch import StylePrefetcher
+
+
+class StyleTransferMixin:
+    """Stylize the img0 views of (batch_x, batch_u) toward other source
+    domains with AdaIN (TRAINER.STYLEMATCH).
+
+    The style comes from another domain of the minibatch, from a StyleBank
+    of whole domains (STYLE_BANK) or from pre-rendered images read by the
+    data loaders (STYLE_CACHE). With STYLE_PREFETCH, upcoming batches are
+    stylized in the background. With "adain" in TEST.TTA, the test images
+    are also restyled toward each source domain, see restyle_views().
+
+    To be mixed in before TrainerXU. The trainer calls build_style_transfer()
+    in __init__(), passes style_dataset_wrapper() to its DataManager and
+    adds parse_batch_style() to its parsed batch.
+    """
+
+    # Set by build_style_transfer()
+    style_bank = None
+    style_prefetcher = None
+    tta_styles = None
+
+    def style_dataset_wrapper(self):
+        """Dataset wrapper of the data loaders, None for the default one."""
+        cfg = self.cfg.TRAINER.STYLEMATCH
+        if cfg.APPLY_STY and cfg.STYLE_CACHE:
+            return StyleCacheDatasetWrapper
+        return None
+
+    def build_style_transfer(self):
+        cfg = self.cfg
+        apply_sty = cfg.TRAINER.STYLEMATCH.APPLY_STY
+        use_cache = apply_sty and cfg.TRAINER.STYLEMATCH.STYLE_CACHE
+
+        self.adain = build_adain(cfg, self.device)
+
+        if use_cache:
+            # Stylized views are read from disk by the data loaders
+            build_style_cache(cfg, self.adain, self.dm.dataset)
+        elif apply_sty and cfg.TRAINER.STYLEMATCH.STYLE_BANK:
+            self.style_bank = self.build_style_bank()
+
+        style_prefetch = cfg.TRAINER.STYLEMATCH.STYLE_PREFETCH
+        if apply_sty and not use_cache and style_prefetch > 0:
+            # Stylize upcoming batches while the current step is running
+            self.style_prefetcher = StylePrefetcher(
+                self.transfer_style_ahead,
+                self.device,
+                depth=style_prefetch,
+                autocast=self.autocast,
+            )
+
+        self.build_tta_styles()
+
+    def build_tta_styles(self):
+        """Average style of each source domain, for restyle_views()."""
+        cfg = self.cfg
+        if "adain" not in cfg.TEST.TTA:
+            return
+
+        device = cfg.TEST.BACKGROUND_DEVICE
+        if cfg.TEST.BACKGROUND and device and torch.device(device) != self.device:
+            raise ValueError(
+                "The adain test-time augmentation runs on the training "
+                "device, it cannot be used with TEST.BACKGROUND_DEVICE"
+            )
+
+        style_bank = self.style_bank
+        if style_bank is None:
+            style_bank = self.build_style_bank()
+        self.tta_styles = style_bank.domain_styles(self.device)
+
+    def build_tta(self, extra_views=None):
+        views = {"adain": self.restyle_views}
+        if extra_views is not None:
+            views.update(extra_views)
+        return super().build_tta(views)
+
+    def restyle_views(self, input):
+        """TTA views: the images restyled toward the mean style of each
+        source domain."""
+        return [
+            self.adain(input, style_stats=style) for style in self.tta_styles
+        ]
+
+    def build_style_bank(self):
+        data_loader = build_style_data_loader(self.cfg, self.dm.dataset)
+        return StyleBank(self.adain, data_loader)
+
+    def train_batches(self):
+        batches = super().train_batches()
+        if self.style_prefetcher is not None:
+            batches = self.style_prefetcher(batches)
+        return batches
+
+    def parse_batch_style(self, batch_x, batch_u, K):
+        """Return the stylized views of the style cache or the style
+        prefetcher split into K chunks, as "x_sty" and "u_sty" ({} if
+        there are none)."""
+        if "img_sty" not in batch_x:
+            return {}
+        return {
+            "x_sty": batch_x["img_sty"].to(self.device).chunk(K),
+            "u_sty": batch_u["img_sty"].to(self.device).chunk(K),
+        }
+
+    def transfer_style(self, parsed_batch, K):
+        if "x_sty" in parsed_batch:
+            # Pre-rendered by the style cache
+            x_sty = parsed_batch["x_sty"]
+            u_sty = parsed_batch["u_sty"]
+            return [torch.cat([x_sty[k], u_sty[k]], 0) for k in range(K)]
+
+        x0 = parsed_batch["x0"]
+        u0 = parsed_batch["u0"]
+        xu_sty = []
+        for k in range(K):
+            # Content
+            x_k = x0[k]
+            u_k = u0[k]
+            xu_k = torch.cat([x_k, u_k], 0)
+            # Style
+            other_domains = [i for i in range(K) if i != k]
+            k2 = random.choice(other_domains)
+            if self.style_bank is not None:
+                # Draw style from the whole domain instead of the minibatch
+                domain = k2 if self.num_source_domains > 1 else 0
+                style_stats = self.style_bank.sample(domain, xu_k.size(0), xu_k.device)
+                xu_k_sty = self.adain(xu_k, style_stats=style_stats)
+            else:
+                x_k2 = x0[k2]
+                u_k2 = u0[k2]
+                xu_k2 = torch.cat([x_k2, u_k2], 0)
+                # Transfer
+                xu_k_sty = self.adain(xu_k, xu_k2)
+            xu_sty.append(xu_k_sty)
+        return xu_sty
+
+    def transfer_style_ahead(self, x0, u0):
+        """Stylize unsplit img0 batches, for the style prefetcher."""
+        K = self.num_source_domains
+        # NOTE: If num_source_domains=1, we split a batch into two halves
+        K = 2 if K == 1 else K
+        x0 = x0.chunk(K)
+        u0 = u0.chunk(K)
+        xu_sty = self.transfer_style({"x0": x0, "u0": u0}, K)
+        x_sty = [xu_k_sty[:x0[k].size(0)] for k, xu_k_sty in enumerate(xu_sty)]
+        u_sty = [xu_k_sty[x0[k].size(0):] for k, xu_k_sty in enumerate(xu_sty)]
+        return torch.cat(x_sty, 0), torch.cat(u_sty, 0)
@@ -0,0 +1,129 @@
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+
+class StochasticClassifier(nn.Module):
+    def __init__(self, num_features, num_classes, temp=0.05):
+        super().__init__()
+        self.mu = nn.Parameter(0.01 * torch.randn(num_classes, num_features))
+        self.sigma = nn.Parameter(torch.zeros(num_classes, num_features))
+        self.temp = temp
+
+    def forward(self, x, stochastic=True):
+        mu = self.mu
+        sigma = self.sigma
+
+        if stochastic:
+            sigma = F.softplus(sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
+            weight = sigma * torch.randn_like(mu) + mu
+        else:
+            weight = mu
+
+        weight = F.normalize(weight, p=2, dim=1)
+        x = F.normalize(x, p=2, dim=1)
+
+        score = F.linear(x, weight)
+        score = score / self.temp
+
+        return score
+
+    def ensemble(self, x, n_samples, generator=None):
+        """Mean score of n_samples stochastic classifiers.
+
+        The weights are sampled at once as a (N, C, D) tensor and scored
+        with one batched matmul.
+        """
+        sigma = F.softplus(self.sigma - 4)
+        noise = torch.randn(
+            n_samples,
+            *self.mu.shape,
+            generator=generator,
+            device=self.mu.device,
+            dtype=self.mu.dtype
+        )
+        weight = F.normalize(sigma*noise + self.mu, p=2, dim=2)
+        x = F.normalize(x, p=2, dim=1)
+
+        score = torch.matmul(x, weight.transpose(1, 2))  # (N, B, C)
+        score = score.mean(0) / self.temp
+
+        return score
+
+    def get_proxy(self, stochastic=False):
+        mu = self.mu
+
+        if stochastic:
+            sigma = F.softplus(self.sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
+            weight = sigma * torch.randn_like(mu) + mu
+        else:
+            weight = mu
+
+        return weight
+
+
+class NormalClassifier(nn.Module):
+    def __init__(self, num_features, num_classes, bias=True):
+        super().__init__()
+        self.linear = nn.Linear(num_features, num_classes, bias)
+
+    def forward(self, x, stochastic=True):
+        return self.linear(x)
+
+    def ensemble(self, x, n_samples, generator=None):
+        return self.linear(x)
+
+    def get_proxy(self, stochastic=True):
+        return self.linear.weight
+
+
+class ClassifierInferenceMixin:
+    """Test-time inference of a trainer with a backbone G and a
+    StochasticClassifier or NormalClassifier C.
+
+    The head is chosen by INFERENCE_MODE. With TEST_BOTH_MODES the other
+    head is also evaluated on the same backbone features, see
+    SimpleTrainer.test().
+    """
+
+    def build_inference(self):
+        cfg = self.cfg
+        # Inference mode: 1) deterministic 2) ensemble
+        self.inference_mode = cfg.TRAINER.STYLEMATCH.INFERENCE_MODE
+        self.n_ensemble = cfg.TRAINER.STYLEMATCH.N_ENSEMBLE
+        if self.inference_mode == "ensemble":
+            print(f"Apply ensemble (n={self.n_ensemble}) at test time")
+
+        self.inference_modes = [self.inference_mode]
+        if cfg.TRAINER.STYLEMATCH.TEST_BOTH_MODES:
+            self.inference_modes = ["deterministic", "ensemble"]
+            self.inference_modes.sort(key=lambda mode: mode != self.inference_mode)
+
+    def model_inference(self, input):
+        batch_size = input.size(0)
+        if self.tta is not None:
+            input = self.tta.views(input)
+        features = self.G(input)
+
+        outputs = {}
+        for mode in self.inference_modes:
+            output = self.classify(features, mode)
+            if self.tta is not None:
+                output = self.tta.aggregate(output, batch_size)
+            outputs[mode] = output
+
+        if len(outputs) == 1:
+            return outputs[self.inference_mode]
+        return outputs
+
+    def classify(self, features, inference_mode):
+        if inference_mode == "deterministic":
+            return self.C(features, stochastic=False)
+
+        elif inference_mode == "ensemble":
+            return self.C.ensemble(
+                features, self.n_ensemble, generator=self.test_generator
+            )
+
+        else:
+            raise NotImplementedError
@@ -15,7 +15,11 @@ from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.data.transforms import build_transform
 from dassl.utils import count_num_param
 
-from .adain.adain import AdaIN
+from .adain.adain import build_adain
+from .classifiers import (
+    StochasticClassifier, NormalClassifier, ClassifierInferenceMixin
+)
+from .adain.style_transfer import StyleTransferMixin
 
 
 @contextlib.contextmanager
@@ -31,72 +35,22 @@ def freeze_models_params(models):
                 param.requires_grad_(True)
 
 
-class StochasticClassifier(nn.Module):
-    def __init__(self, num_features, num_classes, temp=0.05):
-        super().__init__()
-        self.mu = nn.Parameter(0.01 * torch.randn(num_classes, num_features))
-        self.sigma = nn.Parameter(torch.zeros(num_classes, num_features))
-        self.temp = temp
-
-    def forward(self, x, stochastic=True):
-        mu = self.mu
-        sigma = self.sigma
-
-        if stochastic:
-            sigma = F.softplus(sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
-            weight = sigma * torch.randn_like(mu) + mu
-        else:
-            weight = mu
-
-        weight = F.normalize(weight, p=2, dim=1)
-        x = F.normalize(x, p=2, dim=1)
-
-        score = F.linear(x, weight)
-        score = score / self.temp
-
-        return score
-
-
-class NormalClassifier(nn.Module):
-    def __init__(self, num_features, num_classes):
-        super().__init__()
-        self.linear = nn.Linear(num_features, num_classes)
-
-    def forward(self, x, stochastic=True):
-        return self.linear(x)
-
-
 @TRAINER_REGISTRY.register()
-class ERM(TrainerXU):
+class ERM(ClassifierInferenceMixin, StyleTransferMixin, TrainerXU):
     def __init__(self, cfg):
         super().__init__(cfg)
         # Confidence threshold
         self.conf_thre = cfg.TRAINER.STYLEMATCH.CONF_THRE
 
-        # Inference mode: 1) deterministic 2) ensemble
-        self.inference_mode = cfg.TRAINER.STYLEMATCH.INFERENCE_MODE
-        self.n_ensemble = cfg.TRAINER.STYLEMATCH.N_ENSEMBLE
-        if self.inference_mode == "ensemble":
-            print(f"Apply ensemble (n={self.n_ensemble}) at test time")
+        self.build_inference()
 
-        norm_mean = None
-        norm_std = None
-
-        if "normalize" in cfg.INPUT.TRANSFORMS:
-            norm_mean = cfg.INPUT.PIXEL_MEAN
-            norm_std = cfg.INPUT.PIXEL_STD
-
-        self.adain = AdaIN(
-            cfg.TRAINER.STYLEMATCH.ADAIN_DECODER,
-            cfg.TRAINER.STYLEMATCH.ADAIN_VGG,
-            self.device,
-            norm_mean=norm_mean,
-            norm_std=norm_std,
-        )
+        self.adain = build_adain(cfg, self.device)
 
         self.apply_aug = cfg.TRAINER.STYLEMATCH.APPLY_AUG
         self.apply_sty = cfg.TRAINER.STYLEMATCH.APPLY_STY
 
+        self.build_tta_styles()
+
         self.save_sigma = cfg.TRAINER.STYLEMATCH.SAVE_SIGMA
         self.sigma_log = {"raw": [], "std": []}
         if self.save_sigma:
@@ -123,6 +77,7 @@ class ERM(TrainerXU):
         self.num_classes = dm.num_classes
         self.num_source_domains = dm.num_source_domains
         self.lab2cname = dm.lab2cname
+        self.dm = dm
 
     def build_model(self):
         cfg = self.cfg
@@ -286,29 +241,13 @@ class ERM(TrainerXU):
 
         return batch
 
-    def model_inference(self, input):
-        features = self.G(input)
-
-        if self.inference_mode == "deterministic":
-            prediction = self.C(features, stochastic=False)
-
-        elif self.inference_mode == "ensemble":
-            prediction = 0
-            for _ in range(self.n_ensemble):
-                prediction += self.C(features, stochastic=True)
-            prediction = prediction / self.n_ensemble
-
-        else:
-            raise NotImplementedError
-
-        return prediction
-
     def after_epoch(self):
         if (self.epoch+1) % 5 == 0 and (self.epoch+1) != self.cfg.OPTIM.MAX_EPOCH:
-            self.test()
+            self.test_in_background(subset=True)
             
     def after_train(self):
         print("Finish training")
+        self.collect_tests(wait=True)
 
         # Do testing
         if not self.cfg.TEST.NO_TEST:
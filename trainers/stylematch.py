@@ -1,5 +1,4 @@
 import contextlib
-import random
 import os
 import time
 import datetime
@@ -15,7 +14,10 @@ from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.data.transforms import build_transform
 from dassl.utils import count_num_param
 
-from .adain.adain import AdaIN
+from .classifiers import (
+    StochasticClassifier, NormalClassifier, ClassifierInferenceMixin
+)
+from .adain.style_transfer import StyleTransferMixin
 
 
 @contextlib.contextmanager
@@ -31,43 +33,8 @@ def freeze_models_params(models):
                 param.requires_grad_(True)
 
 
-class StochasticClassifier(nn.Module):
-    def __init__(self, num_features, num_classes, temp=0.05):
-        super().__init__()
-        self.mu = nn.Parameter(0.01 * torch.randn(num_classes, num_features))
-        self.sigma = nn.Parameter(torch.zeros(num_classes, num_features))
-        self.temp = temp
-
-    def forward(self, x, stochastic=True):
-        mu = self.mu
-        sigma = self.sigma
-
-        if stochastic:
-            sigma = F.softplus(sigma - 4)  # when sigma=0, softplus(sigma-4)=0.0181
-            weight = sigma * torch.randn_like(mu) + mu
-        else:
-            weight = mu
-
-        weight = F.normalize(weight, p=2, dim=1)
-        x = F.normalize(x, p=2, dim=1)
-
-        score = F.linear(x, weight)
-        score = score / self.temp
-
-        return score
-
-
-class NormalClassifier(nn.Module):
-    def __init__(self, num_features, num_classes):
-        super().__init__()
-        self.linear = nn.Linear(num_features, num_classes)
-
-    def forward(self, x, stochastic=True):
-        return self.linear(x)
-
-
 @TRAINER_REGISTRY.register()
-class StyleMatch(TrainerXU):
+class StyleMatch(ClassifierInferenceMixin, StyleTransferMixin, TrainerXU):
     """StyleMatch for semi-supervised domain generalization.
 
     Reference:
@@ -80,30 +47,13 @@ class StyleMatch(TrainerXU):
         # Confidence threshold
         self.conf_thre = cfg.TRAINER.STYLEMATCH.CONF_THRE
 
-        # Inference mode: 1) deterministic 2) ensemble
-        self.inference_mode = cfg.TRAINER.STYLEMATCH.INFERENCE_MODE
-        self.n_ensemble = cfg.TRAINER.STYLEMATCH.N_ENSEMBLE
-        if self.inference_mode == "ensemble":
-            print(f"Apply ensemble (n={self.n_ensemble}) at test time")
-
-        norm_mean = None
-        norm_std = None
-
-        if "normalize" in cfg.INPUT.TRANSFORMS:
-            norm_mean = cfg.INPUT.PIXEL_MEAN
-            norm_std = cfg.INPUT.PIXEL_STD
-
-        self.adain = AdaIN(
-            cfg.TRAINER.STYLEMATCH.ADAIN_DECODER,
-            cfg.TRAINER.STYLEMATCH.ADAIN_VGG,
-            self.device,
-            norm_mean=norm_mean,
-            norm_std=norm_std,
-        )
+        self.build_inference()
 
         self.apply_aug = cfg.TRAINER.STYLEMATCH.APPLY_AUG
         self.apply_sty = cfg.TRAINER.STYLEMATCH.APPLY_STY
 
+        self.build_style_transfer()
+
         self.save_sigma = cfg.TRAINER.STYLEMATCH.SAVE_SIGMA
         self.sigma_log = {"raw": [], "std": []}
         if self.save_sigma:
@@ -121,7 +71,11 @@ class StyleMatch(TrainerXU):
         choices = cfg.TRAINER.STYLEMATCH.STRONG_TRANSFORMS
         tfm_train_strong = build_transform(cfg, is_train=True, choices=choices)
         custom_tfm_train += [tfm_train_strong]
-        dm = DataManager(self.cfg, custom_tfm_train=custom_tfm_train)
+        dm = DataManager(
+            self.cfg,
+            custom_tfm_train=custom_tfm_train,
+            dataset_wrapper=self.style_dataset_wrapper()
+        )
         self.train_loader_x = dm.train_loader_x
         self.train_loader_u = dm.train_loader_u
         self.val_loader = dm.val_loader
@@ -129,6 +83,7 @@ class StyleMatch(TrainerXU):
         self.num_classes = dm.num_classes
         self.num_source_domains = dm.num_source_domains
         self.lab2cname = dm.lab2cname
+        self.dm = dm
 
     def build_model(self):
         cfg = self.cfg
@@ -213,21 +168,7 @@ class StyleMatch(TrainerXU):
         # Generate style transferred images
         ####################
         if self.apply_sty:
-            xu_sty = []
-            for k in range(K):
-                # Content
-                x_k = x0[k]
-                u_k = u0[k]
-                xu_k = torch.cat([x_k, u_k], 0)
-                # Style
-                other_domains = [i for i in range(K) if i != k]
-                k2 = random.choice(other_domains)
-                x_k2 = x0[k2]
-                u_k2 = u0[k2]
-                xu_k2 = torch.cat([x_k2, u_k2], 0)
-                # Transfer
-                xu_k_sty = self.adain(xu_k, xu_k2)
-                xu_sty.append(xu_k_sty)
+            xu_sty = self.transfer_style(parsed_batch, K)
 
         ####################
         # Supervised loss
@@ -347,31 +288,17 @@ class StyleMatch(TrainerXU):
             "y_u_true": y_u_true,  # kept intact
         }
 
-        return batch
-
-    def model_inference(self, input):
-        features = self.G(input)
+        batch.update(self.parse_batch_style(batch_x, batch_u, K))
 
-        if self.inference_mode == "deterministic":
-            prediction = self.C(features, stochastic=False)
-
-        elif self.inference_mode == "ensemble":
-            prediction = 0
-            for _ in range(self.n_ensemble):
-                prediction += self.C(features, stochastic=True)
-            prediction = prediction / self.n_ensemble
-
-        else:
-            raise NotImplementedError
-
-        return prediction
+        return batch
 
     def after_epoch(self):
         if (self.epoch+1) % 5 == 0 and (self.epoch+1) != self.cfg.OPTIM.MAX_EPOCH:
-            self.test()
+            self.test_in_background(subset=True)
             
     def after_train(self):
         print("Finish training")
+        self.collect_tests(wait=True)
 
         # Do testing
         if not self.cfg.TEST.NO_TEST: